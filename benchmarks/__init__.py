@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""iris benchmarks.  Run `python -m benchmarks.run --help` from the top of
+the source tree."""
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Deterministic synthetic photo corpus for the iris benchmarks.
+
+Files are real baseline JPEGs (and uncompressed grayscale TIFFs) that exiv2
+and other decoders accept, with the kind of metadata cameras write:  an
+IFD0 with make and model, an Exif IFD with exposure settings, dates, a lens
+and a maker note, an IFD1 thumbnail, and Photoshop IPTC keywords and
+captions.  The same seed always produces the same bytes, so results from
+different versions of iris are comparable.
+
+Image data is kept cheap to produce:  each 8x8 block is flat, and every row
+of blocks is its own restart interval, so a few encoded rows can be reused
+to fill out an image of any size."""
+
+import os
+import math
+import struct
+import random
+import datetime
+
+# -- tiff structures
+
+ASCII, SHORT, LONG, RATIONAL, UNDEFINED = 2, 3, 4, 5, 7
+
+def ascii(value):
+    return (ASCII, len(value) + 1, value + '\x00')
+
+def short(*values):
+    return (SHORT, len(values), struct.pack('<%dH' % len(values), *values))
+
+def long_(*values):
+    return (LONG, len(values), struct.pack('<%dL' % len(values), *values))
+
+def rational(*pairs):
+    return (RATIONAL, len(pairs), ''.join([struct.pack('<LL', n, d) for n, d in pairs]))
+
+def undefined(value):
+    return (UNDEFINED, len(value), value)
+
+def ifd_size(entries):
+    """The size of the IFD that `ifd` will pack entries into."""
+    extra = sum([len(data) + len(data) % 2 for type, count, data in entries.values() if len(data) > 4])
+    return 2 + len(entries) * 12 + 4 + extra
+
+def ifd(entries, offset, next=0):
+    """Pack {tag: (type, count, data)} into a little endian IFD that will
+    live at offset, followed by the values that don't fit in their entry."""
+    body = struct.pack('<H', len(entries))
+    extra = ''
+    start = offset + 2 + len(entries) * 12 + 4
+    for tag in sorted(entries):
+        type, count, data = entries[tag]
+        if len(data) <= 4:
+            body += struct.pack('<HHL', tag, type, count) + data.ljust(4, '\x00')
+        else:
+            body += struct.pack('<HHLL', tag, type, count, start + len(extra))
+            extra += data + '\x00' * (len(data) % 2)
+    return body + struct.pack('<L', next) + extra
+
+# -- jpeg encoding
+
+# the standard luminance dc table;  the only ac symbol used is end of block
+DC_COUNTS = [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]
+
+def _canonical_codes(counts):
+    """The canonical huffman code strings for symbols 0, 1, 2..."""
+    codes, code = [], 0
+    for length, count in enumerate(counts, 1):
+        for i in range(count):
+            codes.append(bin(code)[2:].zfill(length))
+            code += 1
+        code <<= 1
+    return codes
+
+DC_CODES = _canonical_codes(DC_COUNTS)
+
+def segment(marker, data):
+    return '\xff' + chr(marker) + struct.pack('>H', len(data) + 2) + data
+
+def _encode_blocks(values):
+    """Entropy code a run of flat blocks with brightnesses 0-255, starting
+    from a dc predictor of 0;  returns byte aligned, stuffed scan data."""
+    bits, previous = [], 0
+    for value in values:
+        dc = (value - 128) * 8
+        diff, previous = dc - previous, dc
+        size = len(bin(abs(diff))) - 2 if diff else 0
+        bits.append(DC_CODES[size])
+        if size:
+            bits.append(bin(diff if diff > 0 else diff + (1 << size) - 1)[2:].zfill(size))
+        bits.append('0')
+    bits = ''.join(bits)
+    bits += '1' * (-len(bits) % 8)
+    data = ''.join([chr(int(bits[i:i+8], 2)) for i in range(0, len(bits), 8)])
+    return data.replace('\xff', '\xff\x00')
+
+def _headers(width, height, interval=0):
+    dqt = '\x00' + '\x01' * 64
+    dht = '\x00' + ''.join(map(chr, DC_COUNTS)) + ''.join(map(chr, range(12)))
+    dht += '\x10' + '\x01' + '\x00' * 15 + '\x00'
+    frame = struct.pack('>BHHB', 8, height, width, 1) + '\x01\x11\x00'
+    headers = segment(0xdb, dqt) + segment(0xc4, dht) + segment(0xc0, frame)
+    if interval:
+        headers += segment(0xdd, struct.pack('>H', interval))
+    return headers
+
+def encode_jpeg(blocks, metadata=''):
+    """A grayscale jpeg of flat blocks (rows of 0-255 brightnesses), with the
+    metadata segments inserted after SOI."""
+    width, height = len(blocks[0]) * 8, len(blocks) * 8
+    scan = _encode_blocks([v for row in blocks for v in row])
+    return ('\xff\xd8' + metadata + _headers(width, height) +
+        segment(0xda, '\x01\x01\x00\x00\x3f\x00') + scan + '\xff\xd9')
+
+def encode_large_jpeg(rng, size, metadata=''):
+    """A grayscale jpeg of roughly size bytes, built out of a handful of
+    distinct rows of blocks, each in its own restart interval."""
+    # random flat blocks code to about two bytes each
+    columns = max(8, int(math.sqrt(size / 2.0 * 4 / 3.0)))
+    patterns = [_encode_blocks([rng.randint(0, 255) for i in range(columns)]) for j in range(8)]
+    per_row = sum(map(len, patterns)) / float(len(patterns)) + 2
+    rows = max(1, int(size / per_row))
+    scan = []
+    for row in range(rows):
+        scan.append(patterns[rng.randint(0, len(patterns) - 1)])
+        if row < rows - 1:
+            scan.append('\xff' + chr(0xd0 + row % 8))
+    return ('\xff\xd8' + metadata + _headers(columns * 8, rows * 8, columns) +
+        segment(0xda, '\x01\x01\x00\x00\x3f\x00') + ''.join(scan) + '\xff\xd9')
+
+def thumbnail(rng):
+    """A 160x120 thumbnail of random smooth waves, so that perceptual hashes
+    differ between photos."""
+    waves = [(rng.uniform(20, 60), rng.uniform(0.1, 0.8), rng.uniform(0.1, 0.8),
+        rng.uniform(0, 2 * math.pi)) for i in range(3)]
+    def pixel(x, y):
+        value = 128 + sum([a * math.sin(fx * x + fy * y + p) for a, fx, fy, p in waves])
+        return max(0, min(255, int(value)))
+    return encode_jpeg([[pixel(x, y) for x in range(20)] for y in range(15)])
+
+# -- metadata
+
+CAMERAS = [
+    ('Canon', 'Canon EOS 5D Mark II', ['EF24-70mm f/2.8L USM', 'EF50mm f/1.4 USM']),
+    ('NIKON CORPORATION', 'NIKON D700', ['24.0-70.0 mm f/2.8', '85.0 mm f/1.8']),
+    ('SONY', 'ILCE-7M3', ['FE 35mm F1.8', 'FE 24-105mm F4 G OSS']),
+    ('FUJIFILM', 'X-T2', ['XF23mmF1.4 R', 'XF56mmF1.2 R']),
+]
+WORDS = ('italy rome paris family beach sunset mountains snow birthday city '
+    'portrait street night river forest garden wedding dog cat bridge').split()
+SHUTTERS = [(1, 4000), (1, 1000), (1, 500), (1, 250), (1, 125), (1, 60), (1, 30), (1, 8), (1, 2), (2, 1)]
+FSTOPS = [14, 18, 20, 28, 40, 56, 80, 110, 160]
+ISOS = [100, 200, 400, 800, 1600, 3200, 6400]
+
+def exif(rng, index, width, height, makernote=2048):
+    """Random but plausible IFD0 and Exif IFD entries for photo number index,
+    as two {tag: entry} dictionaries."""
+    make, model, lenses = CAMERAS[rng.randint(0, len(CAMERAS) - 1)]
+    taken = datetime.datetime(2008, 1, 1) + datetime.timedelta(seconds=rng.randint(0, 10 * 365 * 86400))
+    stamp = taken.strftime('%Y:%m:%d %H:%M:%S')
+    focal = rng.choice([24, 35, 50, 70, 85, 105])
+    photo = {
+        0x829a: rational(rng.choice(SHUTTERS)),
+        0x829d: rational((rng.choice(FSTOPS), 10)),
+        0x8822: short(rng.randint(1, 4)),
+        0x8827: short(rng.choice(ISOS)),
+        0x9000: undefined('0230'),
+        0x9003: ascii(stamp),
+        0x9004: ascii(stamp),
+        0x9204: (10, 1, struct.pack('<ll', rng.randint(-6, 6), 3)),
+        0x9207: short(5),
+        0x9209: short(rng.choice([0, 16, 24])),
+        0x920a: rational((focal, 1)),
+        # maker notes are mostly opaque binary, and they're most of the exif
+        0x927c: undefined(make[:5] + '\x00' + ''.join([chr(rng.randint(0, 255)) for i in range(makernote)])),
+        0x9291: ascii('%02d' % rng.randint(0, 99)),
+        0xa001: short(1),
+        0xa002: long_(width),
+        0xa003: long_(height),
+        0xa405: short(focal),
+        0xa434: ascii(rng.choice(lenses)),
+        0xa431: ascii('%010d' % rng.randint(0, 10 ** 9)),
+    }
+    image = {
+        0x010f: ascii(make),
+        0x0110: ascii(model),
+        0x0112: short(rng.choice([1, 1, 1, 6, 8])),
+        0x011a: rational((72, 1)),
+        0x011b: rational((72, 1)),
+        0x0128: short(2),
+        0x0131: ascii('iris benchmark corpus'),
+        0x0132: ascii(stamp),
+        0x013b: ascii('Photographer %d' % (index % 7)),
+        0x8769: long_(0),
+    }
+    return image, photo
+
+def pack_exif(image, photo, thumb=None, base=0, image_extra=None):
+    """Lay out IFD0 (with image_extra entries), the Exif IFD and IFD1 at
+    base, returning the tiff structure without its 8 byte header."""
+    image = dict(image, **(image_extra or {}))
+    image_offset = base + 8
+    photo_offset = image_offset + ifd_size(image)
+    image[0x8769] = long_(photo_offset)
+    packed_photo = ifd(photo, photo_offset)
+    thumb_offset = photo_offset + len(packed_photo)
+    ifd1 = ''
+    if thumb:
+        entries = {0x0103: short(6), 0x0201: long_(0), 0x0202: long_(len(thumb))}
+        entries[0x0201] = long_(thumb_offset + ifd_size(entries))
+        ifd1 = ifd(entries, thumb_offset) + thumb
+    packed_image = ifd(image, image_offset, thumb_offset if thumb else 0)
+    return packed_image + packed_photo + ifd1
+
+def iptc(rng):
+    """Photoshop IRB with an IPTC record of keywords, caption, city and a
+    creation date."""
+    keywords = rng.sample(WORDS, rng.randint(1, 6))
+    caption = ' '.join(rng.sample(WORDS, 5)).capitalize()
+    datasets = [(2, 0, '\x00\x04')] + [(2, 25, k) for k in keywords] + [
+        (2, 120, caption), (2, 90, rng.choice(['Rome', 'Paris', 'Toronto', 'Kyoto'])),
+        (2, 55, '20%02d%02d%02d' % (rng.randint(8, 17), rng.randint(1, 12), rng.randint(1, 28))),
+        (2, 80, 'Photographer')]
+    iim = ''.join(['\x1c' + chr(r) + chr(d) + struct.pack('>H', len(v)) + v for r, d, v in datasets])
+    iim += '\x00' * (len(iim) % 2)
+    return 'Photoshop 3.0\x00' + '8BIM' + struct.pack('>H', 0x0404) + '\x00\x00' + \
+        struct.pack('>L', len(iim)) + iim
+
+def jpeg_file(rng, index, size, makernote=2048):
+    image, photo = exif(rng, index, 0, 0, makernote)
+    tiff = 'II*\x00' + struct.pack('<L', 8) + pack_exif(image, photo, thumbnail(rng))
+    metadata = segment(0xe1, 'Exif\x00\x00' + tiff) + segment(0xed, iptc(rng))
+    return encode_large_jpeg(rng, size, metadata)
+
+def tiff_file(rng, index, size, makernote=2048):
+    """An uncompressed 8 bit grayscale tiff of about size bytes."""
+    width = max(8, int(math.sqrt(size * 4 / 3.0)))
+    height = max(8, size // width)
+    image, photo = exif(rng, index, width, height, makernote)
+    row = ''.join([chr(rng.randint(0, 255)) for i in range(width)])
+    pixels = row * height
+    strip_offset = 8
+    extra = {
+        0x0100: long_(width), 0x0101: long_(height), 0x0102: short(8),
+        0x0103: short(1), 0x0106: short(1), 0x0111: long_(strip_offset),
+        0x0115: short(1), 0x0116: long_(height), 0x0117: long_(len(pixels)),
+        0x83bb: undefined(iptc(rng)[len('Photoshop 3.0\x00') + 12:]),
+    }
+    return 'II*\x00' + struct.pack('<L', 8 + len(pixels)) + pixels + \
+        pack_exif(image, photo, base=len(pixels), image_extra=extra)
+
+def generate(root, count=1000, size=256 * 1024, tiff_ratio=0.1, depth=2, fanout=8, seed=0,
+        makernote=2048):
+    """Write count photos of about size bytes under root, spread over a tree
+    of directories depth levels deep with fanout subdirectories each.  About
+    tiff_ratio of them are tiffs.  Returns a list of the paths written."""
+    rng = random.Random(seed)
+    paths = []
+    for index in range(count):
+        parts = []
+        for level in range(depth):
+            parts.append('d%02d' % rng.randint(0, fanout - 1))
+        directory = os.path.join(root, *parts)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if rng.random() < tiff_ratio:
+            path, data = os.path.join(directory, 'IMG_%05d.tif' % index), tiff_file(rng, index, size, makernote)
+        else:
+            path, data = os.path.join(directory, 'IMG_%05d.jpg' % index), jpeg_file(rng, index, size, makernote)
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+    return paths
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""An in-process stand-in for a mongo collection, so the benchmarks can run
+without a mongod.  It implements only what iris' ingest path uses, keeps an
+index on 'path', and BSON encodes everything written to it so that the cost
+of serializing documents is still counted."""
+
+import itertools
+
+from bson import BSON
+
+class _BulkFind(object):
+    def __init__(self, bulk, spec):
+        self.bulk = bulk
+        self.spec = spec
+        self.upserting = False
+
+    def upsert(self):
+        self.upserting = True
+        return self
+
+    def replace_one(self, document):
+        self.bulk.operations.append(('replace', self.spec, document, self.upserting))
+
+    def update_one(self, update):
+        self.bulk.operations.append(('update', self.spec, update, self.upserting))
+
+class MemoryBulk(object):
+    """The subset of pymongo's BulkOperationBuilder BulkInserter uses."""
+    def __init__(self, collection):
+        self.collection = collection
+        self.operations = []
+
+    def find(self, spec):
+        return _BulkFind(self, spec)
+
+    def insert(self, document):
+        self.operations.append(('insert', None, document, False))
+
+    def execute(self):
+        result = dict(nInserted=0, nUpserted=0, nMatched=0, nModified=0, nRemoved=0)
+        for operation, spec, document, upsert in self.operations:
+            if operation == 'insert':
+                self.collection.insert(document)
+                result['nInserted'] += 1
+                continue
+            found = self.collection.find_one(spec)
+            if found is not None and operation == 'update':
+                found.update(document.get('$set', {}))
+                for key in document.get('$unset', {}):
+                    found.pop(key, None)
+                self.collection._store(found)
+                result['nMatched'] += 1
+                result['nModified'] += 1
+            elif found is not None:
+                self.collection._store(dict(document, _id=found['_id']))
+                result['nMatched'] += 1
+                result['nModified'] += 1
+            elif upsert:
+                self.collection._store(dict(document, _id=document.get('_id', self.collection._ids.next())))
+                result['nUpserted'] += 1
+        return result
+
+class MemoryCollection(object):
+    _names = itertools.count(1)
+
+    def __init__(self):
+        # what backend keys write generations on;  every stand-in is new
+        self.full_name = 'memory.photos%d' % self._names.next()
+        self.documents = {}
+        self.paths = {}
+        self._ids = itertools.count(1)
+        self.bytes_written = 0
+
+    def _matches(self, document, spec):
+        for key, value in spec.iteritems():
+            if isinstance(value, dict) and '$in' in value:
+                if document.get(key) not in value['$in']:
+                    return False
+            elif document.get(key) != value:
+                return False
+        return True
+
+    def _candidates(self, spec):
+        """Use the _id or path index when the spec allows it."""
+        if '_id' in spec:
+            ids = spec['_id']['$in'] if isinstance(spec['_id'], dict) else [spec['_id']]
+            return [self.documents[i] for i in ids if i in self.documents]
+        path = spec.get('path')
+        if isinstance(path, dict) and '$in' in path:
+            ids = [self.paths[p] for p in path['$in'] if p in self.paths]
+        elif isinstance(path, basestring):
+            ids = [self.paths[path]] if path in self.paths else []
+        else:
+            return self.documents.values()
+        return [self.documents[i] for i in ids]
+
+    def find(self, spec=None, fields=None, **kwargs):
+        spec = spec or {}
+        results = [d for d in self._candidates(spec) if self._matches(d, spec)]
+        if fields is not None:
+            fields = set(fields) | set(['_id'])
+            return [dict([(k, v) for k, v in d.iteritems() if k in fields]) for d in results]
+        return [dict(d) for d in results]
+
+    def find_one(self, spec=None, fields=None, **kwargs):
+        results = self.find(spec, fields)
+        return results[0] if results else None
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulk(self)
+
+    def count(self):
+        return len(self.documents)
+
+    def _store(self, document):
+        self.bytes_written += len(BSON.encode(document))
+        previous = self.documents.get(document['_id'])
+        if previous is not None and previous.get('path') in self.paths:
+            del self.paths[previous['path']]
+        self.documents[document['_id']] = dict(document)
+        if 'path' in document:
+            self.paths[document['path']] = document['_id']
+
+    def insert(self, documents):
+        if isinstance(documents, dict):
+            documents = [documents]
+        for document in documents:
+            document.setdefault('_id', self._ids.next())
+            self._store(document)
+        return [d['_id'] for d in documents]
+
+    def save(self, document):
+        document.setdefault('_id', self._ids.next())
+        self._store(document)
+        return document['_id']
+
+    def remove(self, spec=None):
+        for document in self.find(spec or {}):
+            self.paths.pop(document.get('path'), None)
+            del self.documents[document['_id']]
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Time parsing and tab completion of iris shell queries and print the
+results as json.
+
+    python -m benchmarks.query --repeat 5 --number 2000
+
+Each statement (and each partial line, for completion) is handled --number
+times per repeat;  the best repeat is reported per call, in seconds.  The
+cold costs of importing and of the first parse and completion are timed
+in fresh interpreters."""
+
+import sys
+import json
+import time
+import platform
+import datetime
+import subprocess
+from optparse import OptionParser
+
+from benchmarks.run import summarize
+
+# %(n)d is replaced with a different number for every call, since LEPL
+# cached what it had parsed by string, and users rarely repeat themselves
+STATEMENTS = [
+    'find %(n)d',
+    'find %(n)d (path, iso) where iso <= 400',
+    'find where iso < %(n)d and tags in ("italy", "portugal", "spain")',
+    'find 10 (iso) where iso > %(n)d or caption = "hello world" or shutter < 0.1',
+    'count where aperture > 2.3 and iso >= %(n)d and tags in ("beach")',
+]
+
+COMPLETIONS = [
+    ('find', 'find %(n)d'),
+    ('find', 'find %(n)d (pa'),
+    ('find', 'find %(n)d (path, is'),
+    ('find', 'find %(n)d (path, iso) wh'),
+    ('count', 'count where iso > %(n)d'),
+]
+
+def time_calls(function, templates, number, repeat):
+    """Call function on number different fillings of every template, repeat
+    times over, and summarize the seconds per call."""
+    seconds = []
+    for i in range(repeat):
+        arguments = [fill(t, i * number + j) for j in xrange(number) for t in templates]
+        t0 = time.time()
+        for argument in arguments:
+            function(argument)
+        seconds.append((time.time() - t0) / len(arguments))
+    return summarize(seconds, len(templates))
+
+def fill(template, n):
+    if isinstance(template, tuple):
+        return template[:-1] + (template[-1] % {'n': n},)
+    return template % {'n': n}
+
+COLD = """
+import time, json
+t0 = time.time()
+from iris.query import parser, completion
+t1 = time.time()
+parser.find_stmt.parse(%r)
+t2 = time.time()
+try:
+    completion.FindStatement('', 'find ').complete()
+except Exception:
+    pass
+t3 = time.time()
+print json.dumps({'import': t1 - t0, 'first_parse': t2 - t1, 'first_complete': t3 - t2})
+"""
+
+def cold(repeat):
+    """The best seconds to import the query modules and then parse and
+    complete for the first time, each in a fresh interpreter, which is what
+    a one-off `iris` command pays."""
+    runs = []
+    for i in range(repeat):
+        output = subprocess.Popen([sys.executable, '-c', COLD % fill(STATEMENTS[1], 10)],
+            stdout=subprocess.PIPE).communicate()[0]
+        runs.append(json.loads(output))
+    return dict([(key, min([r[key] for r in runs])) for key in runs[0]])
+
+def main(argv=None):
+    parser = OptionParser(usage='python -m benchmarks.query [options]')
+    parser.add_option('-n', '--number', type='int', default=1000, help='calls per statement per repeat')
+    parser.add_option('-r', '--repeat', type='int', default=3)
+    parser.add_option('-o', '--out', metavar='FILE', help='write json here instead of stdout')
+    options, args = parser.parse_args(argv)
+
+    from iris.query import parser as q, completion
+    completers = {'find': completion.FindStatement, 'count': completion.CountStatement}
+    def complete(argument):
+        command, line = argument
+        return completers[command](line.split(' ')[-1], line).complete()
+
+    results = {
+        'cold': cold(options.repeat),
+        'parse': time_calls(q.statement.parse, STATEMENTS, options.number, options.repeat),
+        'find_statement': time_calls(q.FindStatement, STATEMENTS[:-1], options.number, options.repeat),
+        'complete': time_calls(complete, COMPLETIONS, options.number, options.repeat),
+    }
+    for name in ('parse', 'find_statement', 'complete'):
+        print >>sys.stderr, '%-15s %10.1fus/call' % (name, results[name]['best'] * 1e6)
+    for name, seconds in sorted(results['cold'].items()):
+        print >>sys.stderr, 'cold %-10s %10.1fms' % (name, seconds * 1e3)
+
+    from iris import version
+    report = {
+        'iris': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'options': {'number': options.number, 'repeat': options.repeat},
+        'results': results,
+    }
+    output = open(options.out, 'w') if options.out else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if options.out:
+        output.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
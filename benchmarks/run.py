@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Run the iris ingest benchmarks and print the results as json.
+
+    python -m benchmarks.run --count 2000 --out results.json
+
+A deterministic corpus (see `benchmarks.corpus`) is generated in a temporary
+directory, or in --corpus if it's given (and reused if it's already there).
+Then each benchmark is run --repeat times:
+
+    walk          utils.recursive_walk over the corpus
+    metadata      MetaData for every file, with exif and iptc serialized
+    bulk_insert   BulkInserter writing every document into an empty collection
+    bulk_update   ... and writing them all again over the top
+    add           a whole `iris add -r` into an empty collection
+    add_unchanged `iris add -r` again, with nothing changed
+    add_force     `iris add -r --force`, reading everything again
+
+Writes go to an in-process stand-in collection unless --mongo HOST:PORT is
+given, in which case the 'iris_benchmark' database there is used (and
+dropped)."""
+
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+import datetime
+from optparse import OptionParser
+
+from benchmarks import corpus
+
+BENCHMARKS = ['walk', 'metadata', 'bulk_insert', 'bulk_update', 'add', 'add_unchanged', 'add_force']
+
+def summarize(seconds, items):
+    best = min(seconds)
+    ordered = sorted(seconds)
+    return {
+        'seconds': seconds,
+        'best': best,
+        'median': ordered[len(ordered) // 2],
+        'items': items,
+        'items_per_second': items / best if best else None,
+    }
+
+class Runner(object):
+    def __init__(self, options, root, paths):
+        self.options = options
+        self.root = root
+        self.paths = paths
+        self._documents = None
+
+    def collection(self):
+        """A fresh, empty photos collection, which Photo.objects uses too."""
+        from iris import backend
+        if self.options.mongo:
+            import pymongo
+            host, port = self.options.mongo.split(':')
+            db = pymongo.Connection(host, int(port)).iris_benchmark
+            db.drop_collection('photos')
+            collection = db.photos
+            collection.create_index([('path', pymongo.DESCENDING)])
+        else:
+            from benchmarks.memory import MemoryCollection
+            collection = MemoryCollection()
+        backend.Photo.objects.collection = collection
+        return collection
+
+    def documents(self):
+        if self._documents is None:
+            from iris import ingest
+            self._documents = [ingest.extract(p, os.stat(p)) for p in self.paths]
+        return self._documents
+
+    def time(self, name, setup=None):
+        """Time the bench_name method --repeat times, running setup (whose
+        result is passed to it) untimed before each."""
+        function = getattr(self, 'bench_' + name)
+        seconds, items = [], 0
+        for i in range(self.options.repeat):
+            argument = setup() if setup else None
+            t0 = time.time()
+            items = function(argument)
+            seconds.append(time.time() - t0)
+        return summarize(seconds, items)
+
+    def bench_walk(self, ignored):
+        from iris import utils
+        return len(utils.recursive_walk(self.root))
+
+    def bench_metadata(self, ignored):
+        from iris.loaders.file import MetaData
+        for path in self.paths:
+            meta = MetaData(path)
+            meta.exif, meta.iptc
+        return len(self.paths)
+
+    def _bulk(self, collection):
+        from iris import backend
+        inserter = backend.BulkInserter(collection, threshold=self.options.threshold, unique_attr='path')
+        for document in self.documents():
+            inserter.insert(dict(document))
+        inserter.flush()
+        return len(self.documents())
+
+    def bench_bulk_insert(self, collection):
+        return self._bulk(collection)
+
+    def bench_bulk_update(self, collection):
+        return self._bulk(collection)
+
+    def _add(self, force=False):
+        from iris import utils, ingest
+        pipeline = ingest.Pipeline(workers=self.options.workers, force=force,
+            hashing=self.options.hash, threshold=self.options.threshold)
+        pipeline.run(utils.walk(self.root))
+        return len(self.paths)
+
+    def bench_add(self, ignored):
+        return self._add()
+
+    def bench_add_unchanged(self, ignored):
+        return self._add()
+
+    def bench_add_force(self, ignored):
+        return self._add(force=True)
+
+    def run(self, names):
+        results = {}
+        def populated():
+            collection = self.collection()
+            self._bulk(collection)
+            return collection
+        def added():
+            self.collection()
+            self._add()
+        setups = {
+            'bulk_insert': self.collection,
+            'bulk_update': populated,
+            'add': self.collection,
+            'add_unchanged': added,
+            'add_force': added,
+        }
+        for name in names:
+            results[name] = self.time(name, setups.get(name))
+            print >>sys.stderr, '%-14s %8.3fs  %10.1f/s' % (name, results[name]['best'],
+                results[name]['items_per_second'] or 0)
+        return results
+
+def main(argv=None):
+    parser = OptionParser(usage='python -m benchmarks.run [options]')
+    parser.add_option('-n', '--count', type='int', default=1000, help='photos in the corpus')
+    parser.add_option('-s', '--size', type='int', default=256 * 1024, help='approximate bytes per photo')
+    parser.add_option('', '--tiff-ratio', type='float', default=0.1, help='fraction of photos that are tiffs')
+    parser.add_option('', '--depth', type='int', default=2, help='directory levels')
+    parser.add_option('', '--fanout', type='int', default=8, help='subdirectories per directory')
+    parser.add_option('', '--makernote', type='int', default=2048, help='bytes of maker note per photo')
+    parser.add_option('', '--seed', type='int', default=0)
+    parser.add_option('', '--corpus', metavar='DIR', help='generate (or reuse) the corpus in DIR and keep it')
+    parser.add_option('-w', '--workers', type='int', default=0, help='extractor processes for add')
+    parser.add_option('', '--hash', choices=['full', 'quick'], default=None, help='content hash during add')
+    parser.add_option('-t', '--threshold', type='int', default=50, help='BulkInserter threshold')
+    parser.add_option('-r', '--repeat', type='int', default=3)
+    parser.add_option('', '--mongo', metavar='HOST:PORT', help='use a real mongod')
+    parser.add_option('-b', '--benchmarks', default=','.join(BENCHMARKS),
+        help='comma separated benchmarks to run (default: all)')
+    parser.add_option('-o', '--out', metavar='FILE', help='write json here instead of stdout')
+    options, args = parser.parse_args(argv)
+
+    names = options.benchmarks.split(',')
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+
+    root = options.corpus or tempfile.mkdtemp(prefix='iris-corpus-')
+    try:
+        t0 = time.time()
+        paths = sorted(os.path.join(r, f) for r, d, fs in os.walk(root) for f in fs)
+        if not paths:
+            paths = corpus.generate(root, count=options.count, size=options.size,
+                tiff_ratio=options.tiff_ratio, depth=options.depth, fanout=options.fanout,
+                seed=options.seed, makernote=options.makernote)
+        generated = time.time() - t0
+        total = sum([os.path.getsize(p) for p in paths])
+        runner = Runner(options, root, paths)
+        results = runner.run(names)
+    finally:
+        if not options.corpus:
+            shutil.rmtree(root)
+
+    from iris import version
+    report = {
+        'iris': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'backend': 'mongodb %s' % options.mongo if options.mongo else 'memory',
+        'corpus': {
+            'count': len(paths),
+            'bytes': total,
+            'size': options.size,
+            'tiff_ratio': options.tiff_ratio,
+            'depth': options.depth,
+            'fanout': options.fanout,
+            'makernote': options.makernote,
+            'seed': options.seed,
+            'generate_seconds': generated,
+        },
+        'options': {
+            'workers': options.workers,
+            'hash': options.hash,
+            'threshold': options.threshold,
+            'repeat': options.repeat,
+        },
+        'results': results,
+    }
+    output = open(options.out, 'w') if options.out else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if options.out:
+        output.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
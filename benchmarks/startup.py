@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Time how long `iris` commands take to start, each in a fresh interpreter,
+and check they don't import what they don't need.  Prints the results as
+json, and exits with 1 if any command is over its budget:
+
+    python -m benchmarks.startup --repeat 10 --scale 1.5
+
+Commands that use the database are pointed (through a temporary HOME and
+~/.iris.cfg) at a port nothing listens on, so they fail as soon as they
+try to connect;  what's timed is everything up to there.  Any other
+failure, like a missing dependency, fails the benchmark."""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import datetime
+import subprocess
+from optparse import OptionParser
+
+# command -> (arguments, budget in milliseconds, modules it must not import)
+COMMANDS = {
+    'help': (['help'], 80, ['pyexiv2', 'pymongo', 'iris.backend', 'iris.query.parser']),
+    'help add': (['help', 'add'], 80, ['pyexiv2', 'pymongo', 'iris.backend', 'iris.query.parser']),
+    'list': (['list'], 250, ['pyexiv2', 'iris.query.parser']),
+}
+
+DRIVER = """
+import sys, os, json
+sys.argv = ['iris'] + %r
+stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+try:
+    from iris import script
+    script.main()
+except SystemExit, e:
+    if e.code:
+        raise
+except Exception, e:
+    # pymongo is only imported here, so it isn't counted against commands
+    from pymongo.errors import ConnectionFailure
+    if not isinstance(e, ConnectionFailure):
+        raise
+stdout.write(json.dumps(sorted(sys.modules)))
+"""
+
+def start(arguments, home):
+    """Run iris with arguments in a fresh interpreter.  Returns the wall
+    clock seconds and the modules it imported, or raises RuntimeError if
+    it fails other than by not being able to connect."""
+    env = dict(os.environ, HOME=home)
+    t0 = time.time()
+    process = subprocess.Popen([sys.executable, '-c', DRIVER % arguments], env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    seconds = time.time() - t0
+    if process.returncode:
+        raise RuntimeError('iris %s failed:\n%s' % (' '.join(arguments), errors))
+    return seconds, json.loads(output)
+
+def main(argv=None):
+    parser = OptionParser(usage='python -m benchmarks.startup [options]')
+    parser.add_option('-r', '--repeat', type='int', default=5)
+    parser.add_option('-s', '--scale', type='float', default=1.0,
+        help='multiply the budgets, for slow machines')
+    parser.add_option('-o', '--out', metavar='FILE', help='write json here instead of stdout')
+    options, args = parser.parse_args(argv)
+
+    home = tempfile.mkdtemp(prefix='iris-startup-')
+    try:
+        with open(os.path.join(home, '.iris.cfg'), 'w') as f:
+            f.write('[db]\nhost = 127.0.0.1\nport = 1\n')
+        baseline = min([start([], home)[0] for i in range(options.repeat)])
+        results, failed = {}, False
+        for name, (arguments, budget, forbidden) in sorted(COMMANDS.items()):
+            runs = [start(arguments, home) for i in range(options.repeat)]
+            best = min([seconds for seconds, modules in runs])
+            imported = [m for m in forbidden if m in runs[0][1]]
+            over = best * 1000 > budget * options.scale
+            failed = failed or over or bool(imported)
+            results[name] = {
+                'seconds': [seconds for seconds, modules in runs],
+                'best': best,
+                'budget': budget * options.scale / 1000.0,
+                'modules': len(runs[0][1]),
+                'forbidden_imports': imported,
+            }
+            print >>sys.stderr, '%-10s %8.1fms (budget %dms) %s' % (name, best * 1000,
+                budget * options.scale, 'imports ' + ', '.join(imported) if imported else '')
+    finally:
+        shutil.rmtree(home)
+
+    from iris import version
+    report = {
+        'iris': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'options': {'repeat': options.repeat, 'scale': options.scale},
+        'interpreter': baseline,
+        'results': results,
+    }
+    output = open(options.out, 'w') if options.out else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if options.out:
+        output.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
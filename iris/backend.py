@@ -6,14 +6,33 @@
 Iris uses mongodb because it's web scale."""
 
 import os
+import sys
+import math
+import time
+import Queue
+import datetime
 import imghdr
+import weakref
 
+import bson
 import pymongo
 import threading
 
-from iris.loaders import file, picasa
+from iris.loaders import phash
+from iris import utils, metrics, fields
 from iris.utils import memoize, OpenStruct, exclude_self
 
+# how much of a file the quick content hash looks at
+QUICK_HASH_BYTES = 64 * 1024
+# a BulkInserter byte budget well under mongo's 48MB message limit
+BATCH_BYTES = 8 * 1024 * 1024
+# BulkInserters measure the encoded size of one document in this many, and
+# take the rest to be the average of those, rather than encoding every one
+# for the budget and again when it's written
+SIZE_SAMPLE = 16
+# bump this whenever `migrate` has something new to do to a database
+SCHEMA_VERSION = 2
+
 @memoize
 def get_database(host=None, port=None):
     """Get the iris mongo db from host and port.  If none are supplied, attempt
@@ -28,191 +47,870 @@ def get_database(host=None, port=None):
         except:
             host, port = '127.0.0.1', 27017
     connection = pymongo.Connection(host, port)
-    db = connection.iris
+    return connection.iris
+
+def create_indexes(db):
+    """Create the indexes on the photos collection."""
     photos = db.photos
     photos.create_index([('path', pymongo.DESCENDING)])
     photos.create_index([('date', pymongo.DESCENDING)])
-    return db
+    photos.create_index([('hash', pymongo.ASCENDING)], sparse=True)
+    photos.create_index([('quickhash', pymongo.ASCENDING)], sparse=True)
+    photos.create_index([('phash_bands', pymongo.ASCENDING)], sparse=True)
+    for name in fields.NAMES:
+        photos.create_index([(name, pymongo.ASCENDING)], sparse=True)
+    photos.create_index([('keywords', pymongo.ASCENDING)])
+
+def backfill(collection):
+    """Fill in the typed fields, date and keywords of the photos in
+    collection that were stored before iris kept them, so queries on them
+    (and keyword lookups for `==`) find those photos too.  The fields are
+    extracted from the stored exif, and the date falls back to the
+    modification time in the fingerprint.  Returns how many were updated."""
+    spec = {'$or': [{'keywords': {'$exists': False}}, {'date': {'$exists': False}}]}
+    updated = 0
+    pager = Pager(collection, sort=[('_id', pymongo.ASCENDING)], threshold=500)
+    for document in pager.find(spec):
+        changes = {}
+        for name, value in fields.extract(fields.StoredMeta(document)).items():
+            if document.get(name) is None:
+                changes[name] = document[name] = value
+        if document.get('date') is None:
+            if document.get('taken_at'):
+                changes['date'] = document['taken_at']
+            elif document.get('fingerprint'):
+                changes['date'] = datetime.datetime.fromtimestamp(document['fingerprint'][3] // 1000000000)
+        changes['keywords'] = fields.keywords(document)
+        collection.update({'_id': document['_id']}, {'$set': changes})
+        updated += 1
+    if updated:
+        bump_generation(collection)
+    return updated
+
+def migrate(db):
+    """Bring db up to SCHEMA_VERSION if an older iris (or none) set it up,
+    and return True if there was anything to do.  The version is kept in
+    the 'meta' collection."""
+    schema = db.meta.find_one({'_id': 'schema'}) or {}
+    version = schema.get('version', 0)
+    if version >= SCHEMA_VERSION:
+        return False
+    create_indexes(db)
+    if version < 2:
+        backfill(db.photos)
+    db.meta.update({'_id': 'schema'}, {'$set': {'version': SCHEMA_VERSION}}, upsert=True)
+    return True
+
+@memoize
+def ensure_schema():
+    """`migrate` the iris database, once per process.  The commands that
+    write photos and the shell (whose queries hint at indexes) call this;
+    the others don't need to."""
+    migrate(get_database())
+
+def fingerprint(stat):
+    """Return a cheap identity for a file from its stat result.  If any of
+    the device, inode, size or modification time change, the file is treated
+    as changed and its metadata is read again on the next add."""
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1000000000)
+    return [stat.st_dev, stat.st_ino, stat.st_size, mtime_ns]
+
+def aggregate(collection, pipeline):
+    """Run an aggregation pipeline and return an iterable of the resulting
+    documents;  older pymongos return these wrapped up in a dictionary."""
+    result = collection.aggregate(pipeline)
+    if isinstance(result, dict):
+        return result['result']
+    return result
+
+def group_spec(keys, spec=None, width=None):
+    """The spec for the documents `group_pipeline` groups:  those matching
+    spec, with a date if any of the keys is a period, and with a value for
+    the key of a histogram."""
+    conditions = [spec] if spec else []
+    if [k for k in keys if k in fields.PERIODS]:
+        conditions.append({'date': {'$ne': None}})
+    if width:
+        conditions.extend([{k: {'$ne': None}} for k in keys if k not in fields.PERIODS])
+    if len(conditions) > 1:
+        return {'$and': conditions}
+    return conditions[0] if conditions else {}
+
+def _group_expression(key, width=None):
+    """The $group _id expression for key:  a field, a field's value rounded
+    down to a multiple of width, or a period of the date."""
+    if key in fields.PERIODS:
+        parts = [{'$year': '$date'}, {'$month': '$date'}, {'$dayOfMonth': '$date'}]
+        expression = parts[0]
+        for part in parts[1:fields.PERIODS.index(key) + 1]:
+            expression = {'$add': [{'$multiply': [expression, 100]}, part]}
+        return expression
+    if width:
+        return {'$subtract': ['$' + key, {'$mod': ['$' + key, width]}]}
+    return '$' + key
+
+def _group_value(document, key, width=None):
+    """What `_group_expression` works out for a document, in python."""
+    if key in fields.PERIODS:
+        return fields.period(key, document.get('date'))
+    value = _lookup(document, key)
+    if width and isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        # fmod rounds towards zero, the way $mod does
+        remainder = math.fmod(value, width)
+        if isinstance(value, (int, long)) and isinstance(width, (int, long)):
+            remainder = int(remainder)
+        return value - remainder
+    return value
+
+def group_pipeline(keys, spec=None, width=None, order='count'):
+    """The aggregation pipeline that counts the documents matching spec by
+    their values for keys, into documents of an _id with each key and a
+    'count'.  They're ordered by count, most first, or with order='value'
+    by the values of the keys."""
+    group = bson.SON([(key, _group_expression(key, width)) for key in keys])
+    if order == 'count':
+        sort = bson.SON([('count', -1)] + [('_id.' + key, 1) for key in keys])
+    else:
+        sort = bson.SON([('_id.' + key, 1) for key in keys])
+    return [
+        {'$match': group_spec(keys, spec, width)},
+        {'$group': {'_id': group, 'count': {'$sum': 1}}},
+        {'$sort': sort},
+    ]
+
+def diff(old, new, keys=None):
+    """Return the update ({'$set': ..., '$unset': ...}) that turns document
+    old into document new, looking only at keys if they're given, or {} if
+    there's nothing to change.  The _id is never changed."""
+    if keys is None:
+        keys = set(old) | set(new)
+    sets, unsets = {}, {}
+    for key in keys:
+        if key == '_id':
+            continue
+        if key in new:
+            if key not in old or old[key] != new[key]:
+                sets[key] = new[key]
+        elif key in old:
+            unsets[key] = 1
+    update = {}
+    if sets:
+        update['$set'] = sets
+    if unsets:
+        update['$unset'] = unsets
+    return update
 
 def flush():
     """Flush the iris database.  You should probably only do this if you're
     testing things."""
     db = get_database()
     db.drop_collection('photos')
+    bump_generation(db.photos)
+
+# write generations by collection name, bumped after every write through a
+# BulkInserter or Model.save;  cached counts are only good for the
+# generation they were counted in.  They're kept in the database's 'meta'
+# collection too, so that a process sees the writes of others (a shell
+# running next to `iris watch`, say)
+_generations = {}
+_generations_lock = threading.Lock()
+
+def bump_generation(collection):
+    """Note that collection has been written to."""
+    with _generations_lock:
+        _generations[collection.full_name] = _generations.get(collection.full_name, 0) + 1
+    database = getattr(collection, 'database', None)
+    if database is not None:
+        database.meta.update({'_id': 'writes'}, {'$inc': {collection.name.replace('.', '_'): 1}},
+            upsert=True)
+
+def write_generation(collection):
+    """The writes noted for collection so far, by this process and by every
+    process (as far as the database knows)."""
+    local = _generations.get(collection.full_name, 0)
+    database = getattr(collection, 'database', None)
+    if database is None:
+        return local
+    name = collection.name.replace('.', '_')
+    stored = database.meta.find_one({'_id': 'writes'}, [name]) or {}
+    return local, stored.get(name, 0)
+
+def _normalize(value):
+    """A hashable version of a spec that's the same whatever order its keys
+    are in."""
+    if isinstance(value, dict):
+        return tuple(sorted([(k, _normalize(v)) for k, v in value.iteritems()]))
+    if isinstance(value, (list, tuple)):
+        return tuple([_normalize(v) for v in value])
+    return value
+
+class BatchController(object):
+    """Picks BulkInserter thresholds so that flushes take about `target`
+    seconds.  It keeps a smoothed cost per document, but it starts from
+    `initial` and grows by at most double per flush, so a couple of quick
+    flushes don't send a huge batch to a struggling server.
+    A fixed round trip cost makes small batches look expensive per document,
+    which pushes the size up until flushes are worth their overhead."""
+    def __init__(self, initial=100, target=0.5, minimum=10, maximum=10000, smoothing=0.3):
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+        self.smoothing = smoothing
+        self.per_item = None
+        self._size = initial
+
+    def observe(self, elapsed, count):
+        """Record that a flush of count documents took elapsed seconds."""
+        if not count:
+            return
+        per_item = elapsed / count
+        if self.per_item is None:
+            self.per_item = per_item
+        else:
+            self.per_item += self.smoothing * (per_item - self.per_item)
+        ideal = self.target / self.per_item if self.per_item else self.maximum
+        self._size = max(self.minimum, min(self.maximum, ideal, self._size * 2))
+
+    @property
+    def size(self):
+        return int(self._size)
 
 class BulkInserter(object):
     """A caching updater for mongo documents going into the same collection.
     You can choose a threshold, and add documents to it, and they will be
-    flushed after the threshold number of documents have been reached."""
-    def __init__(self, collection, threshold=100, unique_attr=None):
+    flushed after the threshold number of documents have been reached.  If
+    on_flush is given, it's called with the list of documents written after
+    every flush.  Flushes are timed in the 'flush' stage of stats.
+
+    Documents are also flushed once their encoded size (estimated from a
+    sample of them, see SIZE_SAMPLE) reaches max_bytes, or once the oldest of them has waited max_linger seconds, if those are
+    set.  Without a background writer, linger is only checked on insert.  If
+    a controller (eg. a `BatchController`) is given, its size is used as the
+    threshold, and it's told how long each flush took.
+
+    If diff_updates is True, documents that already exist are compared with
+    their stored versions and only the fields that differ are written, with
+    $set and $unset;  unchanged documents aren't written at all.  Only each
+    document's own keys and diff_keys are fetched and compared, so stored
+    fields outside those are left alone, and diff_keys a document doesn't
+    have are unset.  `Model`s that track their changes aren't even looked
+    up.
+
+    If background is True, full buffers are handed off to a writer thread
+    and a fresh buffer is started, so inserting doesn't wait on the
+    database.  Inserting only blocks once max_pending batches are waiting
+    to be written.  `flush` still waits until everything has been written,
+    errors from the writer are raised by the next `insert` or `flush`, and
+    `close` should be called when you're done."""
+    def __init__(self, collection, threshold=100, unique_attr=None, on_flush=None, stats=None,
+            background=False, max_pending=2, max_bytes=None, max_linger=None, controller=None,
+            diff_updates=False, diff_keys=()):
         # this has to be reentrant so we can protect flushes
         self.collection = collection
         self.unique_attr = unique_attr
+        self.on_flush = on_flush
+        self.stats = stats or metrics.NULL
         self.threshold = threshold
+        self.background = background
+        self.max_bytes = max_bytes
+        self.max_linger = max_linger
+        self.controller = controller
+        self.diff_updates = diff_updates
+        self.diff_keys = set(diff_keys)
         self.total = 0
+        self.bytes = 0
+        self._oldest = None
+        # documents seen, and the number and total size of those measured
+        self._sized, self._measured, self._measured_bytes = 0, 0, 0
         self.documents = {
             'updates' : [],
             'inserts' : [],
+            'diffs' : [],
         }
         self._inserts = 0
         self._updates = 0
+        self._unchanged = 0
         self.lock = threading.RLock()
+        self._batches = None
+        self._slots = threading.Semaphore(max_pending)
+        self._error = None
 
     def insert(self, *documents):
         """Add one or more documents to be updated whenever the threshold is met.
         If the document has an '_id', it's considered an update.  If it doesn't,
         it's considered an insert.  If the document has a '_unique_attr'
-        attribute, it's used later to check if it is actually an insert or an
-        update.  This method is thread safe."""
+        key (or a Model attribute), it's used instead of unique_attr to check
+        if it is actually an insert or an update, and isn't stored.  This
+        method is thread safe."""
         self.lock.acquire()
-        for document in documents:
-            document = dict(document)
-            if '_id' in document:
-                self.documents['updates'].append(document)
-            else:
-                self.documents['inserts'].append(document)
-            self.total += 1
-            if self.total >= self.threshold:
-                self.flush(False)
-        self.lock.release()
+        try:
+            self._raise_error()
+            for document in documents:
+                changes = None
+                if self.diff_updates and isinstance(document, Model):
+                    changes = document.changes()
+                    document.mark_clean()
+                # not getattr:  a Model's is None for anything it doesn't have
+                document = dict(document)
+                unique = document.pop('_unique_attr', self.unique_attr)
+                if changes is not None and '_id' in document:
+                    self.documents['diffs'].append(({'_id': document['_id']}, changes, document))
+                elif '_id' in document:
+                    self.documents['updates'].append(document)
+                else:
+                    self.documents['inserts'].append((unique, document))
+                if not self.total:
+                    self._oldest = time.time()
+                    if self.background and self.max_linger and self._batches is None:
+                        # the writer is what notices documents lingering
+                        self._start_writer()
+                self.total += 1
+                if self.max_bytes:
+                    self.bytes += self._size(document)
+                if self._full():
+                    self.flush(False)
+        finally:
+            self.lock.release()
+
+    def _size(self, document):
+        """The encoded size of a document, or of one in SIZE_SAMPLE anyway;
+        the others are taken to be the average of those."""
+        self._sized += 1
+        if self._sized % SIZE_SAMPLE == 1 or SIZE_SAMPLE == 1:
+            self._measured += 1
+            self._measured_bytes += len(bson.BSON.encode(document))
+        return self._measured_bytes // self._measured
+
+    def _full(self):
+        """True if the buffer has hit any of its limits."""
+        if not self.total:
+            return False
+        limit = self.controller.size if self.controller else self.threshold
+        if self.total >= limit:
+            return True
+        if self.max_bytes and self.bytes >= self.max_bytes:
+            return True
+        return bool(self.max_linger and time.time() - self._oldest >= self.max_linger)
 
     def flush(self, force=True):
         """Flush all of the documents with as few queries as possible.  If
         force is False (default), documents are only saved if they meet the
-        threshold.  This method is thread safe."""
+        threshold (or another limit).  If force is True, this waits for documents handed to
+        the background writer to be written too.  This method is thread
+        safe."""
+        self.lock.acquire()
+        try:
+            self._raise_error()
+            if not force and not self._full():
+                return
+            if not self.background:
+                self._flush()
+                return
+            if self.total:
+                if self._batches is None:
+                    self._start_writer()
+                # blocks while max_pending batches are already in flight
+                self._slots.acquire()
+                self._batches.put(self._swap())
+            if force and self._batches is not None:
+                self._batches.join()
+                self._raise_error()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Flush everything and stop the background writer, if there is one."""
+        self.flush()
         self.lock.acquire()
-        if self.total < self.threshold and not force:
+        try:
+            if self._batches is not None:
+                self._batches.put(None)
+                self._writer.join()
+                self._batches = self._writer = None
+        finally:
             self.lock.release()
+
+    def _start_writer(self):
+        self._batches = Queue.Queue()
+        self._writer = threading.Thread(target=self._write_batches)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _write_batches(self):
+        """The background writer's loop;  writes batches until it gets None.
+        Once a write fails, the batches after it are dropped until the error
+        has been raised.  While it's idle, it flushes documents that have
+        lingered for too long."""
+        while True:
+            try:
+                batch = self._batches.get(True, self.max_linger or 86400)
+            except Queue.Empty:
+                self._flush_lingering()
+                continue
+            try:
+                if batch is None:
+                    return
+                if self._error is None:
+                    self._write_batch(batch)
+            except Exception, e:
+                self._error = e
+            finally:
+                if batch is not None:
+                    self._slots.release()
+                self._batches.task_done()
+
+    def _flush_lingering(self):
+        """Queue the buffer to be written if it's been waiting for max_linger
+        seconds, unless an insert is busy with it.  It goes through the
+        queue like any other batch, so a forced `flush` waits for it."""
+        if not self.lock.acquire(False):
             return
-        self._flush()
-        self.lock.release()
+        try:
+            if not self.max_linger or not self._full() or not self._slots.acquire(False):
+                return
+            self._batches.put(self._swap())
+        finally:
+            self.lock.release()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _swap(self):
+        """Take the buffered documents, leaving an empty buffer in their place.
+        This method is NOT thread safe."""
+        batch = self.documents
+        self.documents = {
+            'updates' : [],
+            'inserts' : [],
+            'diffs' : [],
+        }
+        self.total = 0
+        self.bytes = 0
+        self._oldest = None
+        return batch
 
     def _flush(self):
-        """Save all documents with as few queries as possible.  Checks the
-        db for 'inserts' documents that pre-exist (based on the presence of
-        a '_unique_attr' attribute), and moves those that exist over to the
-        'updates', then bulk inserts whatever's left and saves the others one
-        at a time.  This method is NOT thread safe."""
-        updates = self.documents['updates']
-        inserts = self.documents['inserts']
+        """Save all buffered documents now.  This method is NOT thread safe."""
+        self._write_batch(self._swap())
+
+    def _write_batch(self, batch):
+        """Save a batch of documents with as few queries as possible.  'inserts'
+        with a unique attribute are upserted on it, so those that pre-exist
+        are replaced rather than duplicated.  With a pymongo that has the
+        bulk write API, this is one batch of operations;  otherwise see
+        `_write`."""
+        t0 = time.time()
+        updates, inserts = self._pending(batch)
+        diffs = batch['diffs']
+        if self.diff_updates:
+            updates, inserts, found = self._diff(updates, inserts)
+            diffs = diffs + found
+        unchanged = [d for d in diffs if not d[1]]
+        diffs = [d for d in diffs if d[1]]
+        if not updates and not inserts and not diffs:
+            inserted, updated = 0, 0
+        else:
+            try:
+                if hasattr(self.collection, 'initialize_unordered_bulk_op'):
+                    inserted, updated = self._bulk_write(updates, inserts, diffs)
+                else:
+                    inserted, updated = self._write(updates, inserts, diffs)
+            finally:
+                # even a failed write may have written some
+                bump_generation(self.collection)
+        elapsed = time.time() - t0
+        self.stats.add('flush', elapsed)
+        if self.controller:
+            self.controller.observe(elapsed, len(updates) + len(inserts) + len(diffs))
+        self._inserts += inserted
+        self._updates += updated
+        self._unchanged += len(unchanged)
+        if self.on_flush:
+            self.on_flush([d for u, d in inserts] + updates + [d for s, c, d in diffs + unchanged])
+
+    def _diff(self, updates, inserts):
+        """Look up the stored versions of updates, and of inserts with a
+        unique attribute, and turn those that exist into (spec, changes,
+        document) diffs.  Returns the updates and inserts that are left, and
+        the diffs.  Only the keys being compared are fetched."""
+        diffs = []
+        keys = set(self.diff_keys)
+        def compare(stored, document):
+            changes = diff(stored, document, self.diff_keys.union(document))
+            diffs.append(({'_id': stored['_id']}, changes, document))
+        by_id = dict([(d['_id'], d) for d in updates])
+        if by_id:
+            projection = list(keys.union(*by_id.values()))
+            for stored in self.collection.find({'_id': {'$in': by_id.keys()}}, projection):
+                compare(stored, by_id.pop(stored['_id']))
+        lookups, matched = {}, set()
+        for unique, document in inserts:
+            if unique:
+                lookups.setdefault(unique, {})[document[unique]] = document
+        for unique, values in lookups.iteritems():
+            projection = list(keys.union([unique], *values.values()))
+            for stored in self.collection.find({unique: {'$in': list(values)}}, projection):
+                document = values.pop(stored[unique], None)
+                if document is not None:
+                    matched.add(id(document))
+                    compare(stored, document)
+        inserts = [(u, d) for u, d in inserts if id(d) not in matched]
+        return by_id.values(), inserts, diffs
+
+    def _pending(self, batch):
+        """Return the updates and the (unique attr, document) inserts of a
+        batch.  If more than one insert has the same unique value, only the
+        last one is kept."""
+        inserts, seen = [], {}
+        for unique, document in batch['inserts']:
+            if unique:
+                key = (unique, document[unique])
+                if key in seen:
+                    inserts[seen[key]] = None
+                seen[key] = len(inserts)
+            inserts.append((unique, document))
+        return batch['updates'], [i for i in inserts if i is not None]
+
+    def _bulk_write(self, updates, inserts, diffs=()):
+        """Write everything in one unordered bulk operation.  Returns the
+        number of documents inserted and updated."""
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for spec, changes, document in diffs:
+            bulk.find(spec).update_one(changes)
+        for document in updates:
+            bulk.find({'_id': document['_id']}).upsert().replace_one(document)
+        for unique, document in inserts:
+            if unique:
+                bulk.find({unique: document[unique]}).upsert().replace_one(document)
+            else:
+                bulk.insert(document)
+        result = bulk.execute()
+        return result['nInserted'] + result['nUpserted'], result['nMatched']
+
+    def _write(self, updates, inserts, diffs=()):
+        """Write everything for pymongos without bulk writes.  Looks up the
+        _ids of inserts whose unique values pre-exist with one query per
+        unique attribute, bulk inserts the rest and saves the others one at
+        a time.  Returns the number of documents inserted and updated."""
         lookups = {}
-        # check all insert documents for a 'unique attr' that will allow us
-        # to search the db for possible duplicates
-        for document in inserts:
-            unique = getattr(document, '_unique_attr', self.unique_attr)
+        for unique, document in inserts:
             if unique:
                 lookups.setdefault(unique, {})[document[unique]] = document
-        # search db for duplicates based on unique attrs of insert documents
-        results = {}
-        for lookup,values in lookups.iteritems():
-            keys = [lookup]
-            if '_id' not in keys:
-                keys.append('_id')
-            spec = {lookup: {'$in' : list(values)}}
-            results[lookup] = dict([(d[lookup], d['_id']) for d in self.collection.find(spec, keys)])
-        # for each match, remove that document from inserts, add the _id from
-        # the database, and add that document to updates
-        for key in results:
-            for unique, _id in results[key].iteritems():
-                # add _id to document in inserts with unique value 'unique'
-                document = lookups[key][unique]
-                # XXX: this is O(n) but it could be O(1);  room for improvement
-                # here with potentially large docucment cache thresholds
-                inserts.remove(document)
-                document['_id'] = _id
-                updates.append(document)
-        if inserts:
-            self.collection.insert(inserts)
+        for unique, values in lookups.iteritems():
+            spec = {unique: {'$in': list(values)}}
+            for found in self.collection.find(spec, [unique, '_id']):
+                values[found[unique]]['_id'] = found['_id']
+        new = [d for u, d in inserts if '_id' not in d]
+        updates = updates + [d for u, d in inserts if '_id' in d]
+        if new:
+            self.collection.insert(new)
         for doc in updates:
             self.collection.save(doc)
-        self._clear()
-
-    def _clear(self):
-        """Clears out documents that have already been flushed.  This method
-        is NOT thread safe."""
-        self._inserts += len(self.documents['inserts'])
-        self._updates += len(self.documents['updates'])
-        self.documents.clear()
-        self.documents['updates'] = []
-        self.documents['inserts'] = []
-        self.total = 0
+        for spec, changes, document in diffs:
+            self.collection.update(spec, changes)
+        return len(new), len(updates) + len(diffs)
+
+def _lookup(document, key):
+    """Get a (possibly dotted) key from a document, or None."""
+    for part in key.split('.'):
+        try:
+            document = document[part]
+        except (KeyError, TypeError):
+            return None
+    return document
 
 class PagingCursor(object):
     """A cursor-like object that iterates through a large queryset a little at
     a time.  Meant to be used by the Pager only, its behavior is determined by
     the Pager that created it.  It is NOT thread safe to iterate a PagingCursor
-    from multiple threads, as it uses internal state to store pagination."""
+    from multiple threads, as it uses internal state to store pagination.
+
+    If every sort key is one of the pager's range_keys, pages after the first
+    are found by range on them, starting after the last document seen (with
+    _id breaking ties), rather than by skipping over everything already seen,
+    so paging through n documents is linear in n as long as the keys are
+    indexed.  A range would pass over documents where a key is missing, null
+    or of another type than the last one seen, so any other sort is paged
+    with skip."""
     def __init__(self, pager, *args, **kwargs):
         self.__dict__.update(exclude_self(locals()))
         self.collection = pager.collection
         self.threshold = pager.threshold
-        # we need a stable sort in order to page reliably
-        self._sort = kwargs.get('sort', pager.sort)
+        self.prefetch = kwargs.get('prefetch', pager.prefetch)
+        self.kwargs = dict(kwargs)
+        args = list(args)
+        self._spec = args.pop(0) if args else self.kwargs.pop('spec', None)
+        self._fields = args.pop(0) if args else self.kwargs.pop('fields', None)
+        for key in ('sort', 'skip', 'limit', 'paged', 'prefetch'):
+            self.kwargs.pop(key, None)
+        self.args = args
+        # we need a stable sort in order to page reliably, so _id always
+        # breaks ties on the other keys
+        self._sort = list(kwargs.get('sort', pager.sort))
+        if '_id' not in [key for key, direction in self._sort]:
+            self._sort.append(('_id', self._sort[-1][1] if self._sort else pymongo.DESCENDING))
+        self._ranged = all(key in pager.range_keys for key, direction in self._sort)
         # adjust for a base skip
         self._base_skip = kwargs.get('skip', 0)
         # adjust for a given limit
         self._base_limit = kwargs.get('limit', None)
         self._num_pages = 0
+        self._seen = 0
+        self._last = None
         self._page = []
 
+    def _projection(self):
+        """The fields to fetch, which have to include the sort keys, and the
+        keys that were only fetched for paging and should be dropped."""
+        fields, keys = self._fields, [key for key, direction in self._sort]
+        if fields is None:
+            return None, []
+        if isinstance(fields, dict):
+            fields = dict(fields)
+            if any(fields.values()):
+                extra = [k for k in keys if k not in fields and k != '_id']
+                fields.update([(k, 1) for k in extra])
+            else:
+                extra = [k for k in keys if k in fields]
+                for k in extra:
+                    del fields[k]
+            return fields, extra
+        extra = [k for k in keys if k not in fields and k != '_id']
+        return list(fields) + extra, extra
+
+    def _after(self):
+        """A query for the documents that sort after the last one seen."""
+        clauses = []
+        for i, (key, direction) in enumerate(self._sort):
+            clause = dict([(k, self._last[j]) for j, (k, d) in enumerate(self._sort[:i])])
+            clause[key] = {'$gt' if direction == pymongo.ASCENDING else '$lt': self._last[i]}
+            clauses.append(clause)
+        return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
     def _next_query(self):
-        skip = self._base_skip + (self._num_pages * self.threshold)
         limit = self.threshold
         if self._base_limit is not None:
-            distance = (skip - self._base_skip) + limit
-            if distance > self._base_limit:
-                limit = (self._base_skip + self._base_limit) - skip
-            if skip == (self._base_skip + self._base_limit):
+            limit = min(limit, self._base_limit - self._seen)
+            if limit <= 0:
                 self._page = []
                 return
-        assert limit >= 0
-        kwargs = dict(self.kwargs)
-        kwargs['skip'] = skip
-        kwargs['limit'] = limit
-        kwargs['sort'] = self._sort
-        self._page = list(self.collection.find(*self.args, **kwargs))
-        if self._page:
-            self._num_pages += 1
+        fields, extra = self._projection()
+        spec = self._spec or {}
+        kwargs = dict(self.kwargs, limit=limit, sort=self._sort)
+        if self._last is None:
+            kwargs['skip'] = self._base_skip + self._seen
+        elif spec:
+            spec = {'$and': [spec, self._after()]}
+        else:
+            spec = self._after()
+        self._page = list(self.collection.find(spec, fields, *self.args, **kwargs))
+        if not self._page:
+            return
+        self._num_pages += 1
+        self._seen += len(self._page)
+        if self._ranged:
+            self._last = [_lookup(self._page[-1], key) for key, direction in self._sort]
+            if None in self._last:
+                self._last = None
+        for document in self._page:
+            for key in extra:
+                if key.split('.')[0] in document:
+                    del document[key.split('.')[0]]
 
     def __iter__(self):
+        if self.prefetch:
+            for item in self._prefetching():
+                yield item
+            return
         self._next_query()
         while self._page:
             for item in self._page:
                 yield item
             self._next_query()
 
+    def _prefetching(self):
+        """Iterate with a thread fetching up to `prefetch` pages ahead.  When
+        iteration stops early, the thread is stopped (after the query it's
+        in the middle of, if any) before this returns."""
+        pages = Queue.Queue()
+        slots = threading.Semaphore(self.prefetch)
+        cancelled = threading.Event()
+        def fetch():
+            page = True
+            while page:
+                slots.acquire()
+                if cancelled.is_set():
+                    return
+                try:
+                    self._next_query()
+                    page = self._page
+                except Exception:
+                    page = sys.exc_info()
+                    pages.put(page)
+                    return
+                pages.put(page)
+        thread = threading.Thread(target=fetch, name='iris-prefetch')
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                page = pages.get()
+                slots.release()
+                if isinstance(page, tuple):
+                    raise page[0], page[1], page[2]
+                if not page:
+                    break
+                for item in page:
+                    yield item
+        finally:
+            cancelled.set()
+            slots.release()
+            thread.join()
+
 class Pager(object):
     """A class that can perform simple 'finds' against a database and present
     one iterate over all results even though only a maximum of `threshold`
-    (default: 100) are ever loaded at one time."""
-    def __init__(self, collection, sort=None, threshold=100):
+    (default: 100) are ever loaded at one time.  With a prefetch depth, a
+    thread loads up to that many pages ahead while the current one is being
+    used, so at most (prefetch + 1) * threshold are.  range_keys are the keys
+    that every document has, with values of a single type, which makes them
+    safe to page on by range (see `PagingCursor`)."""
+    def __init__(self, collection, sort=None, threshold=100, prefetch=0, range_keys=('_id',)):
         self.collection = collection
         self.threshold = threshold
+        self.prefetch = prefetch
+        self.range_keys = range_keys
         self.sort = sort or [('_id', pymongo.DESCENDING)]
 
     def find(self, *args, **kwargs):
         return PagingCursor(self, *args, **kwargs)
 
+# model -> (the document as it was loaded or last saved, keys set since);
+# this can't live on the models, whose __dict__ is the document itself
+_loaded = weakref.WeakKeyDictionary()
+
 class Model(OpenStruct):
     """A base model for whatever types of data we need to save.  For now this
-    is just photos, but we might have some more application data to save."""
+    is just photos, but we might have some more application data to save.
+
+    Models built from a document with an _id (and those found through a
+    `Manager`) remember which attributes are set or deleted afterwards, so
+    `save` only writes what changed.  Changes inside a value (eg. one key of
+    'exif') aren't noticed;  assign the whole value again."""
+    def __init__(self, *d, **dd):
+        OpenStruct.__init__(self, *d, **dd)
+        if '_id' in self.__dict__:
+            self.mark_clean()
+
+    def __setattr__(self, attr, value):
+        self.__dict__[attr] = value
+        self._touch(attr)
+
+    def __setitem__(self, item, value):
+        self.__dict__[item] = value
+        self._touch(item)
+
+    def __delitem__(self, item):
+        if item in self.__dict__:
+            del self.__dict__[item]
+            self._touch(item)
+
+    __delattr__ = __delitem__
+
+    def update(self, d):
+        self.__dict__.update(d)
+        for key in d:
+            self._touch(key)
+
+    def _touch(self, key):
+        state = _loaded.get(self)
+        if state is not None:
+            state[1].add(key)
+
+    def mark_clean(self):
+        """Take the model as being exactly what's stored in the database."""
+        _loaded[self] = (dict(self.__dict__), set())
+
+    def changes(self):
+        """The $set/$unset update for what has changed since the model was
+        loaded or saved, {} if nothing has, or None if it isn't tracked."""
+        state = _loaded.get(self)
+        if state is None:
+            return None
+        document, touched = state
+        return diff(document, self.__dict__, touched)
+
     def save(self):
-        import bson
+        """Save the model;  if it's tracked, only changed fields are written,
+        and nothing is written if none changed."""
         db = get_database()
         collection_name = getattr(self, '_collection', None)
         collection = db[collection_name]
+        changes = self.changes()
         try:
-            collection.save(self.__dict__)
+            if changes is None or '_id' not in self.__dict__:
+                collection.save(self.__dict__)
+                bump_generation(collection)
+            elif changes:
+                collection.update({'_id': self._id}, changes)
+                bump_generation(collection)
         except bson.errors.InvalidDocument:
             import traceback
             tb = traceback.format_exc()
             import ipdb; ipdb.set_trace();
+        self.mark_clean()
+
+class ModelCursor(object):
+    """Wraps a cursor (or a `PagingCursor`) of models.  pymongo builds them
+    up an item at a time, which looks like a lot of changes, so each one is
+    marked clean on its way out.  Everything else is passed through to the
+    cursor."""
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __iter__(self):
+        for document in self.cursor:
+            yield _clean(document)
+
+    def next(self):
+        return _clean(self.cursor.next())
+
+    def __getitem__(self, index):
+        result = self.cursor[index]
+        if result is self.cursor:
+            return self
+        return _clean(result)
+
+    def __getattr__(self, attr):
+        value = getattr(self.cursor, attr)
+        if not callable(value):
+            return value
+        def method(*args, **kwargs):
+            result = value(*args, **kwargs)
+            # keep chained calls (sort, limit, skip...) wrapped
+            return self if result is self.cursor else result
+        return method
+
+def _clean(document):
+    if isinstance(document, Model):
+        document.mark_clean()
+    return document
 
 class Manager(object):
     """A thin wrapper around a generic mongo collection cursor that auto-applies
     our class and """
+    # how many counts are cached, and for how long:  writes by other
+    # processes don't bump this one's write generations
+    count_cache_size = 256
+    count_max_age = 10
+
     def __init__(self, cls):
         self.cls = cls
+        self._counts = {}
         try:
             self.collection = get_database()[cls._collection]
         except:
@@ -227,21 +925,188 @@ class Manager(object):
         if 'as_class' not in kwargs:
             kwargs['as_class'] = self.cls
         if 'paged' in kwargs:
-            pager = Pager(self.collection, threshold=kwargs['paged'])
-            return pager.find(*args, **kwargs)
-        return self.collection.find(*args, **kwargs)
+            pager = Pager(self.collection, threshold=kwargs['paged'],
+                range_keys=getattr(self.cls, 'range_keys', ('_id',)))
+            return ModelCursor(pager.find(*args, **kwargs))
+        kwargs.pop('prefetch', None)
+        return ModelCursor(self.collection.find(*args, **kwargs))
+
+    def find_one(self, *args, **kwargs):
+        self._init()
+        return self.collection.find_one(*args, **kwargs)
+
+    def count(self, spec=None, hint=None):
+        """Count the documents matching spec on the server, using the index
+        hint if it's given.  Counts are cached by spec until the collection
+        is next written to (see `bump_generation`), or for count_max_age
+        seconds at most."""
+        self._init()
+        key = (_normalize(spec or {}), _normalize(hint))
+        generation = write_generation(self.collection)
+        cached = self._counts.get(key)
+        if cached and cached[0] == generation and time.time() - cached[1] < self.count_max_age:
+            return cached[2]
+        if not spec:
+            count = self.collection.count()
+        else:
+            cursor = self.collection.find(spec, ['_id'])
+            if hint:
+                cursor = cursor.hint(hint)
+            count = cursor.count()
+        if len(self._counts) >= self.count_cache_size:
+            self._counts.clear()
+        self._counts[key] = (generation, time.time(), count)
+        return count
+
+    def fingerprints(self, paths):
+        """Look up the stored fingerprints for a batch of paths in one query.
+        Returns a dictionary of path -> fingerprint for those paths that are
+        already in the database."""
+        self._init()
+        spec = {'path': {'$in': list(paths)}}
+        cursor = self.collection.find(spec, ['path', 'fingerprint'])
+        return dict([(d['path'], d.get('fingerprint')) for d in cursor])
+
+    def duplicates(self, field='hash'):
+        """Group photos that share a value for field, which should be 'hash'
+        or 'quickhash'.  Returns a list of documents with the shared value as
+        '_id', and the 'count' and 'paths' of the photos in the group, most
+        duplicated first.  This is a single aggregation over the index on
+        field rather than a comparison of every photo with every other."""
+        self._init()
+        pipeline = [
+            {'$match': {field: {'$exists': True}}},
+            {'$sort': {field: 1}},
+            {'$group': {'_id': '$' + field, 'count': {'$sum': 1}, 'paths': {'$push': '$path'}}},
+            {'$match': {'count': {'$gt': 1}}},
+            {'$sort': {'count': -1}},
+        ]
+        return list(aggregate(self.collection, pipeline))
+
+    def group(self, keys, spec=None, width=None, order='count', server=True):
+        """Count the documents matching spec by their values for keys, which
+        can be fields or `iris.fields.PERIODS`.  With width, numbers are put
+        in buckets that wide, as for a histogram.  Returns an iterator of
+        rows:  a tuple of the values of the keys, then the count, ordered as
+        for `group_pipeline`.  This is an aggregation on the server;  where
+        there is none (mongo before 2.2, or server=False), just the fields
+        the keys need are fetched and counted here."""
+        self._init()
+        if server and hasattr(self.collection, 'aggregate'):
+            try:
+                documents = aggregate(self.collection, group_pipeline(keys, spec, width, order))
+            except pymongo.errors.OperationFailure, e:
+                if 'no such' not in str(e) and 'unrecognized' not in str(e):
+                    raise
+            else:
+                return _group_rows(keys, documents)
+        return self._group_here(keys, spec, width, order)
+
+    def _group_here(self, keys, spec, width, order):
+        needed = set(['date' if k in fields.PERIODS else k for k in keys])
+        cursor = self.collection.find(group_spec(keys, spec, width), list(needed))
+        counts = {}
+        for document in cursor:
+            values = tuple([_group_value(document, key, width) for key in keys])
+            counts[values] = counts.get(values, 0) + 1
+        if order == 'count':
+            rows = sorted(counts.iteritems(), key=lambda row: (-row[1], row[0]))
+        else:
+            rows = sorted(counts.iteritems())
+        documents = [{'_id': dict(zip(keys, values)), 'count': count} for values, count in rows]
+        return _group_rows(keys, documents)
+
+    def similar(self, value, distance=6):
+        """Find photos whose perceptual hash is within distance bits of value.
+        Candidates are found through the index on 'phash_bands' (see
+        `iris.loaders.phash`), so this doesn't scan every stored hash.
+        Returns a list of (distance, photo) tuples, nearest first."""
+        self._init()
+        spec = {'phash_bands': {'$in': phash.neighbour_bands(value, distance)}}
+        matches = []
+        for document in self.collection.find(spec, ['path', 'phash']):
+            d = phash.hamming(value, document['phash'])
+            if d <= distance:
+                matches.append((d, self.cls(document)))
+        matches.sort(key=lambda m: (m[0], m[1].path))
+        return matches
+
+def _group_rows(keys, documents):
+    """Turn grouped documents into (value, ..., count) rows, with periods
+    labelled."""
+    for document in documents:
+        values = [document['_id'].get(key) for key in keys]
+        for i, key in enumerate(keys):
+            if key in fields.PERIODS:
+                values[i] = fields.period_label(key, values[i])
+        yield tuple(values) + (document['count'],)
 
 class Photo(Model):
     _collection = 'photos'
 
-    def load_file(self, path):
+    # the metadata keys (or key prefixes) photos keep;  None keeps them all
+    metadata_keys = None
+    # projections for listing photos, which shouldn't drag whole exif trees
+    # over the wire:  just the paths, and what a one line summary shows
+    path_fields = ('path',)
+    summary_fields = ('path', 'moved', 'tags', 'x', 'y', 'size')
+    # what `load_file` sets, or leaves out when the file doesn't have it;  a
+    # photo read again loses those it no longer has (and 'moved')
+    loaded_fields = ('x', 'y', 'exif', 'iptc', 'tags', 'path', 'caption', 'date', 'keywords',
+        'size', 'fingerprint', 'phash', 'phash_bands', 'moved') + tuple(fields.NAMES)
+    # keys every photo has, as a string, which finds can page on by range
+    range_keys = ('_id', 'path')
+
+    def load_file(self, path, stat=None, keys=None, stats=None):
+        """Load the photo at path.  If `stat` is given, it should be the result
+        of an `os.stat` taken before the file was read;  it is used for the
+        size and fingerprint instead of stat'ing the file again.  `keys`
+        restricts the exif and iptc keys that are read and stored, and
+        defaults to `metadata_keys`.  Reading, serializing and hashing the
+        thumbnail are timed in `stats` if it's given."""
+        stats = stats or metrics.NULL
         path = os.path.realpath(path)
-        meta = file.MetaData(path)
+        if stat is None:
+            stat = os.stat(path)
+        if keys is None:
+            keys = self.metadata_keys
+        # pyexiv2 is slow to import, and only needed here
+        from iris.loaders import file
+        with stats.timer('read'):
+            meta = file.MetaData(path, keys=keys)
         copykeys = ('x', 'y', 'exif', 'iptc', 'tags', 'path', 'caption')
-        d = dict([(k,v) for k,v in meta.__dict__.iteritems() if k in copykeys])
-        self.__dict__.update(d)
-        stat = os.stat(meta.path)
+        with stats.timer('serialize'):
+            for key in copykeys:
+                self[key] = getattr(meta, key)
+            typed = fields.extract(meta)
+            self.update(typed)
+            self.date = typed.get('taken_at') or datetime.datetime.fromtimestamp(int(stat.st_mtime))
+            self.keywords = fields.keywords(self)
         self.size = stat.st_size
+        self.fingerprint = fingerprint(stat)
+        with stats.timer('phash'):
+            thumbnail = meta.thumbnail
+            value = phash.dhash(thumbnail) if thumbnail else None
+        if value is not None:
+            self.phash = phash.to_signed(value)
+            self.phash_bands = phash.bands(value)
+
+    def save(self):
+        """Save the photo, with its keywords brought up to date with its
+        tags and caption."""
+        keywords = fields.keywords(self)
+        if keywords != self.get('keywords'):
+            self.keywords = keywords
+        Model.save(self)
+
+    def load_hash(self, quick=False):
+        """Hash the contents of this photo's file.  The full hash is stored in
+        'hash';  a quick hash of the first QUICK_HASH_BYTES and the size is
+        stored in 'quickhash' instead if quick is True."""
+        if quick:
+            self.quickhash = utils.hash_file(self.path, prefix=QUICK_HASH_BYTES)
+        else:
+            self.hash = utils.hash_file(self.path)
 
     def __repr__(self):
         return '<iris.backend.Photo "%s">' % (self.path or self._id or '(at 0x%08X)' % id(self))
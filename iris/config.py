@@ -49,3 +49,10 @@ class IrisConfig(object):
         try: return int(self.config.get('db', 'port'))
         except: return None
 
+    @property
+    def roots(self):
+        """Directories `iris watch` watches by default;  set 'roots' in the
+        [iris] section to a list of paths separated by ':'."""
+        try: return [r for r in self.config.get('iris', 'roots').split(os.pathsep) if r]
+        except: return []
+
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Typed query fields.
+
+Exif values are stored the way `exiv_serialize` formats them, which is
+good for reading but not for querying:  shutter speeds are strings like
+"1/250", apertures strings like "2.8", and the camera is buried under
+'exif.Image'.  So a few of them are also stored at the top level of every
+photo as plain numbers, strings and datetimes, and indexed:
+
+    iso             int         Exif.Photo.ISOSpeedRatings
+    shutter         float       exposure time in seconds
+    fstop           float       Exif.Photo.FNumber (or ApertureValue)
+    focal_length    float       in mm
+    camera          string      make and model, eg. "Canon EOS 5D"
+    lens            string      Exif.Photo.LensModel
+    taken_at        datetime    Exif.Photo.DateTimeOriginal
+
+Photos stored before a field was are given it by `backend.backfill`, which
+`extract`s it from their stored exif through `StoredMeta`.
+
+Every photo also gets a `date`, which is `taken_at` or, for photos without
+one, the file's modification time.  It has its own (descending) index, and
+is what time range queries are meant to use:
+
+    find where date between "2011-05-06" and "2011-05-08"
+    count where date after "yesterday"
+
+`date_range` turns the values of those into the span of time they mean.
+`group by` and `histogram` statements can also use the PERIODS year,
+month and day of the date, as if they were fields.
+
+The words of the tags, caption, camera and lens go into `keywords`, along
+with their prefixes, lower cased.  That's indexed, so `caption == "par"`
+looks up photos with a word starting with "par" before matching the
+caption itself against ".*par.*".
+
+`ALIASES` gives other names queries can use for them, and `query_value`
+turns query values into the right type, so `find where shutter <= 1/250`
+and `find where aperture = "5.6"` compare numbers."""
+
+import re
+import math
+import datetime
+
+def _first(value):
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+def to_float(value):
+    """A float from a number, a fraction (Fraction or pyexiv2's Rational) or
+    a "num/denom" string, or None."""
+    value = _first(value)
+    if value is None or isinstance(value, bool):
+        return None
+    if hasattr(value, 'numerator') and hasattr(value, 'denominator'):
+        if not value.denominator:
+            return None
+        return float(value.numerator) / value.denominator
+    if isinstance(value, basestring):
+        if '/' in value:
+            numerator, denominator = value.split('/', 1)
+            try: return float(numerator) / float(denominator)
+            except (ValueError, ZeroDivisionError): return None
+        try: return float(value)
+        except ValueError: return None
+    try: return float(value)
+    except (TypeError, ValueError): return None
+
+def to_int(value):
+    value = to_float(value)
+    return int(round(value)) if value is not None else None
+
+def to_string(value):
+    value = _first(value)
+    if not isinstance(value, basestring):
+        return None
+    value = value.strip().strip('\x00').strip()
+    return value or None
+
+_datetime_formats = ('%Y:%m:%d %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+    '%Y:%m:%d', '%Y-%m-%d')
+
+def to_datetime(value):
+    """A naive datetime from a datetime, a date, or an exif or iso string."""
+    value = _first(value)
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    if isinstance(value, basestring):
+        for format in _datetime_formats:
+            try: return datetime.datetime.strptime(value.strip(), format)
+            except ValueError: pass
+    return None
+
+def _apex_shutter(value):
+    value = to_float(value)
+    return 2 ** -value if value is not None else None
+
+def _apex_aperture(value):
+    value = to_float(value)
+    return math.sqrt(2) ** value if value is not None else None
+
+def _camera(meta):
+    make, model = to_string(meta.raw('Exif.Image.Make')), to_string(meta.raw('Exif.Image.Model'))
+    if make and model and not model.lower().startswith(make.split()[0].lower()):
+        return '%s %s' % (make, model)
+    return model or make
+
+# name -> (type conversion, [(exif key, conversion)...] in order of preference)
+FIELDS = {
+    'iso': (to_int, [('Exif.Photo.ISOSpeedRatings', to_int)]),
+    'shutter': (to_float, [('Exif.Photo.ExposureTime', to_float),
+                           ('Exif.Photo.ShutterSpeedValue', _apex_shutter)]),
+    'fstop': (to_float, [('Exif.Photo.FNumber', to_float),
+                         ('Exif.Photo.ApertureValue', _apex_aperture)]),
+    'focal_length': (to_float, [('Exif.Photo.FocalLength', to_float)]),
+    'camera': (to_string, []),
+    'date': (to_datetime, []),
+    'lens': (to_string, [('Exif.Photo.LensModel', to_string)]),
+    'taken_at': (to_datetime, [('Exif.Photo.DateTimeOriginal', to_datetime),
+                               ('Exif.Photo.DateTimeDigitized', to_datetime),
+                               ('Exif.Image.DateTime', to_datetime)]),
+}
+# the fields that aren't just read from one of a list of keys;  'date' is
+# set by the backend, since it needs the file as well
+_extractors = {'camera': _camera}
+
+NAMES = ['iso', 'shutter', 'fstop', 'focal_length', 'camera', 'lens', 'taken_at']
+
+ALIASES = {
+    'aperture': 'fstop',
+    'f': 'fstop',
+    'exposure': 'shutter',
+    'speed': 'shutter',
+    'focal': 'focal_length',
+    'focallength': 'focal_length',
+    'model': 'camera',
+    'taken': 'taken_at',
+}
+
+# fields compared as spans of time by the date operators
+DATES = ('date', 'taken_at')
+
+# pseudo fields for the period a photo's date is in;  they're numbers like
+# 2011, 201105 and 20110506, so they sort, and `period_label` formats them
+PERIODS = ('year', 'month', 'day')
+
+def period(name, date):
+    """The number for the period name of a datetime, or None."""
+    if not isinstance(date, datetime.date):
+        return None
+    value = 0
+    for part in (date.year, date.month, date.day)[:PERIODS.index(name) + 1]:
+        value = value * 100 + part
+    return value
+
+def period_label(name, value):
+    """A period's number as "2011", "2011-05" or "2011-05-06"."""
+    if value is None:
+        return None
+    value = int(value)
+    parts = []
+    for i in range(PERIODS.index(name)):
+        value, part = divmod(value, 100)
+        parts.insert(0, '%02d' % part)
+    return '-'.join(['%d' % value] + parts)
+
+_one_second = datetime.timedelta(seconds=1)
+_one_day = datetime.timedelta(days=1)
+
+def date_range(value):
+    """The (start, end) of the time a query value means, end exclusive:  a
+    timestamp is that second, a date that day, "2011-05" and "2011" the
+    month and year, and "today" and "yesterday" what they say.  Returns
+    None for values that aren't any of those."""
+    if isinstance(value, basestring):
+        word = value.strip().lower()
+        if word in ('today', 'yesterday'):
+            start = datetime.datetime.combine(datetime.date.today(), datetime.time())
+            if word == 'yesterday':
+                start -= _one_day
+            return start, start + _one_day
+        for format in ('%Y-%m', '%Y:%m', '%Y'):
+            try: start = datetime.datetime.strptime(word, format)
+            except ValueError: continue
+            if format == '%Y':
+                return start, start.replace(year=start.year + 1)
+            if start.month == 12:
+                return start, start.replace(year=start.year + 1, month=1)
+            return start, start.replace(month=start.month + 1)
+        start = to_datetime(word)
+        if start is not None and len(word) <= len('yyyy-mm-dd'):
+            return start, start + _one_day
+    else:
+        start = to_datetime(value)
+    if start is None:
+        return None
+    return start, start + _one_second
+
+def extract(meta):
+    """The typed fields of a `MetaData`, as a dictionary;  fields the photo
+    doesn't have are left out."""
+    fields = {}
+    for name in NAMES:
+        if name in _extractors:
+            value = _extractors[name](meta)
+        else:
+            value = None
+            for key, convert in FIELDS[name][1]:
+                value = convert(meta.raw(key))
+                if value is not None:
+                    break
+        if value is not None:
+            fields[name] = value
+    return fields
+
+class StoredMeta(object):
+    """The `raw` values of a stored photo's exif and iptc, to `extract` the
+    fields of photos stored before they were from.  They've been through
+    `exiv_serialize`, but the conversions read those forms too."""
+    def __init__(self, document):
+        self.document = document
+
+    def raw(self, key, default=None):
+        parts = key.split('.')
+        value = self.document.get(parts[0].lower())
+        for part in parts[1:]:
+            if not isinstance(value, dict) or part not in value:
+                return default
+            value = value[part]
+        return value
+
+def resolve(name):
+    """The stored field a query field name refers to."""
+    lowered = name.lower()
+    if lowered in FIELDS:
+        return lowered
+    return ALIASES.get(lowered, name)
+
+def query_value(name, value):
+    """Convert a value from a query on the stored field name to the type
+    that's stored;  lists are converted item by item.  Values that can't be
+    converted are left alone."""
+    if name not in FIELDS:
+        return value
+    if isinstance(value, list):
+        return [query_value(name, v) for v in value]
+    converted = FIELDS[name][0](value)
+    return value if converted is None else converted
+
+# the fields whose words are keywords, and the shortest and longest prefix
+# of each word that's stored;  longer words are looked up by their prefix
+KEYWORD_FIELDS = ('tags', 'caption', 'camera', 'lens')
+KEYWORD_PREFIXES = (2, 12)
+
+_word = re.compile(r'\w+', re.U)
+
+def words(value):
+    """The lower cased words in a string or a list of strings."""
+    if isinstance(value, basestring):
+        return _word.findall(value.lower())
+    if isinstance(value, (list, tuple)):
+        return [w for v in value for w in words(v)]
+    return []
+
+def keywords(document):
+    """The sorted keywords of a document:  every prefix, from the shortest
+    to the longest stored, of the words in its KEYWORD_FIELDS."""
+    shortest, longest = KEYWORD_PREFIXES
+    found = set()
+    for field in KEYWORD_FIELDS:
+        for word in words(document.get(field)):
+            for end in range(shortest, min(len(word), longest) + 1):
+                found.add(word[:end])
+    return sorted(found)
+
+def keyword_query(value):
+    """The keywords every photo matching a substring query has to have, at
+    least if it matches at the start of a word.  Words too short to have
+    been stored are left out."""
+    shortest, longest = KEYWORD_PREFIXES
+    found = []
+    for word in words(value):
+        if len(word) >= shortest and word[:longest] not in found:
+            found.append(word[:longest])
+    return found
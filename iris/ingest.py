@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Streaming ingest pipeline for iris.
+
+Paths flow from a walker through a bounded work queue to a set of extractor
+processes, and the documents they produce are batched into the database by a
+single writer.  Only a bounded number of paths and documents are in flight at
+any time, so memory use does not grow with the size of the tree being added
+and the first inserts happen as soon as the first files have been read.
+
+If the pipeline is given a `journal.Journal`, every batch the writer flushes
+is recorded in it, along with the files that could not be read, so that an
+interrupted run can be resumed.
+
+Every stage is timed into the pipeline's `metrics.Stats`:  'walk' (per batch
+of paths), 'lookup', 'stat', 'read', 'serialize', 'phash', 'hash' and
+'flush'.  Extractor processes send what they've recorded back with their
+results every STATS_INTERVAL seconds."""
+
+import os
+import sys
+import time
+import threading
+import multiprocessing
+
+from iris import backend, utils, metrics
+
+# sentinel put on the queues to signal that a stage has finished
+DONE = None
+# how often extractor processes send their stats back, in seconds
+STATS_INTERVAL = 1.0
+# what `_extract` gives for a file that isn't an image iris can read, which
+# is remembered, as opposed to None for one that couldn't be read this time;
+# it's a string so that it survives the trip back from an extractor
+NOT_AN_IMAGE = 'not an image'
+
+def extract(path, stat, hashing=None, stats=None):
+    """Read the photo at path and return its document, or None if the file
+    is not an image we understand.  If hashing is 'full' or 'quick', the
+    contents of the file are hashed as well (see `Photo.load_hash`)."""
+    from iris.loaders.file import UnknownImageTypeException
+    from iris.loaders.header import UnsupportedFormat
+    stats = stats or metrics.NULL
+    photo = backend.Photo()
+    try:
+        photo.load_file(path, stat, stats=stats)
+    except (UnknownImageTypeException, UnsupportedFormat):
+        return None
+    if hashing:
+        with stats.timer('hash'):
+            photo.load_hash(quick=(hashing == 'quick'))
+    return photo.__dict__
+
+def _extract(path, stat, hashing=None, stats=None):
+    """`extract`, but NOT_AN_IMAGE for a file that isn't an image, and None
+    for one that can't be read for any other reason (it's vanished, can't be
+    opened, ...), so one bad file fails on its own rather than taking the
+    run down with it."""
+    try:
+        document = extract(path, stat, hashing, stats)
+    except Exception, e:
+        print >>sys.stderr, 'iris: %s: %s' % (path, e)
+        return None
+    return NOT_AN_IMAGE if document is None else document
+
+def _extractor(work, results, hashing):
+    """Extractor worker loop;  runs in its own process until it gets DONE.
+    DONE is always sent back, since the writer waits for it."""
+    stats, sent = metrics.Stats(), time.time()
+    try:
+        for path, stat, known in iter(work.get, DONE):
+            results.put((path, known, backend.fingerprint(stat), _extract(path, stat, hashing, stats)))
+            if time.time() - sent >= STATS_INTERVAL:
+                results.put(stats.drain())
+                sent = time.time()
+        results.put(stats.drain())
+    finally:
+        results.put(DONE)
+
+class Pipeline(object):
+    """A staged ingest pipeline.  A walker feeds candidate paths to `workers`
+    extractor processes through a bounded queue, and a writer batches their
+    results into the photos collection.  If workers is 0, every stage runs
+    in-process, one file at a time.  Files are content hashed by the
+    extractors if hashing is 'full' or 'quick'.  If journal is given, paths
+    are recorded in it as they're written, and paths it has already finished
+    with (or found weren't images, and which haven't changed since) are
+    skipped;  files that couldn't be read for other reasons are tried again.
+    Stage timings are recorded in stats (a new `metrics.Stats` by default),
+    and progress is called after every file that's written.
+
+    Documents are written in batches that start at threshold documents and
+    are sized from then on by a `backend.BatchController`, capped at
+    `backend.BATCH_BYTES` of BSON.  No document waits more than linger
+    seconds, so slow trees still show up (and get journaled) steadily."""
+    def __init__(self, workers=0, force=False, hashing=None, batch_size=500, threshold=50,
+            queue_size=None, journal=None, stats=None, progress=None, linger=5.0):
+        self.workers = workers
+        self.journal = journal
+        self.stats = stats or metrics.Stats()
+        self.progress = progress
+        self.force = force
+        self.hashing = hashing
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.linger = linger
+        self.queue_size = queue_size or max(workers, 1) * 16
+        self.counts = dict(added=0, refreshed=0, skipped=0, failed=0)
+
+    def candidates(self, paths):
+        """Walker stage.  Yields (path, stat, known) for each path that has to
+        be read, where known is True if the path is already in the database.
+        Paths are looked up a batch at a time, and those whose fingerprint is
+        unchanged are skipped unless force is set."""
+        journal, stats = self.journal, self.stats
+        batches = utils.chunked(paths, self.batch_size)
+        while True:
+            with stats.timer('walk'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            batch = [os.path.realpath(p) for p in batch]
+            if journal:
+                # paths a resumed run already wrote don't need looking up
+                pending = [p for p in batch if not journal.done(p)]
+                self.counts['skipped'] += len(batch) - len(pending)
+                batch = pending
+            with stats.timer('lookup'):
+                known = backend.Photo.objects.fingerprints(batch)
+            unchanged = []
+            for path in batch:
+                t0 = time.time()
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    self.counts['failed'] += 1
+                    continue
+                stats.add('stat', time.time() - t0)
+                fingerprint = backend.fingerprint(stat)
+                if not self.force and journal and journal.known_failure(path, fingerprint):
+                    self.counts['skipped'] += 1
+                    continue
+                if not self.force and known.get(path) == fingerprint:
+                    self.counts['skipped'] += 1
+                    unchanged.append((path, fingerprint))
+                    continue
+                yield path, stat, path in known
+            if journal:
+                journal.record(completed=unchanged)
+
+    def write(self, results):
+        """Writer stage.  Batches (path, known, fingerprint, document) results
+        into the database, which a background thread writes while the next
+        batch fills up, and returns the counts for the whole run."""
+        backend.Photo.objects._init()
+        collection = backend.Photo.objects.collection
+        failures, lock = [], threading.Lock()
+        def flushed(documents):
+            # only journal what's actually been written;  this is called
+            # from the inserter's writer thread
+            with lock:
+                failed = failures[:]
+                del failures[:]
+            if self.journal:
+                completed = [(d['path'], d['fingerprint']) for d in documents]
+                self.journal.record(completed=completed, failed=failed)
+        inserter = backend.BulkInserter(collection, unique_attr='path', on_flush=flushed,
+            stats=self.stats, background=True, max_bytes=backend.BATCH_BYTES,
+            max_linger=self.linger, controller=backend.BatchController(initial=self.threshold),
+            diff_updates=True, diff_keys=backend.Photo.loaded_fields)
+        for path, known, fingerprint, document in results:
+            if document is None:
+                # maybe readable next time, so not journaled
+                self.counts['failed'] += 1
+            elif document == NOT_AN_IMAGE:
+                self.counts['failed'] += 1
+                with lock:
+                    failures.append((path, fingerprint))
+            else:
+                inserter.insert(document)
+                self.counts['refreshed' if known else 'added'] += 1
+                self.stats.count(files=1, bytes=document['size'])
+            if self.progress:
+                self.progress()
+        inserter.close()
+        # failures since the last batch was written
+        flushed([])
+        return self.counts
+
+    def run(self, paths):
+        """Run paths (any iterable, eg. a utils.walk generator) through the
+        pipeline and return a dictionary counting the files that were added,
+        refreshed, skipped and failed."""
+        if not self.workers:
+            results = ((p, k, backend.fingerprint(s), _extract(p, s, self.hashing, self.stats))
+                for p, s, k in self.candidates(paths))
+            return self.write(results)
+        work = multiprocessing.Queue(self.queue_size)
+        results = multiprocessing.Queue(self.queue_size)
+        # start the workers before any threads so they fork cleanly
+        processes = [multiprocessing.Process(target=_extractor,
+            args=(work, results, self.hashing))
+            for i in range(self.workers)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+        errors = []
+        def feed():
+            try:
+                for item in self.candidates(paths):
+                    work.put(item)
+            except Exception, e:
+                errors.append(e)
+            finally:
+                for process in processes:
+                    work.put(DONE)
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        try:
+            counts = self.write(self._drain(results))
+        except:
+            for process in processes:
+                process.terminate()
+            raise
+        feeder.join()
+        for process in processes:
+            process.join()
+        if errors:
+            raise errors[0]
+        return counts
+
+    def _drain(self, results):
+        """Yield results until every extractor has said it's done, merging
+        the stats they send along the way."""
+        finished = 0
+        while finished < self.workers:
+            result = results.get()
+            if result is DONE:
+                finished += 1
+            elif isinstance(result, metrics.Stats):
+                self.stats.merge(result)
+            else:
+                yield result
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A local journal of the paths an ingest has finished with.
+
+Each line of the journal is a status ('ok' or 'failed'), the fingerprint of
+the file when it was handled, and its path, separated by tabs.  Lines are
+appended (and synced) every time the ingest's `BulkInserter` flushes, so if
+an `iris add` dies partway through, `iris add --resume` can skip everything
+that was already written without reading or even looking those files up in
+the database again.
+
+Failures are remembered across runs, so files that aren't images are not
+read again every time unless they change.  Finished paths are only kept
+until a run completes."""
+
+import os
+import threading
+
+DEFAULT_PATH = '~/.iris.journal'
+
+def format_fingerprint(fingerprint):
+    return ':'.join(map(str, fingerprint))
+
+class Journal(object):
+    """The ingest journal at path.  Call `open` before recording anything
+    and `close` afterwards.  Recording is thread safe."""
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = os.path.expanduser(path)
+        self.completed = set()
+        self.failed = {}
+        self.lock = threading.Lock()
+        self._file = None
+
+    def open(self, resume=False):
+        """Load the journal.  Unless resume is True, the paths finished by
+        previous runs are forgotten, and only their failures are kept."""
+        self._load()
+        if not resume:
+            self.completed = set()
+            self._rewrite()
+        self._file = open(self.path, 'a')
+
+    def close(self, finished=False):
+        """Close the journal.  If finished is True, the run completed and
+        only failures need to be kept."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if finished:
+            self.completed = set()
+            self._rewrite()
+
+    def _load(self):
+        self.completed, self.failed = set(), {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    status, fingerprint, path = line.rstrip('\n').split('\t', 2)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                if status == 'ok':
+                    self.completed.add(path)
+                    self.failed.pop(path, None)
+                elif status == 'failed':
+                    self.failed[path] = fingerprint
+                    self.completed.discard(path)
+
+    def _rewrite(self):
+        """Atomically replace the journal with what's in memory."""
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            for path in self.completed:
+                f.write('ok\t-\t%s\n' % path)
+            for path, fingerprint in self.failed.iteritems():
+                f.write('failed\t%s\t%s\n' % (fingerprint, path))
+        os.rename(temporary, self.path)
+
+    def done(self, path):
+        """True if a run being resumed already finished with path."""
+        return path in self.completed
+
+    def known_failure(self, path, fingerprint):
+        """True if path failed before and hasn't changed since."""
+        return self.failed.get(path) == format_fingerprint(fingerprint)
+
+    def record(self, completed=(), failed=()):
+        """Append completed [(path, fingerprint)] and failed [(path,
+        fingerprint)] entries, and sync them to disk."""
+        if not completed and not failed:
+            return
+        lines = ['ok\t%s\t%s\n' % (format_fingerprint(f), p) for p, f in completed]
+        lines += ['failed\t%s\t%s\n' % (format_fingerprint(f), p) for p, f in failed]
+        with self.lock:
+            # failures outlive the run, so keep them for `close` to rewrite
+            for path, fingerprint in completed:
+                self.failed.pop(path, None)
+            for path, fingerprint in failed:
+                self.failed[path] = format_fingerprint(fingerprint)
+            self._file.write(''.join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
@@ -8,13 +8,15 @@ import datetime
 import pyexiv2
 if pyexiv2.version_info < (0, 3, 0):
     from pyexiv2.utils import Rational, GPSCoordinate
-    Fraction = type
-    examine_types = (Rational, GPSCoordinate, list, datetime.date, datetime.time)
+    # the header reader produces fractions even for old pyexiv2
+    from fractions import Fraction
+    examine_types = (Rational, GPSCoordinate, list, datetime.date, datetime.time, Fraction)
 else:
     from pyexiv2.utils import Rational, GPSCoordinate, Fraction
     examine_types = (Rational, GPSCoordinate, list, datetime.date, datetime.time, Fraction)
 
 from iris import utils
+from iris.loaders import header
 
 def time_format(time):
     return '%02d:%02d:%02d' % (time.hour, time.minute, time.second)
@@ -82,57 +84,134 @@ class MetaData(object):
     """Encapsulation of image metadata.  Accessing the 'exif' or 'iptc'
     attributes will get you a hierarchical dictionary with the correct
     types.  Accessing 'metas' will get you a combined dictionary, with
-    exif rooted at 'Exif' and iptc rooted at 'Iptc'."""
+    exif rooted at 'Exif' and iptc rooted at 'Iptc'.
+
+    JPEG and TIFF files are read with the header-only reader in
+    `iris.loaders.header`;  everything else is read with pyexiv2.
 
-    def __init__(self, path):
-        _metadata = pyexiv2.ImageMetadata(path)
+    Values are only serialized, and hierarchical dictionaries only built,
+    when they are first accessed, and both are cached.  Use `get` for single
+    keys and `subtree` for parts of the hierarchy.  If `keys` is given, only
+    exif and iptc keys under one of those prefixes (eg. 'Exif.Photo' or
+    'Iptc.Application2.Keywords') are visible at all."""
+
+    def __init__(self, path, keys=None):
         UITException = UnknownImageTypeException('File at `%s` mangled or of unknown type (not an image?)' % path)
         try:
+            _metadata = header.HeaderMetadata(path)
             _metadata.read()
-        except IOError:
-            raise UITException
+        except header.UnsupportedFormat:
+            _metadata = pyexiv2.ImageMetadata(path)
+            try:
+                _metadata.read()
+            except IOError:
+                raise UITException
         self._metadata = _metadata
-        x,y = _metadata.dimensions
-        # XXX: Canon Movie Thumbnails (.THM) seem to have valid EXIF metadata,
-        # but then choke the actual exif parser;  we should just ignore.
-        try:
-            exif = self._exif()
-        except pyexiv2.exif.ExifValueError:
-            raise UITException
-        iptc = self._iptc()
-        tags = extract_tags(exif, iptc)
-        caption = extract_caption(exif, iptc)
-        self.__dict__.update(utils.exclude_self(locals()))
+        self._error = UITException
+        self._prefixes = tuple(keys) if keys is not None else None
+        self._known = None
+        self._values = {}
+        self._subtrees = {}
+        self.path = path
+        self.x, self.y = _metadata.dimensions
+
+    @property
+    def exif(self):
+        return self.subtree('Exif')
+
+    @property
+    def iptc(self):
+        return self.subtree('Iptc')
+
+    @property
+    def tags(self):
+        tags = list(self.get('Iptc.Application2.Keywords') or [])
+        tags += self.get('Iptc.Application.Keywords') or []
+        return tags
+
+    @property
+    def caption(self):
+        return self.get('Iptc.Application2.Caption') or None
+
+    @property
+    def thumbnail(self):
+        """The raw jpeg data of the embedded thumbnail, or None."""
+        m = self._metadata
+        if isinstance(m, header.HeaderMetadata):
+            return m.thumbnail
+        previews = getattr(m, 'previews', None)
+        if previews:
+            smallest = min(previews, key=lambda p: p.size)
+            if smallest.mime_type == 'image/jpeg':
+                return smallest.data
+        return None
 
     def metas(self):
         return {
-            'exif' : self.exif(),
-            'iptc' : self.iptc(),
+            'exif' : self.exif,
+            'iptc' : self.iptc,
         }
 
-    def _hierarchical_split(self, keys):
+    def wanted(self, key):
+        """True if key is visible given the keys this MetaData was made with."""
+        if self._prefixes is None:
+            return True
+        for prefix in self._prefixes:
+            if key == prefix or key.startswith(prefix + '.'):
+                return True
+        return False
+
+    def keys(self):
+        """All of the (wanted) exif and iptc keys for this file."""
+        m = self._metadata
+        return [k for k in list(m.exif_keys) + list(m.iptc_keys) if self.wanted(k)]
+
+    def raw(self, key, default=None):
+        """The value of key as the metadata reader decoded it, before any
+        serialization;  iptc values are always lists."""
         m = self._metadata
+        if self._known is None:
+            self._known = set(m.exif_keys) | set(m.iptc_keys)
+        if key not in self._known:
+            return default
+        # XXX: Canon Movie Thumbnails (.THM) seem to have valid EXIF metadata,
+        # but then choke the actual exif parser;  we should just ignore.
+        try:
+            tag = m[key]
+            return tag.values if key.startswith('Iptc') else tag.value
+        except pyexiv2.exif.ExifValueError:
+            raise self._error
+
+    def get(self, key, default=None):
+        """The serialized value of a single key like 'Exif.Photo.FNumber'."""
+        if key not in self._values:
+            if not self.wanted(key):
+                return default
+            value = self.raw(key, default)
+            if value is not default:
+                value = exiv_serialize(key.rsplit('.', 1)[-1], value)
+            self._values[key] = value
+        return self._values[key]
+
+    def subtree(self, prefix):
+        """The hierarchical dictionary of all keys under prefix, eg. 'Exif'
+        or 'Exif.Photo'.  Only the parts under prefix are built."""
+        if prefix not in self._subtrees:
+            depth = prefix.count('.') + 1
+            keys = [k for k in self.keys() if k.startswith(prefix + '.')]
+            self._subtrees[prefix] = self._hierarchical_split(keys, depth)
+        return self._subtrees[prefix]
+
+    def _hierarchical_split(self, keys, depth=1):
         d = {}
         for key in keys:
-            parts = key.split('.')[1:]
+            parts = key.split('.')[depth:]
+            name = parts[-1]
+            if discard(name):
+                continue
             cur = d
             for part in parts[:-1]:
                 cur.setdefault(part, {})
                 cur = cur[part]
-            name = parts[-1]
-            if discard(name):
-                continue
-            if key.startswith('Iptc'):
-                cur[name] = exiv_serialize(name, m[key].values)
-            else:
-                cur[name] = exiv_serialize(name, m[key].value)
+            cur[name] = self.get(key)
         return d
-
-    def _exif(self):
-        return self._hierarchical_split(self._metadata.exif_keys)
-
-    def _iptc(self):
-        return self._hierarchical_split(self._metadata.iptc_keys)
-
-
-
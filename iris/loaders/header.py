@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A fast, header-only metadata reader for JPEG and TIFF files.
+
+Rather than having exiv2 parse the whole file, this memory-maps it and only
+touches the segments that hold metadata:  the Exif APP1 and Photoshop APP13
+segments of a JPEG, or the IFD chain of a TIFF (along with any IPTC its
+first IFD holds).  Values are decoded to the
+same python types pyexiv2 >= 0.3 produces, and `HeaderMetadata` provides the
+subset of the `pyexiv2.ImageMetadata` interface that `MetaData` uses, so the
+two can be used interchangeably.  Anything this module can't handle raises
+`UnsupportedFormat`, and the caller should fall back to pyexiv2."""
+
+import os
+import mmap
+import struct
+import datetime
+from fractions import Fraction
+
+class UnsupportedFormat(Exception):
+    pass
+
+# -- tag names, as exiv2 names them
+
+image_tags = {
+    0x00fe: 'NewSubfileType', 0x0100: 'ImageWidth', 0x0101: 'ImageLength',
+    0x0102: 'BitsPerSample', 0x0103: 'Compression',
+    0x0106: 'PhotometricInterpretation', 0x010d: 'DocumentName',
+    0x010e: 'ImageDescription', 0x010f: 'Make', 0x0110: 'Model',
+    0x0111: 'StripOffsets', 0x0112: 'Orientation', 0x0115: 'SamplesPerPixel',
+    0x0116: 'RowsPerStrip', 0x0117: 'StripByteCounts', 0x011a: 'XResolution',
+    0x011b: 'YResolution', 0x011c: 'PlanarConfiguration',
+    0x0128: 'ResolutionUnit', 0x012d: 'TransferFunction', 0x0131: 'Software',
+    0x0132: 'DateTime', 0x013b: 'Artist', 0x013c: 'HostComputer',
+    0x013e: 'WhitePoint', 0x013f: 'PrimaryChromaticities',
+    0x0142: 'TileWidth', 0x0143: 'TileLength', 0x0144: 'TileOffsets',
+    0x0145: 'TileByteCounts', 0x014a: 'SubIFDs',
+    0x0201: 'JPEGInterchangeFormat', 0x0202: 'JPEGInterchangeFormatLength',
+    0x0211: 'YCbCrCoefficients', 0x0212: 'YCbCrSubSampling',
+    0x0213: 'YCbCrPositioning', 0x0214: 'ReferenceBlackWhite',
+    0x02bc: 'XMLPacket', 0x4746: 'Rating', 0x4749: 'RatingPercent',
+    0x8298: 'Copyright', 0x83bb: 'IPTCNAA', 0x8649: 'ImageResources',
+    0x8769: 'ExifTag', 0x8773: 'InterColorProfile', 0x8825: 'GPSTag',
+    0x9c9b: 'XPTitle', 0x9c9c: 'XPComment', 0x9c9d: 'XPAuthor',
+    0x9c9e: 'XPKeywords', 0x9c9f: 'XPSubject', 0xc4a5: 'PrintImageMatching',
+    0xc612: 'DNGVersion', 0xc614: 'UniqueCameraModel',
+}
+
+photo_tags = {
+    0x829a: 'ExposureTime', 0x829d: 'FNumber', 0x8822: 'ExposureProgram',
+    0x8824: 'SpectralSensitivity', 0x8827: 'ISOSpeedRatings', 0x8828: 'OECF',
+    0x8830: 'SensitivityType', 0x8832: 'RecommendedExposureIndex',
+    0x9000: 'ExifVersion', 0x9003: 'DateTimeOriginal',
+    0x9004: 'DateTimeDigitized', 0x9101: 'ComponentsConfiguration',
+    0x9102: 'CompressedBitsPerPixel', 0x9201: 'ShutterSpeedValue',
+    0x9202: 'ApertureValue', 0x9203: 'BrightnessValue',
+    0x9204: 'ExposureBiasValue', 0x9205: 'MaxApertureValue',
+    0x9206: 'SubjectDistance', 0x9207: 'MeteringMode', 0x9208: 'LightSource',
+    0x9209: 'Flash', 0x920a: 'FocalLength', 0x9214: 'SubjectArea',
+    0x927c: 'MakerNote', 0x9286: 'UserComment', 0x9290: 'SubSecTime',
+    0x9291: 'SubSecTimeOriginal', 0x9292: 'SubSecTimeDigitized',
+    0xa000: 'FlashpixVersion', 0xa001: 'ColorSpace',
+    0xa002: 'PixelXDimension', 0xa003: 'PixelYDimension',
+    0xa004: 'RelatedSoundFile', 0xa005: 'InteroperabilityTag',
+    0xa20b: 'FlashEnergy', 0xa20c: 'SpatialFrequencyResponse',
+    0xa20e: 'FocalPlaneXResolution', 0xa20f: 'FocalPlaneYResolution',
+    0xa210: 'FocalPlaneResolutionUnit', 0xa214: 'SubjectLocation',
+    0xa215: 'ExposureIndex', 0xa217: 'SensingMethod', 0xa300: 'FileSource',
+    0xa301: 'SceneType', 0xa302: 'CFAPattern', 0xa401: 'CustomRendered',
+    0xa402: 'ExposureMode', 0xa403: 'WhiteBalance',
+    0xa404: 'DigitalZoomRatio', 0xa405: 'FocalLengthIn35mmFilm',
+    0xa406: 'SceneCaptureType', 0xa407: 'GainControl', 0xa408: 'Contrast',
+    0xa409: 'Saturation', 0xa40a: 'Sharpness',
+    0xa40b: 'DeviceSettingDescription', 0xa40c: 'SubjectDistanceRange',
+    0xa420: 'ImageUniqueID', 0xa430: 'CameraOwnerName',
+    0xa431: 'BodySerialNumber', 0xa432: 'LensSpecification',
+    0xa433: 'LensMake', 0xa434: 'LensModel', 0xa435: 'LensSerialNumber',
+}
+
+gps_tags = {
+    0x00: 'GPSVersionID', 0x01: 'GPSLatitudeRef', 0x02: 'GPSLatitude',
+    0x03: 'GPSLongitudeRef', 0x04: 'GPSLongitude', 0x05: 'GPSAltitudeRef',
+    0x06: 'GPSAltitude', 0x07: 'GPSTimeStamp', 0x08: 'GPSSatellites',
+    0x09: 'GPSStatus', 0x0a: 'GPSMeasureMode', 0x0b: 'GPSDOP',
+    0x0c: 'GPSSpeedRef', 0x0d: 'GPSSpeed', 0x0e: 'GPSTrackRef',
+    0x0f: 'GPSTrack', 0x10: 'GPSImgDirectionRef', 0x11: 'GPSImgDirection',
+    0x12: 'GPSMapDatum', 0x13: 'GPSDestLatitudeRef', 0x14: 'GPSDestLatitude',
+    0x15: 'GPSDestLongitudeRef', 0x16: 'GPSDestLongitude',
+    0x17: 'GPSDestBearingRef', 0x18: 'GPSDestBearing',
+    0x19: 'GPSDestDistanceRef', 0x1a: 'GPSDestDistance',
+    0x1b: 'GPSProcessingMethod', 0x1c: 'GPSAreaInformation',
+    0x1d: 'GPSDateStamp', 0x1e: 'GPSDifferential',
+}
+
+iop_tags = {
+    0x0001: 'InteroperabilityIndex', 0x0002: 'InteroperabilityVersion',
+    0x1000: 'RelatedImageFileFormat', 0x1001: 'RelatedImageWidth',
+    0x1002: 'RelatedImageLength',
+}
+
+# ifd pointer tag -> (group, tag names) of the ifd it points to
+sub_ifds = {
+    0x8769: ('Photo', photo_tags),
+    0x8825: ('GPSInfo', gps_tags),
+    0xa005: ('Iop', iop_tags),
+}
+
+iptc_records = {1: 'Envelope', 2: 'Application2'}
+
+iptc_datasets = {
+    1: {
+        0: 'ModelVersion', 5: 'Destination', 20: 'FileFormat',
+        22: 'FileVersion', 30: 'ServiceId', 40: 'EnvelopeNumber',
+        50: 'ProductId', 60: 'EnvelopePriority', 70: 'DateSent',
+        80: 'TimeSent', 90: 'CharacterSet', 100: 'UNO', 120: 'ARMId',
+        122: 'ARMVersion',
+    },
+    2: {
+        0: 'RecordVersion', 3: 'ObjectType', 4: 'ObjectAttribute',
+        5: 'ObjectName', 7: 'EditStatus', 8: 'EditorialUpdate', 10: 'Urgency',
+        12: 'Subject', 15: 'Category', 20: 'SuppCategory', 22: 'FixtureId',
+        25: 'Keywords', 26: 'LocationCode', 27: 'LocationName',
+        30: 'ReleaseDate', 35: 'ReleaseTime', 37: 'ExpirationDate',
+        38: 'ExpirationTime', 40: 'SpecialInstructions', 42: 'ActionAdvised',
+        45: 'ReferenceService', 47: 'ReferenceDate', 50: 'ReferenceNumber',
+        55: 'DateCreated', 60: 'TimeCreated', 62: 'DigitizationDate',
+        63: 'DigitizationTime', 65: 'Program', 70: 'ProgramVersion',
+        75: 'ObjectCycle', 80: 'Byline', 85: 'BylineTitle', 90: 'City',
+        92: 'SubLocation', 95: 'ProvinceState', 100: 'CountryCode',
+        101: 'CountryName', 103: 'TransmissionReference', 105: 'Headline',
+        110: 'Credit', 115: 'Source', 116: 'Copyright', 118: 'Contact',
+        120: 'Caption', 122: 'Writer', 125: 'RasterizedCaption',
+        130: 'ImageType', 131: 'ImageOrientation', 135: 'Language',
+    },
+}
+
+iptc_shorts = set([(1, 0), (1, 20), (1, 22), (1, 120), (1, 122), (2, 0)])
+iptc_dates = set([(1, 70), (2, 30), (2, 37), (2, 47), (2, 55), (2, 62)])
+iptc_times = set([(1, 80), (2, 35), (2, 38), (2, 60), (2, 63)])
+
+# tiff field type -> (size in bytes, struct format)
+tiff_types = {
+    1: (1, 'B'), 2: (1, 's'), 3: (2, 'H'), 4: (4, 'L'), 5: (8, 'LL'),
+    6: (1, 'b'), 7: (1, 's'), 8: (2, 'h'), 9: (4, 'l'), 10: (8, 'll'),
+    11: (4, 'f'), 12: (8, 'd'), 13: (4, 'L'),
+}
+ASCII, UNDEFINED = 2, 7
+
+# IFD0 tags that hold IPTC, as raw IIM datasets or in Photoshop image
+# resources;  they're decoded as iptc rather than kept as exif
+IPTCNAA, IMAGE_RESOURCES = 0x83bb, 0x8649
+
+# jpeg start of frame markers;  0xc4, 0xc8 and 0xcc are not frames
+sof_markers = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+
+tiff_extensions = ('.tif', '.tiff')
+
+class FixedOffset(datetime.tzinfo):
+    """A fixed utc offset, for IPTC times."""
+    def __init__(self, minutes):
+        self.offset = datetime.timedelta(minutes=minutes)
+    def utcoffset(self, dt): return self.offset
+    def dst(self, dt): return datetime.timedelta(0)
+    def tzname(self, dt): return None
+
+def to_unicode(value):
+    """Decode value as utf-8 where that works, like pyexiv2 does."""
+    try: return unicode(value, 'utf-8')
+    except UnicodeDecodeError: return value
+
+def ascii_value(raw):
+    """Exif ASCII values, with dates and datetimes parsed out."""
+    value = raw.split('\x00', 1)[0].strip()
+    for format, convert in (('%Y:%m:%d %H:%M:%S', None), ('%Y:%m:%d', 'date')):
+        try:
+            parsed = datetime.datetime.strptime(value, format)
+            return parsed.date() if convert else parsed
+        except ValueError:
+            pass
+    return to_unicode(value)
+
+def comment_value(raw):
+    """Decode an Exif UserComment, which has an 8 byte charset header."""
+    charset, text = raw[:8], raw[8:]
+    if charset.startswith('UNICODE'):
+        for encoding in ('utf-16-be', 'utf-16-le'):
+            try: return text.decode(encoding).rstrip(u'\x00 ')
+            except UnicodeDecodeError: pass
+    return to_unicode(text.rstrip('\x00 '))
+
+class Tag(object):
+    """A decoded metadata tag.  pyexiv2 calls the value of an exif tag `value`
+    and those of an iptc tag `values`;  both work here."""
+    __slots__ = ('key', 'value')
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+    @property
+    def values(self): return self.value
+    def __repr__(self): return '<%s = %r>' % (self.key, self.value)
+
+class HeaderMetadata(object):
+    """Reads metadata out of the headers of a JPEG or TIFF file.  Mirrors the
+    bits of `pyexiv2.ImageMetadata` that iris uses:  `read`, `dimensions`,
+    `exif_keys`, `iptc_keys` and item access by key.  The raw bytes of an
+    embedded exif thumbnail, if any, are kept in `thumbnail`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.dimensions = (0, 0)
+        self.exif_keys = []
+        self.iptc_keys = []
+        self.thumbnail = None
+        self._tags = {}
+        self._embedded = {}
+
+    def __getitem__(self, key):
+        return self._tags[key]
+
+    def read(self):
+        try:
+            handle = open(self.path, 'rb')
+        except IOError:
+            raise UnsupportedFormat(self.path)
+        try:
+            try:
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                raise UnsupportedFormat(self.path)
+            try:
+                self._read(data)
+            except (struct.error, IndexError):
+                raise UnsupportedFormat(self.path)
+            finally:
+                data.close()
+        finally:
+            handle.close()
+
+    def _read(self, data):
+        magic = data[:4]
+        if magic[:2] == '\xff\xd8':
+            self._read_jpeg(data)
+        elif magic in ('II*\x00', 'MM\x00*') and \
+                os.path.splitext(self.path)[1].lower() in tiff_extensions:
+            self._read_tiff(data, 0)
+            width = self._tags.get('Exif.Image.ImageWidth')
+            height = self._tags.get('Exif.Image.ImageLength')
+            if width is None or height is None:
+                raise UnsupportedFormat(self.path)
+            self.dimensions = (width.value, height.value)
+        else:
+            raise UnsupportedFormat(self.path)
+        if not self.iptc_keys:
+            self._read_embedded()
+
+    def _read_embedded(self):
+        """Decode the IPTC a TIFF (or, rarely, a JPEG's exif) keeps in IFD0,
+        preferring the raw IIM of IPTCNAA to the Photoshop resources, which
+        usually hold the same datasets again."""
+        if IPTCNAA in self._embedded:
+            self._read_iptc(self._embedded[IPTCNAA])
+        elif IMAGE_RESOURCES in self._embedded:
+            self._read_photoshop(self._embedded[IMAGE_RESOURCES])
+
+    def _read_jpeg(self, data):
+        """Walk the jpeg segments up to the start of scan, decoding Exif and
+        IPTC metadata and picking up dimensions from the frame header."""
+        pos, size, photoshop = 2, len(data), []
+        frame = None
+        while pos < size:
+            if data[pos] != '\xff':
+                raise UnsupportedFormat(self.path)
+            while data[pos] == '\xff':
+                pos += 1
+            marker = ord(data[pos])
+            pos += 1
+            if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                continue
+            if marker in (0xd9, 0xda):
+                break
+            length = struct.unpack('>H', data[pos:pos+2])[0]
+            if marker == 0xe1 and data[pos+2:pos+8] == 'Exif\x00\x00':
+                if not self.exif_keys:
+                    self._read_tiff(data[pos+8:pos+length], 0)
+            elif marker == 0xed and data[pos+2:pos+16] == 'Photoshop 3.0\x00':
+                photoshop.append(data[pos+16:pos+length])
+            elif marker in sof_markers and frame is None:
+                height, width = struct.unpack('>HH', data[pos+3:pos+7])
+                frame = (width, height)
+            pos += length
+        if frame is None:
+            raise UnsupportedFormat(self.path)
+        self.dimensions = frame
+        if photoshop:
+            self._read_photoshop(''.join(photoshop))
+
+    def _read_tiff(self, data, start):
+        """Decode the IFD chain of the tiff structure at data[start:]."""
+        endian = {'II': '<', 'MM': '>'}.get(data[start:start+2])
+        if endian is None:
+            raise UnsupportedFormat(self.path)
+        offset = struct.unpack(endian + 'L', data[start+4:start+8])[0]
+        seen = set()
+        ifd0 = self._read_ifd(data, start, offset, endian, 'Image', image_tags, seen)
+        if ifd0:
+            self._read_ifd(data, start, ifd0, endian, 'Thumbnail', image_tags, seen)
+            offset = self._tags.get('Exif.Thumbnail.JPEGInterchangeFormat')
+            length = self._tags.get('Exif.Thumbnail.JPEGInterchangeFormatLength')
+            if offset is not None and length is not None:
+                thumbnail = data[start+offset.value:start+offset.value+length.value]
+                if thumbnail[:2] == '\xff\xd8':
+                    self.thumbnail = thumbnail
+
+    def _read_ifd(self, data, start, offset, endian, group, names, seen):
+        """Decode one IFD into tags, following pointers to sub-IFDs.  Returns
+        the offset of the next IFD in the chain, or 0 if there isn't one.  IPTC
+    in IFD0 is set aside in `_embedded` for `_read_embedded`."""
+        if not offset or offset in seen:
+            return 0
+        seen.add(offset)
+        pos = start + offset
+        count = struct.unpack(endian + 'H', data[pos:pos+2])[0]
+        for i in xrange(count):
+            entry = data[pos+2+i*12:pos+14+i*12]
+            tag, type, components = struct.unpack(endian + 'HHL', entry[:8])
+            if type not in tiff_types:
+                continue
+            width, format = tiff_types[type]
+            length = width * components
+            if length <= 4:
+                raw = entry[8:8+length]
+            else:
+                where = start + struct.unpack(endian + 'L', entry[8:12])[0]
+                raw = data[where:where+length]
+                if len(raw) < length:
+                    continue
+            if group == 'Image' and tag in (IPTCNAA, IMAGE_RESOURCES):
+                self._embedded.setdefault(tag, raw)
+                continue
+            name = names.get(tag, '0x%04x' % tag)
+            key = 'Exif.%s.%s' % (group, name)
+            value = self._decode(key, type, components, raw, endian)
+            if key not in self._tags:
+                self.exif_keys.append(key)
+            self._tags[key] = Tag(key, value)
+            if tag in sub_ifds and isinstance(value, (int, long)):
+                subgroup, subnames = sub_ifds[tag]
+                self._read_ifd(data, start, value, endian, subgroup, subnames, seen)
+        next = pos + 2 + count * 12
+        return struct.unpack(endian + 'L', data[next:next+4])[0]
+
+    def _decode(self, key, type, components, raw, endian):
+        if type == ASCII:
+            return ascii_value(raw)
+        if type == UNDEFINED:
+            if key == 'Exif.Photo.UserComment':
+                return comment_value(raw)
+            return raw
+        width, format = tiff_types[type]
+        if len(format) == 2:
+            values = struct.unpack('%s%d%s' % (endian, components * 2, format[0]), raw)
+            pairs = zip(values[::2], values[1::2])
+            values = [Fraction(n, d) if d else '%d/%d' % (n, d) for n, d in pairs]
+        else:
+            values = list(struct.unpack('%s%d%s' % (endian, components, format), raw))
+        if components == 1:
+            return values[0]
+        return values
+
+    def _read_photoshop(self, data):
+        """Find the IPTC resource among Photoshop's 8BIM image resources."""
+        pos = 0
+        while data[pos:pos+4] == '8BIM':
+            resource = struct.unpack('>H', data[pos+4:pos+6])[0]
+            namesize = ord(data[pos+6]) + 1
+            pos += 6 + namesize + (namesize % 2)
+            size = struct.unpack('>L', data[pos:pos+4])[0]
+            pos += 4
+            if resource == 0x0404:
+                self._read_iptc(data[pos:pos+size])
+            pos += size + (size % 2)
+
+    def _read_iptc(self, data):
+        """Decode IPTC IIM datasets.  Repeated datasets, like keywords, are
+        collected into one tag with a list of values."""
+        pos = 0
+        while data[pos:pos+1] == '\x1c' and pos + 5 <= len(data):
+            record, dataset = ord(data[pos+1]), ord(data[pos+2])
+            size = struct.unpack('>H', data[pos+3:pos+5])[0]
+            pos += 5
+            if size & 0x8000:
+                width = size & 0x7fff
+                size = 0
+                for char in data[pos:pos+width]:
+                    size = (size << 8) | ord(char)
+                pos += width
+            raw = data[pos:pos+size]
+            pos += size
+            if record not in iptc_records:
+                continue
+            name = iptc_datasets[record].get(dataset, '0x%04x' % dataset)
+            key = 'Iptc.%s.%s' % (iptc_records[record], name)
+            if key not in self._tags:
+                self.iptc_keys.append(key)
+                self._tags[key] = Tag(key, [])
+            self._tags[key].value.append(self._decode_iptc((record, dataset), raw))
+
+    def _decode_iptc(self, dataset, raw):
+        if dataset in iptc_shorts and len(raw) == 2:
+            return struct.unpack('>H', raw)[0]
+        if dataset in iptc_dates:
+            try: return datetime.datetime.strptime(raw, '%Y%m%d').date()
+            except ValueError: pass
+        if dataset in iptc_times and len(raw) >= 6:
+            try:
+                time = datetime.datetime.strptime(raw[:6], '%H%M%S').time()
+                if len(raw) == 11 and raw[6] in '+-':
+                    minutes = int(raw[7:9]) * 60 + int(raw[9:11])
+                    minutes = -minutes if raw[6] == '-' else minutes
+                    time = time.replace(tzinfo=FixedOffset(minutes))
+                return time
+            except ValueError:
+                pass
+        return to_unicode(raw)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Perceptual hashes for finding near-duplicate photos.
+
+The hash is a 64 bit difference hash (dHash) of the small thumbnail that most
+cameras embed in the Exif data, so the full image never has to be decoded.
+Even the thumbnail isn't fully decoded:  the DC coefficient of each 8x8 JPEG
+block is the block's average brightness, so entropy decoding the scan and
+keeping only the luma DC values gives a 1/8 scale image, which is plenty for
+a 9x8 dHash.  Only baseline huffman JPEGs (what thumbnails always are) are
+supported;  anything else hashes to None.
+
+Hashes are searched with multi-index hashing:  they are split into BANDS
+bands of 16 bits, and two hashes within `d` bits of each other must have at
+least one band within `d // BANDS` bits of each other.  Looking up the few
+band values near each of a hash's bands in an index finds all candidates
+without comparing against every stored hash."""
+
+import struct
+import itertools
+
+BANDS = 4
+BAND_BITS = 64 // BANDS
+# keep the number of band values looked up per query reasonable
+MAX_DISTANCE = BANDS * 4 - 1
+
+class UnsupportedJPEG(Exception):
+    pass
+
+_bits = [bin(i)[2:].zfill(8) for i in range(256)]
+
+def _huffman(counts, symbols):
+    """Build a canonical huffman table mapping code strings to symbols."""
+    table, code, index = {}, 0, 0
+    for length, count in enumerate(counts, 1):
+        for i in range(count):
+            table[bin(code)[2:].zfill(length)] = symbols[index]
+            code += 1
+            index += 1
+        code <<= 1
+    return table
+
+class _BitReader(object):
+    """Reads huffman codes and raw bits out of entropy coded jpeg data."""
+    def __init__(self, data):
+        self.bits = ''.join([_bits[ord(c)] for c in data.replace('\xff\x00', '\xff')])
+        self.pos = 0
+
+    def symbol(self, table):
+        for length in range(1, 17):
+            code = self.bits[self.pos:self.pos+length]
+            if code in table:
+                self.pos += length
+                return table[code]
+        raise UnsupportedJPEG('bad huffman code')
+
+    def receive(self, size):
+        """Read size bits as a signed, jpeg 'extended' value."""
+        if not size:
+            return 0
+        raw = self.bits[self.pos:self.pos+size]
+        if len(raw) < size:
+            raise UnsupportedJPEG('truncated scan')
+        self.pos += size
+        value = int(raw, 2)
+        if raw[0] == '0':
+            value -= (1 << size) - 1
+        return value
+
+    def skip(self, size):
+        self.pos += size
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+def dc_image(data):
+    """Decode the luma DC coefficients of a baseline jpeg.  Returns a list of
+    rows, each of which is a list of block brightnesses."""
+    if data[:2] != '\xff\xd8':
+        raise UnsupportedJPEG('not a jpeg')
+    pos, tables, frame, interval = 2, {}, None, 0
+    while True:
+        if data[pos:pos+1] != '\xff':
+            raise UnsupportedJPEG('bad marker')
+        marker = ord(data[pos+1])
+        if marker == 0xff:
+            pos += 1
+            continue
+        length = struct.unpack('>H', data[pos+2:pos+4])[0]
+        segment = data[pos+4:pos+2+length]
+        pos += 2 + length
+        if marker in (0xc0, 0xc1):
+            height, width, count = struct.unpack('>HHB', segment[1:6])
+            components = []
+            for i in range(count):
+                id, sampling = ord(segment[6+i*3]), ord(segment[7+i*3])
+                if not (1 <= sampling >> 4 <= 4 and 1 <= sampling & 15 <= 4):
+                    raise UnsupportedJPEG('bad sampling factors')
+                components.append((id, sampling >> 4, sampling & 15))
+            frame = (width, height, components)
+        elif 0xc2 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            raise UnsupportedJPEG('not a baseline jpeg')
+        elif marker == 0xc4:
+            offset = 0
+            while offset < len(segment):
+                kind = ord(segment[offset])
+                counts = [ord(c) for c in segment[offset+1:offset+17]]
+                symbols = [ord(c) for c in segment[offset+17:offset+17+sum(counts)]]
+                tables[(kind >> 4, kind & 15)] = _huffman(counts, symbols)
+                offset += 17 + sum(counts)
+        elif marker == 0xdd:
+            interval = struct.unpack('>H', segment[:2])[0]
+        elif marker == 0xda:
+            break
+        elif marker == 0xd9:
+            raise UnsupportedJPEG('no scan')
+    if frame is None:
+        raise UnsupportedJPEG('no frame')
+    width, height, components = frame
+    count = ord(segment[0])
+    selectors = {}
+    for i in range(count):
+        id, which = ord(segment[1+i*2]), ord(segment[2+i*2])
+        selectors[id] = (tables.get((0, which >> 4)), tables.get((1, which & 15)))
+    scan = data[pos:]
+    end = scan.find('\xff\xd9')
+    scan = scan[:end] if end >= 0 else scan
+    hmax = max([c[1] for c in components])
+    vmax = max([c[2] for c in components])
+    if count == 1:
+        # a non-interleaved scan is just the component's blocks in order
+        id, h, v = [c for c in components if c[0] in selectors][0]
+        layout = [(id, 1, 1)]
+        mcus_x = _ceil_div(_ceil_div(width * h, hmax), 8)
+        mcus_y = _ceil_div(_ceil_div(height * v, vmax), 8)
+    else:
+        layout = [c for c in components if c[0] in selectors]
+        mcus_x = _ceil_div(width, 8 * hmax)
+        mcus_y = _ceil_div(height, 8 * vmax)
+    luma = layout[0][0]
+    lh, lv = layout[0][1], layout[0][2]
+    image = [[0] * (mcus_x * lh) for i in range(mcus_y * lv)]
+    # restart markers reset the dc predictors and byte-align the data
+    if interval:
+        scan_parts, current = [], ''
+        for i, s in enumerate(scan.split('\xff')):
+            if i and s and 0xd0 <= ord(s[0]) <= 0xd7:
+                scan_parts.append(current)
+                current = s[1:]
+            else:
+                current += ('\xff' if i else '') + s
+        scan_parts.append(current)
+    else:
+        scan_parts = [scan]
+    total = mcus_x * mcus_y
+    per_part = interval or total
+    mcu = 0
+    for part in scan_parts:
+        reader = _BitReader(part)
+        predictors = dict([(c[0], 0) for c in layout])
+        for n in range(min(per_part, total - mcu)):
+            my, mx = divmod(mcu, mcus_x)
+            for id, h, v in layout:
+                dc_table, ac_table = selectors[id]
+                if dc_table is None or ac_table is None:
+                    raise UnsupportedJPEG('missing huffman table')
+                for by in range(v):
+                    for bx in range(h):
+                        predictors[id] += reader.receive(reader.symbol(dc_table))
+                        k = 1
+                        while k < 64:
+                            rs = reader.symbol(ac_table)
+                            r, s = rs >> 4, rs & 15
+                            if not s:
+                                if r != 15:
+                                    break
+                                k += 16
+                                continue
+                            k += r + 1
+                            reader.skip(s)
+                        if id == luma:
+                            image[my * lv + by][mx * lh + bx] = predictors[id]
+            mcu += 1
+        if mcu >= total:
+            break
+    # drop the blocks that only pad the image out to whole mcus
+    if count > 1:
+        rows, columns = _ceil_div(height, 8), _ceil_div(width, 8)
+        image = [row[:columns] for row in image[:rows]]
+    return image
+
+def _resample(image, width, height):
+    """Box-filter image down (or nearest-neighbour it up) to width x height."""
+    rows, columns = len(image), len(image[0])
+    result = []
+    for y in range(height):
+        y0 = y * rows // height
+        y1 = max(y0 + 1, (y + 1) * rows // height)
+        row = []
+        for x in range(width):
+            x0 = x * columns // width
+            x1 = max(x0 + 1, (x + 1) * columns // width)
+            cells = [image[j][i] for j in range(y0, y1) for i in range(x0, x1)]
+            row.append(float(sum(cells)) / len(cells))
+        result.append(row)
+    return result
+
+def dhash(data):
+    """The 64 bit difference hash of jpeg data, or None if it can't be
+    decoded.  Each bit says whether a cell of a 9x8 grid is brighter than
+    its neighbour to the right."""
+    try:
+        image = dc_image(data)
+    except (UnsupportedJPEG, struct.error, IndexError, KeyError, ValueError):
+        return None
+    if not image or not image[0]:
+        return None
+    grid = _resample(image, 9, 8)
+    value = 0
+    for row in grid:
+        for left, right in zip(row, row[1:]):
+            value = (value << 1) | (left > right)
+    return value
+
+def to_signed(value):
+    """Mongo stores signed 64 bit integers."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+def hamming(a, b):
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count('1')
+
+def bands(value):
+    """The band keys of a hash, as stored in the indexed 'phash_bands'.  Each
+    key packs the band number and the band's value into one integer."""
+    value = to_unsigned(value)
+    mask = (1 << BAND_BITS) - 1
+    return [(i << BAND_BITS) | ((value >> (i * BAND_BITS)) & mask) for i in range(BANDS)]
+
+def neighbour_bands(value, distance):
+    """All of the band keys that a hash within distance bits of value must
+    share at least one of."""
+    if distance > MAX_DISTANCE:
+        raise ValueError('distance must be at most %d bits' % MAX_DISTANCE)
+    radius = distance // BANDS
+    mask = (1 << BAND_BITS) - 1
+    flips = [0]
+    for r in range(1, radius + 1):
+        for bits in itertools.combinations(range(BAND_BITS), r):
+            flips.append(sum([1 << b for b in bits]))
+    keys = []
+    for key in bands(value):
+        band, band_value = key >> BAND_BITS, key & mask
+        keys += [(band << BAND_BITS) | (band_value ^ flip) for flip in flips]
+    return keys
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Lightweight ingest instrumentation.
+
+A `Stats` keeps counters and a latency histogram per named stage (walk, stat,
+read, serialize, flush...).  Histograms use power of two buckets of
+microseconds, so they are small, cheap to update, and can be merged, which is
+how stats collected in extractor processes end up in the parent's totals."""
+
+import sys
+import time
+import math
+import threading
+from contextlib import contextmanager
+
+class Histogram(object):
+    """A log2 histogram of durations.  Bucket n counts durations of at most
+    2**n microseconds (and more than 2**(n-1))."""
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        micros = seconds * 1e6
+        bucket = int(math.ceil(math.log(micros, 2))) if micros > 1 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other):
+        for bucket, count in other.buckets.iteritems():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for attr, pick in (('min', min), ('max', max)):
+            mine, theirs = getattr(self, attr), getattr(other, attr)
+            if theirs is not None:
+                setattr(self, attr, theirs if mine is None else pick(mine, theirs))
+
+    def percentile(self, p):
+        """An upper bound on the pth percentile, in seconds."""
+        if not self.count:
+            return None
+        target, seen = self.count * p / 100.0, 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'histogram': dict([('<=%dus' % (1 << b), n) for b, n in sorted(self.buckets.items())]),
+        }
+
+class Stats(object):
+    """Per-stage latency histograms and plain counters.  Recording is thread
+    safe, and a Stats pickles, so worker processes can send theirs to the
+    parent with `drain` to be `merge`d."""
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].add(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the body of a with block as one event in stage."""
+        t0 = time.time()
+        yield
+        self.add(stage, time.time() - t0)
+
+    def count(self, **counters):
+        with self.lock:
+            for name, value in counters.iteritems():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        with self.lock:
+            for stage, histogram in other.stages.iteritems():
+                self.stages.setdefault(stage, Histogram()).merge(histogram)
+            for name, value in other.counters.iteritems():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def drain(self):
+        """Return a Stats with everything recorded so far, and start over."""
+        with self.lock:
+            drained = Stats()
+            drained.stages, drained.counters = self.stages, self.counters
+            self.stages, self.counters = {}, {}
+        return drained
+
+    def as_dict(self):
+        elapsed = time.time() - self.started
+        files, size = self.counters.get('files', 0), self.counters.get('bytes', 0)
+        return {
+            'elapsed': elapsed,
+            'files_per_second': files / elapsed if elapsed else None,
+            'mb_per_second': size / elapsed / (1 << 20) if elapsed else None,
+            'counters': dict(self.counters),
+            'stages': dict([(s, h.as_dict()) for s, h in self.stages.iteritems()]),
+        }
+
+class _NullStats(Stats):
+    """Stats that records nothing, for when nobody is looking."""
+    def add(self, stage, seconds):
+        pass
+
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+    def count(self, **counters):
+        pass
+
+NULL = _NullStats()
+
+class Progress(object):
+    """Rewrites a files/s and MB/s progress line on stream (stderr) at most
+    every interval seconds.  Call `update` as often as you like."""
+    def __init__(self, stats, stream=None, interval=1.0):
+        self.stats = stats
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.last = 0
+
+    def update(self, force=False):
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = max(now - self.stats.started, 1e-6)
+        files = self.stats.counters.get('files', 0)
+        size = self.stats.counters.get('bytes', 0)
+        line = '%d files, %0.1f files/s, %0.1f MB/s' % (files, files / elapsed,
+            size / elapsed / (1 << 20))
+        self.stream.write('\r' + line.ljust(78))
+        self.stream.flush()
+
+    def finish(self):
+        self.update(force=True)
+        self.stream.write('\n')
@@ -2,10 +2,9 @@
 # -*- coding: utf-8 -*-
 
 """Completion helpers for iris queries.  These use partial/lexing query
-parsers to determine what tokens should come next.  Because of limitations
-either in LEPL or my knowledge of LEPL, I'm not able to use the real parsers
-directly to determine what tokens types could come next to satisfy the
-language syntax, so extra code must be written to do so.
+parsers to determine what tokens should come next.  The real parsers only
+say how much of a line they could parse, not what token types could come
+next to satisfy the language syntax, so extra code must be written to do so.
 
 
 See also, some interesting notes on implementing various types of simple
@@ -15,6 +14,7 @@ command grammars using gnu/readline & python:
     https://www.ironalbatross.net/wiki/index.php5?title=Python_Cmd_Completions
 """
 
+from iris import fields
 from iris.query import lexer
 from iris.query import parser
 
@@ -66,7 +66,7 @@ class FieldListCompleter(object):
     """Tab completer for field lists.  Note that the 'line' here should
     start earliest at '(', and in general it will ignore "text" and use
     its own lexer instead."""
-    default = ['iso', 'tags', 'shutter', 'resolution', 'x', 'y', 'fstop', 'aperture']
+    default = ['path', 'tags', 'caption', 'x', 'y', 'aperture', 'date'] + fields.NAMES
     def __init__(self, line):
         self.line = line
         try: self.tokens = lexer.field_list.parse(line)
@@ -1,17 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""Parsers meant for completion.  Note that the term 'lexer' is a little off
-here;  these are just extremely lenient parsers that are probably horribly
-slow lexers.  Eventually it may make sense to create our own tokenizer or
-to use the LEPL lexing facilities directly."""
+"""Lexers meant for completion.  These are lenient:  rather than failing
+on a partial line, they return the tokens of as much of it as makes sense,
+so the completers can tell what should come next.  They share the
+tokenizer in `iris.query.tokenizer` with the real parser."""
 
-import re
-from lepl import *
+from iris.query.tokenizer import tokenize, unquote, Stream, FullFirstMatchException
 
 class LexerToken(object):
     """Embeds most types of tokens for our parser."""
-    keywords = ('find', 'count', 'tag', 'where', 'and', 'or', 'in')
+    keywords = ('find', 'count', 'tag', 'where', 'and', 'or', 'in', 'between', 'before', 'after')
     def __init__(self, type, value):
         self.type = type.lower()
         self.value = value[0] if isinstance(value, list) else value
@@ -26,35 +25,96 @@ class LexerToken(object):
         return self.value == other
     def __str__(self): return str(self.value)
 
-def Insensitive(string):
-    """A case insensitive literal."""
-    return Regexp(re.compile(string, re.I))
-
-def token(name):
-    """Generates a function that returns a curried token."""
-    return lambda value: LexerToken(name, value)
-
-where           = Literal('where')                  > token('where')
-lparen          = Literal("(")                      > token('sep')
-rparen          = Literal(")")                      > token('sep')
-comma           = Literal(",")                      > token('sep')
-operator        = Insensitive('={1,2}|<=|<|>=|>|in')     > token('operator')
-andor           = Insensitive('(and)|(or)')         > token('operator')
-
-field           = Regexp('[a-zA-Z][-a-zA-Z0-9_]*')  > token('field')
-unknown         = Regexp('.+')                      > token('unknown')
-string          = String()                          > token('string')
-num             = Real()                            > token('number')
-ws              = Whitespace()                      > token('whitespace')
-
-# The lexers are basically (first token) & ( any | other | valid | tokens )
-# We need to catch whitespace because the tab on the end of the final token
-# vs the tab a space after the end of the final token actually is different;
-with DroppedSpace():
-    list_           = lparen & ( string | comma | ws | rparen | num )[:]
-    field_list      = lparen & ( field | comma | ws | rparen )[:]
-    where_clause    = field & (operator | string | num | list_ | ws | unknown)[:]
-
-field_list.config.no_full_first_match()
-where_clause.config.no_full_first_match()
+_types = {'whitespace': 'whitespace', 'number': 'number', 'operator': 'operator',
+          'sep': 'sep', 'logic': 'operator', 'unknown': 'unknown'}
 
+def classify(token):
+    """The LexerToken for a tokenizer Token."""
+    if token.kind == 'word':
+        word = token.text.lower()
+        if word == 'where':
+            return LexerToken('where', token.text)
+        if word in ('in', 'and', 'or', 'between', 'before', 'after'):
+            return LexerToken('operator', token.text)
+        return LexerToken('field', token.text)
+    if token.kind == 'string':
+        return LexerToken('string', unquote(token.text))
+    return LexerToken(_types[token.kind], token.text)
+
+class Lexer(object):
+    """Matches a string that's a single token of a type, like 'operator' or
+    'field', and optionally one of some values;  `parse` returns a list of
+    its LexerToken, and raises FullFirstMatchException for anything else."""
+    def __init__(self, type, values=None):
+        self.type = type
+        self.values = values
+
+    def parse(self, string):
+        tokens = tokenize(string)
+        if len(tokens) == 1:
+            token = classify(tokens[0])
+            if token.type == self.type and (self.values is None or token.value in self.values):
+                return [token]
+        raise FullFirstMatchException(Stream(string, 0))
+
+class Anything(Lexer):
+    """Matches any (non-empty) string at all as one 'unknown' token."""
+    def __init__(self):
+        Lexer.__init__(self, 'unknown')
+
+    def parse(self, string):
+        if not string:
+            raise FullFirstMatchException(Stream(string, 0))
+        return [LexerToken('unknown', string)]
+
+class PrefixLexer(object):
+    """Lexes a line that starts with a token matching `first`, followed by
+    any number of tokens of the given types.  Whitespace between tokens is
+    dropped, but whitespace at the end is kept, since completing right
+    after a token and after a space are different things.  With `rest`, an
+    unexpected token and everything after it become one 'unknown' token;
+    otherwise lexing just stops there.  `parse` returns None if the line
+    doesn't start with `first`."""
+    def __init__(self, first, types, rest=False):
+        self.first = first
+        self.types = types
+        self.rest = rest
+
+    def parse(self, string):
+        tokens = tokenize(string)
+        if not tokens:
+            return None
+        try:
+            results = self.first.parse(tokens[0].text)
+        except FullFirstMatchException:
+            return None
+        for i, token in enumerate(tokens[1:]):
+            lexed = classify(token)
+            if lexed.is_ws():
+                if i == len(tokens) - 2:
+                    results.append(lexed)
+            elif lexed.type in self.types:
+                results.append(lexed)
+            elif self.rest:
+                results.append(LexerToken('unknown', string[token.start:]))
+                break
+            else:
+                break
+        return results
+
+where           = Lexer('where')
+lparen          = Lexer('sep', ('(',))
+rparen          = Lexer('sep', (')',))
+comma           = Lexer('sep', (',',))
+operator        = Lexer('operator', ('=', '==', '<=', '<', '>=', '>', 'in', 'between', 'before', 'after'))
+andor           = Lexer('operator', ('and', 'or', '&', '|'))
+
+field           = Lexer('field')
+unknown         = Anything()
+string          = Lexer('string')
+num             = Lexer('number')
+ws              = Lexer('whitespace')
+
+list_           = PrefixLexer(lparen, ('string', 'sep', 'number'))
+field_list      = PrefixLexer(lparen, ('field', 'sep'))
+where_clause    = PrefixLexer(field, ('field', 'operator', 'string', 'number', 'sep'), rest=True)
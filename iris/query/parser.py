@@ -2,25 +2,28 @@
 # -*- coding: utf-8 -*-
 
 """Parser for iris shell queries.  To see a BNF-style description of the
-query language, check ``iris/query/language.bnf``."""
+query language, check ``iris/query/language.bnf``.
+
+This is a small recursive descent parser over the tokens from
+`iris.query.tokenizer`;  it used to be built with LEPL, which took most of
+a second to compile its matchers the first time they were used."""
 
-import re
 from functools import wraps
-from lepl import *
 
-# make lepl's logging behave
-import logging
-logger = logging.getLogger("lepl")
-logger.setLevel(logging.CRITICAL)
+from iris import fields
+
+from iris.query.tokenizer import tokenize, unquote, Stream, FullFirstMatchException
 
 class IrisToken(object):
     """Embeds most types of tokens for our parser."""
-    keywords = ('find', 'count', 'tag', 'where', 'and', 'or', 'in')
+    keywords = ('find', 'count', 'tag', 'group', 'histogram', 'by', 'where', 'and', 'or', 'in',
+                'between', 'before', 'after')
     def __init__(self, type, value):
         self.type = type.lower()
         self.value = value[0] if isinstance(value, list) else value
-        if self.type in ('or', 'and'):
-            self.value = self.value.lower()
+        # 'WHERE', '&' and '|' are just other ways to write the keywords
+        if self.type in self.keywords:
+            self.value = self.type
 
     def is_field(self): return self.type == 'field'
     def is_ws(self): return self.type == 'whitespace'
@@ -35,84 +38,227 @@ class IrisToken(object):
         return self.value == other
     def __str__(self): return str(self.value)
 
-def token(name):
-    """Generates a function that returns a curried token."""
-    return lambda value: IrisToken(name, value)
+def numerify(value):
+    """Cast a string to a number of appropriate type;  fractions like 1/250
+    (shutter speeds) are floats."""
+    if '/' in value:
+        numerator, denominator = value.split('/')
+        return float(numerator) / float(denominator)
+    try: return int(value)
+    except ValueError: return float(value)
 
-def Insensitive(string):
-    """A case insensitive literal."""
-    return Regexp(re.compile(string, re.I))
+class _Fail(Exception):
+    pass
 
-def Separator(matcher, drop=True, ws=~Whitespace()[:]):
-    """Create space-tolerant separators for repetitions."""
-    if drop: return ws & Drop(matcher) & ws
-    return ws & matcher & ws
+class _Parser(object):
+    """Recursive descent over the tokens of one string.  Rules are functions
+    of a _Parser that return a list of results, or call `fail`, which
+    remembers the furthest point reached for error messages."""
+    def __init__(self, string):
+        self.string = string
+        self.tokens = [t for t in tokenize(string) if t.kind != 'whitespace']
+        self.pos = 0
+        self.furthest = 0
 
-def CommaSeparated(matcher, min=1, comma=Literal(',')):
-    """Use the matcher as a comma separated value within ()'s."""
-    return Drop("(") & matcher[min:, Separator(comma)] & Drop(")")
+    def peek(self, kind, text=None):
+        """Whether the next token is of kind (and text, case insensitively)."""
+        if self.pos >= len(self.tokens):
+            return False
+        token = self.tokens[self.pos]
+        return token.kind == kind and (text is None or token.text.lower() == text)
 
-def numerify(x):
-    """Cast a string to a number of appropriate type."""
-    value = x[0]
-    try: return int(value)
-    except ValueError: return float(value)
+    def take(self, kind, text=None):
+        if not self.peek(kind, text):
+            self.fail()
+        self.pos += 1
+        return self.tokens[self.pos - 1]
 
+    def fail(self):
+        self.furthest = max(self.furthest, self.pos)
+        raise _Fail()
+
+    def optional(self, rule, results):
+        """Try a rule, adding its results on success, or backtracking."""
+        pos = self.pos
+        try:
+            results.extend(rule(self))
+        except _Fail:
+            self.pos = pos
+            return False
+        return True
 
-# types
-Alpha = Regexp('[a-zA-Z]+')
-AlphaNum = Regexp('[a-zA-Z0-9]+')
-InitialAlpha = Regexp('[a-zA-Z][-a-zA-Z0-9_]*')
+    def offset(self, pos=None):
+        """The character offset of a token position."""
+        pos = self.pos if pos is None else pos
+        return self.tokens[pos].start if pos < len(self.tokens) else len(self.string)
 
-# tokens
-find    = Insensitive("find")               > token('find')
-count   = Insensitive("count")              > token('count')
-tag     = Insensitive("tag")                > token('tag')
-where   = Insensitive("where")              > token('where')
-AND     = Insensitive("and") | Literal("&") > token('and')
-OR      = Insensitive("or")  | Literal("|") > token('or')
-field   = InitialAlpha                      > token('field')
+class Rule(object):
+    """A named piece of the grammar, with the interface of the LEPL matchers
+    it replaced:  `parse` returns the results for a whole string or raises
+    FullFirstMatchException, and `match` yields (results, stream) for the
+    longest prefix that matches, if any does."""
+    def __init__(self, function):
+        self.function = function
+
+    def parse(self, string):
+        parser = _Parser(string)
+        try:
+            results = self.function(parser)
+        except _Fail:
+            results = None
+        if results is None or parser.pos < len(parser.tokens):
+            raise FullFirstMatchException(Stream(string, parser.offset(max(parser.pos, parser.furthest))))
+        return results
+
+    def match(self, string):
+        parser = _Parser(string)
+        try:
+            results = self.function(parser)
+        except _Fail:
+            return
+        yield results, Stream(string, parser.offset())
+
+def keyword(name):
+    return lambda p: [IrisToken(name, p.take('word', name).text)]
 
 # data types
-string  = String()
-number  = Real()                            > numerify
-list_   = CommaSeparated(string | number)   > list
+def _number(p):
+    return [numerify(p.take('number').text)]
+
+def _string(p):
+    return [unquote(p.take('string').text)]
+
+def _list(p):
+    p.take('sep', '(')
+    values = []
+    while True:
+        values.extend(_string(p) if p.peek('string') else _number(p))
+        if not p.peek('sep', ','):
+            break
+        p.take('sep')
+    p.take('sep', ')')
+    return [values]
+
+def _field(p):
+    return [IrisToken('field', p.take('word').text)]
 
 # operators
-in_oper     = Insensitive("in")     > token('in')
-equal       = Literal("=")          > token('equal')
-dblequal    = Literal("==")         > token('dblequal')
-lt          = Literal("<")          > token('lt')
-lte         = Literal("<=")         > token('lte')
-gt          = Literal(">")          > token('gt')
-gte         = Literal(">=")         > token('gte')
-
-number_operator = dblequal | equal | lte | gte | lt | gt
-string_operator = in_oper | equal | dblequal
-list_operator   = in_oper
-operator        = in_oper | number_operator
+_number_operators = {'==': 'dblequal', '=': 'equal', '<=': 'lte', '>=': 'gte', '<': 'lt', '>': 'gt'}
 
 # expressions
-with DroppedSpace():
-    field_list  = CommaSeparated(field) > list
-    num_expr    = number_operator & number
-    string_expr = string_operator & string
-    list_expr   = list_operator & list_
-    logic_expr  = field & (num_expr | string_expr | list_expr)
-    where_clause = logic_expr[1:, Separator(AND | OR, drop=False)]
-    where_expr  = where & where_clause
-    where_expr.config.auto_memoize()
+def _field_list(p):
+    p.take('sep', '(')
+    fields = _field(p)
+    while p.peek('sep', ','):
+        p.take('sep')
+        fields.extend(_field(p))
+    p.take('sep', ')')
+    return [fields]
+
+def _literal(p):
+    return _string(p) if p.peek('string') else _number(p)
+
+def _logic_expr(p):
+    """field, then a number operator and a number, in or = or == and a
+    string, in and a list, before or after and a string, or between and
+    two strings or numbers joined by and."""
+    results = _field(p)
+    if p.peek('word', 'in'):
+        results.append(IrisToken('in', p.take('word').text))
+        results.extend(_list(p) if p.peek('sep', '(') else _string(p))
+        return results
+    if p.peek('word', 'before') or p.peek('word', 'after'):
+        text = p.take('word').text
+        results.append(IrisToken(text, text))
+        return results + _string(p)
+    if p.peek('word', 'between'):
+        results.append(IrisToken('between', p.take('word').text))
+        low = _literal(p)
+        p.take('word', 'and')
+        return results + [low + _literal(p)]
+    text = p.take('operator').text
+    results.append(IrisToken(_number_operators[text], text))
+    if text in ('=', '==') and p.peek('string'):
+        results.extend(_string(p))
+    else:
+        results.extend(_number(p))
+    return results
+
+def _and_or(p):
+    if p.peek('logic'):
+        text = p.take('logic').text
+        return [IrisToken('and' if text == '&' else 'or', text)]
+    if p.peek('word', 'and') or p.peek('word', 'or'):
+        text = p.take('word').text
+        return [IrisToken(text, text)]
+    p.fail()
+
+def _where_clause(p):
+    results = _logic_expr(p)
+    while p.optional(lambda p: _and_or(p) + _logic_expr(p), results):
+        pass
+    return results
 
+def _where_expr(p):
+    return keyword('where')(p) + _where_clause(p)
 
 # statements
-with DroppedSpace():
-    find_stmt   = find & number[:1] & field_list[:1] & where_expr[:]
-    count_stmt  = count & where_expr[:]
-    tag_stmt    = tag & (string | list_) & where_expr
+def _find_stmt(p):
+    results = keyword('find')(p)
+    p.optional(_number, results)
+    p.optional(_field_list, results)
+    while p.optional(_where_expr, results):
+        pass
+    return results
+
+def _count_stmt(p):
+    results = keyword('count')(p)
+    while p.optional(_where_expr, results):
+        pass
+    return results
+
+def _tag_stmt(p):
+    results = keyword('tag')(p)
+    results.extend(_list(p) if p.peek('sep', '(') else _string(p))
+    return results + _where_expr(p)
+
+def _group_stmt(p):
+    results = keyword('group')(p) + keyword('by')(p)
+    fields = _field(p)
+    while p.peek('sep', ','):
+        p.take('sep')
+        fields.extend(_field(p))
+    results.append(fields)
+    while p.optional(_where_expr, results):
+        pass
+    return results
+
+def _histogram_stmt(p):
+    results = keyword('histogram')(p) + _field(p)
+    p.optional(lambda p: keyword('by')(p) + _number(p), results)
+    while p.optional(_where_expr, results):
+        pass
+    return results
 
-statement = find_stmt | count_stmt | tag_stmt
-statement.config.no_full_first_match()
-statement.config.auto_memoize()
+def _statement(p):
+    for rule in (_find_stmt, _count_stmt, _tag_stmt, _group_stmt, _histogram_stmt):
+        results = []
+        if p.optional(rule, results):
+            return results
+    p.fail()
+
+number = Rule(_number)
+string = Rule(_string)
+list_ = Rule(_list)
+field_list = Rule(_field_list)
+where_clause = Rule(_where_clause)
+where_expr = Rule(_where_expr)
+find_stmt = Rule(_find_stmt)
+count_stmt = Rule(_count_stmt)
+tag_stmt = Rule(_tag_stmt)
+group_stmt = Rule(_group_stmt)
+histogram_stmt = Rule(_histogram_stmt)
+statement = Rule(_statement)
 
 def parse_statement(string):
     return statement.parse(string)
@@ -126,6 +272,41 @@ def token_parser(func):
             return
     return wrapped
 
+class QueryError(ValueError):
+    """Raised for a query that parses but can't be looked up, eg. one that
+    compares a date to something that isn't one."""
+
+def date_range(value):
+    """`iris.fields.date_range`, but a QueryError for what isn't a date."""
+    span = fields.date_range(value)
+    if span is None:
+        raise QueryError('%r is not a date' % (value,))
+    return span
+
+def bounds(key, operator, value):
+    """The mongo conditions for a between, before or after.  On dates these
+    compare spans of time (see `iris.fields.date_range`), so "before" a day
+    is before it starts, "after" it is once it's over, and "between" two
+    days takes in both;  on anything else, they're plain comparisons.  A
+    value that isn't a date, or a between that ends before it starts, is a
+    QueryError."""
+    if key in fields.DATES:
+        values = value if operator == 'between' else [value]
+        ranges = [date_range(v) for v in values]
+        if operator == 'before':
+            return {'$lt': ranges[0][0]}
+        if operator == 'after':
+            return {'$gte': ranges[0][1]}
+        if ranges[-1][1] <= ranges[0][0]:
+            raise QueryError('%r is before %r' % (values[-1], values[0]))
+        return {'$gte': ranges[0][0], '$lt': ranges[-1][1]}
+    value = fields.query_value(key, value)
+    if operator == 'before':
+        return {'$lt': value}
+    if operator == 'after':
+        return {'$gt': value}
+    return {'$gte': value[0], '$lte': value[1]}
+
 class Statement(object):
 
     def parse_where_tokens(self, iterator):
@@ -159,10 +340,28 @@ class Statement(object):
                     specs.append({})
                 continue
             key, operator, value = query
-            if operator.type == 'equal':
+            # typed fields (and their aliases) are compared as their type
+            key = fields.resolve(key)
+            if key in fields.DATES and operator.type in ('equal', 'dblequal'):
+                # a day (or a month...) is equal to any time in it
+                spec.setdefault(key, {}).update(bounds(key, 'between', [value, value]))
+                continue
+            if key in fields.DATES and operator.type in ('lt', 'lte', 'gt', 'gte'):
+                # these only take numbers, which aren't dates
+                raise QueryError('compare %s with before, after or between' % key)
+            if key in fields.DATES and operator.type == 'in':
+                value = [date_range(v)[0] for v in value]
+            if operator.type in ('between', 'before', 'after'):
+                spec.setdefault(key, {}).update(bounds(key, operator.type, value))
+                continue
+            value = fields.query_value(key, value)
+            if operator.type == 'equal' or (operator.type == 'dblequal' and not isinstance(value, basestring)):
                 spec[key] = value
-            if operator.type == 'dblequal':
+            elif operator.type == 'dblequal':
+                # find candidates through the keyword index, then match them
                 spec[key] = { '$regex' : '.*%s.*' % value }
+                if key in fields.KEYWORD_FIELDS and fields.keyword_query(value):
+                    spec.setdefault('keywords', {}).setdefault('$all', []).extend(fields.keyword_query(value))
             elif operator.type in ('lt', 'lte', 'gt', 'gte', 'in'):
                 spec.setdefault(key, {}).update({ '$%s' % operator.type : value })
         # collapse the specs into an or statement
@@ -172,6 +371,21 @@ class Statement(object):
             self._spec = {'$or' : specs}
         return self._spec
 
+    @property
+    def hint(self):
+        """The index for a query that's bounded in time, or failing that one
+        that looks up keywords, or None.  Without it, mongo can pick an
+        index on one of the other fields in the query and scan through every
+        photo that matches that."""
+        spec = self.spec
+        for key in fields.DATES:
+            if isinstance(spec.get(key), dict) and not set(spec[key]) - set(['$lt', '$lte', '$gt', '$gte']):
+                # the directions backend.create_indexes indexes them in
+                return [(key, -1 if key == 'date' else 1)]
+        if 'keywords' in spec:
+            return [('keywords', 1)]
+        return None
+
 class CountStatement(Statement):
     def __init__(self, query):
         if isinstance(query, basestring):
@@ -179,6 +393,7 @@ class CountStatement(Statement):
         self.tokens = query
         self.queries = []
         self.parsed = False
+        self.parse()
 
     @token_parser
     def parse(self):
@@ -201,6 +416,7 @@ class FindStatement(Statement):
         self.fields = tuple()
         self.queries = []
         self.parsed = False
+        self.parse()
 
     @token_parser
     def parse(self):
@@ -215,9 +431,68 @@ class FindStatement(Statement):
             self.count = next
             next = eat()
         if isinstance(next, list):
-            self.fields = map(str, next)
+            self.fields = [fields.resolve(str(f)) for f in next]
             next = eat()
         assert next == 'where'
         self.queries = self.parse_where_tokens(eat)
         self.parsed = True
 
+
+class GroupStatement(Statement):
+    """`group by field, ... [where ...]`:  counts of the photos with each
+    combination of values for the fields (or the periods year, month and
+    day of their dates), most common first."""
+    order = 'count'
+
+    def __init__(self, query):
+        if isinstance(query, basestring):
+            query = group_stmt.parse(query)
+        self.tokens = query
+        self.keys = []
+        self.width = None
+        self.queries = []
+        self.parsed = False
+        self.parse()
+
+    @token_parser
+    def parse(self):
+        """Generate mongo arguments for this statement."""
+        eat = iter(list(self.tokens)).next
+        group, by = eat(), eat()
+        assert group == 'group' and by == 'by'
+        self.keys = [fields.resolve(str(f)) for f in eat()]
+        next = eat()
+        assert next == 'where'
+        self.queries = self.parse_where_tokens(eat)
+        self.parsed = True
+
+class HistogramStatement(Statement):
+    """`histogram field [by width] [where ...]`:  counts of the photos with
+    each value of the field, in order, in buckets width wide if it's
+    given."""
+    order = 'value'
+
+    def __init__(self, query):
+        if isinstance(query, basestring):
+            query = histogram_stmt.parse(query)
+        self.tokens = query
+        self.keys = []
+        self.width = None
+        self.queries = []
+        self.parsed = False
+        self.parse()
+
+    @token_parser
+    def parse(self):
+        """Generate mongo arguments for this statement."""
+        eat = iter(list(self.tokens)).next
+        histogram = eat()
+        assert histogram == 'histogram'
+        self.keys = [fields.resolve(str(eat()))]
+        next = eat()
+        if next == 'by':
+            self.width = eat()
+            next = eat()
+        assert next == 'where'
+        self.queries = self.parse_where_tokens(eat)
+        self.parsed = True
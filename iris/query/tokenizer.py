@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The single pass tokenizer under both the query parser and the completion
+lexers, and the exception they raise when a string doesn't match."""
+
+import re
+from collections import namedtuple
+
+Token = namedtuple('Token', 'kind text start end')
+
+# every character matches one of these, so finditer never skips anything
+_token = re.compile(r'''
+    (?P<whitespace>\s+)
+  | (?P<number>[-+]?(?:\d+/0*[1-9]\d*|\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<word>[a-zA-Z][-a-zA-Z0-9_]*)
+  | (?P<operator>==?|<=?|>=?)
+  | (?P<sep>[(),])
+  | (?P<logic>[&|])
+  | (?P<unknown>.)
+''', re.X | re.S)
+
+_escape = re.compile(r'\\(.)', re.S)
+
+def tokenize(string):
+    """Split a string into a list of Tokens, whitespace included.  Anything
+    that isn't part of the query language is an 'unknown' token, one
+    character at a time."""
+    return [Token(m.lastgroup, m.group(), m.start(), m.end()) for m in _token.finditer(string)]
+
+def unquote(text):
+    """The value of a string token:  the quotes and escapes removed."""
+    return _escape.sub(r'\1', text[1:-1])
+
+class Stream(object):
+    """Where in a string matching stopped.  `text` is what's left over, and
+    `location` is (line, column, offset, line text, source)."""
+    def __init__(self, string, offset):
+        self.string = string
+        self.character_offset = offset
+
+    @property
+    def text(self):
+        return self.string[self.character_offset:]
+
+    @property
+    def location(self):
+        line = self.string.count('\n', 0, self.character_offset) + 1
+        start = self.string.rfind('\n', 0, self.character_offset) + 1
+        end = self.string.find('\n', self.character_offset)
+        if end < 0:
+            end = len(self.string)
+        return (line, self.character_offset - start, self.character_offset,
+                self.string[start:end], '<string>')
+
+class FullFirstMatchException(Exception):
+    """Raised when a string can't be parsed in full;  `stream` says where it
+    went wrong."""
+    def __init__(self, stream):
+        self.stream = stream
+        Exception.__init__(self, 'The match failed at %r (line %d, character %d).' % (
+            stream.text, stream.location[0], stream.location[1] + 1))
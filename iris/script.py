@@ -6,38 +6,85 @@
 import os
 
 from cmdparse import Command, CommandParser
-from iris import backend
-
-def insert_photos(paths):
-    """Insert a single photo.  Meant to be run in a parallelized scenario."""
-    from iris.loaders.file import UnknownImageTypeException
-    collection = backend.Photo.objects.collection
-    inserter = backend.BulkInserter(collection, threshold=50)
-    for path in paths:
-        photo = backend.Photo()
-        try:
-            photo.load_file(path)
-        except UnknownImageTypeException:
-            continue
-        inserter.insert(photo)
-    inserter.flush()
+from iris import utils
+
+def insert_photos(paths, force=False, hashing=None):
+    """Insert photos at paths in this process.  Files whose fingerprint
+    matches the one stored on their document are skipped unless force is
+    True, and hashing is passed on to `ingest.Pipeline`.  Returns a
+    dictionary counting the files that were added, refreshed, skipped and
+    failed."""
+    from iris import ingest
+    return ingest.Pipeline(force=force, hashing=hashing).run(paths)
+
+def print_counts(counts):
+    """Print a summary of the counts returned by insert_photos."""
+    print '%d added, %d refreshed, %d skipped, %d failed' % (counts['added'],
+        counts['refreshed'], counts['skipped'], counts['failed'])
+
+def write_stats(path, stats, counts):
+    """Write stats (a `metrics.Stats`) and the run's counts to path as json."""
+    import json
+    report = stats.as_dict()
+    report['counts'] = counts
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
 
 class AddCommand(Command):
-    """Add a photo or directory of photos."""
+    """Add a photo or directory of photos.
+
+    Files already in iris are skipped if their size, modification time, inode
+    and device have not changed since they were last added;  use --force to
+    read them again anyway.
+
+    Progress is journaled to ~/.iris.journal as it's written, so if a run is
+    interrupted, `add --resume` with the same arguments picks up where it
+    left off.  Files that aren't images are remembered there too, and are
+    not read again until they change (or --force is given).
+
+    When run on a terminal, a progress line shows the files and megabytes
+    read per second.  --stats writes the time spent in each stage of the
+    ingest (walk, stat, read, serialize, flush...), across all processes."""
     def __init__(self):
         Command.__init__(self, "add", summary="add files or directories.")
         self.add_option('-r', '--recursive', action='store_true', default=False)
+        self.add_option('-f', '--force', action='store_true', default=False, help='re-read files that have not changed')
         self.add_option('', '--parallelize', action='store_true', default=False, help='run on more than one CPU')
+        self.add_option('', '--hash', type='choice', choices=['full', 'quick', 'none'], default='quick',
+            help='content hash files by their first 64KB and size (default), fully, or not at all')
+        self.add_option('', '--resume', action='store_true', default=False,
+            help='skip files an interrupted add already finished')
+        self.add_option('', '--stats', metavar='FILE',
+            help='write per-stage counters and latency histograms to FILE as json')
 
     def run(self, options, args):
         """Args here are a bunch of file or directory names.  We want to
         mostly defer to other functions that do the stuff for us."""
-        from iris import utils
-        paths = utils.recursive_walk(*args) if options.recursive else args
-        if options.parallelize:
-            utils.auto_parallelize(insert_photos, paths)
-            return None
-        return insert_photos(paths)
+        import sys
+        import multiprocessing
+        from iris import backend, ingest, journal, metrics
+        backend.ensure_schema()
+        paths = utils.walk(*args) if options.recursive else args
+        workers = multiprocessing.cpu_count() if options.parallelize else 0
+        hashing = options.hash if options.hash != 'none' else None
+        stats = metrics.Stats()
+        progress = metrics.Progress(stats) if sys.stderr.isatty() else None
+        log = journal.Journal()
+        log.open(resume=options.resume)
+        pipeline = ingest.Pipeline(workers=workers, force=options.force, hashing=hashing,
+            journal=log, stats=stats, progress=progress.update if progress else None)
+        try:
+            counts = pipeline.run(paths)
+        except:
+            log.close()
+            raise
+        finally:
+            if progress:
+                progress.finish()
+        log.close(finished=True)
+        print_counts(counts)
+        if options.stats:
+            write_stats(options.stats, stats, counts)
 
 class TagCommand(Command):
     """Tag one or more photos.
@@ -77,25 +124,34 @@ class ListCommand(Command):
         self.add_option('-c', '--count', action='store_true', help='count files matching spec')
 
     def run(self, options, args):
-        from iris import utils
+        from iris import backend, utils
         if options.count:
-            print '%d photos' % backend.Photo.objects.find().count()
+            print '%d photos' % backend.Photo.objects.count()
             return
-        photos = backend.Photo.objects.find(sort=[('path', backend.pymongo.ASCENDING)], paged=100)
+        # only fetch whole documents when they're all going to be printed
+        fields = {0: backend.Photo.path_fields, 1: backend.Photo.summary_fields}.get(options.verbose or 0)
+        photos = backend.Photo.objects.find({}, fields and list(fields),
+            sort=[('path', backend.pymongo.ASCENDING)], paged=100, prefetch=1)
+        # the listing is a count as well, so don't ask the server for another
+        count = 0
         if options.verbose > 1:
             import pprint
-            pprint.pprint([p.__dict__ for p in photos])
+            documents = [p.__dict__ for p in photos]
+            count = len(documents)
+            pprint.pprint(documents)
         elif options.verbose == 1:
             for photo in photos:
+                count += 1
                 moved_tag = '[%s]' % utils.bold('e', utils.red) if getattr(photo, 'moved', False) else ''
                 print '-- %s %s' % (utils.bold(photo.path), moved_tag)
                 tagstr = '  tags: %s' % ', '.join(photo.tags) if photo.tags else ''
                 print '  %dx%d, %s%s' % (photo.x, photo.y, utils.humansize(photo.size), tagstr)
         else:
             for photo in photos:
+                count += 1
                 print photo.path
         print ''
-        print '%d photos' % backend.Photo.objects.find().count()
+        print '%d photos' % count
 
 class SyncCommand(Command):
     def __init__(self):
@@ -103,7 +159,7 @@ class SyncCommand(Command):
         self.add_option('-v', '--verbose', action='count', help='increase verbosity')
 
     def run(self, options, args):
-        from iris import utils
+        from iris import backend, utils
         db = backend.get_database()
         photos = [backend.Photo(p) for p in db.photos.find()]
         def log(string):
@@ -117,16 +173,131 @@ class SyncCommand(Command):
                 continue
             if photo.moved:
                 photo.moved = None
+                photo.save()
             #photo.sync()
             log('%s' % photo.path)
 
+class DupesCommand(Command):
+    """List groups of identical files.
+
+    Files are grouped by the quick hash taken when they were added, and
+    each group is then confirmed by fully hashing just the files in it.
+    With --full, they are grouped by the full content hash instead, which
+    is only there for files added with `add --hash full`."""
+    def __init__(self):
+        Command.__init__(self, 'dupes', summary='list duplicate photos')
+        self.add_option('', '--full', action='store_true', default=False,
+            help='group by the full hash taken by add --hash full')
+
+    def run(self, options, args):
+        from iris import backend
+        field = 'hash' if options.full else 'quickhash'
+        groups = [g['paths'] for g in backend.Photo.objects.duplicates(field)]
+        if not options.full:
+            groups = confirm_duplicates(groups)
+        for paths in groups:
+            print utils.bold('-- %d copies' % len(paths))
+            for path in sorted(paths):
+                print '  %s' % path
+        print ''
+        print '%d groups of duplicates' % len(groups)
+
+def confirm_duplicates(groups):
+    """Split groups of paths that share a quick hash into groups that share
+    a full hash, dropping any that turn out to be unique."""
+    confirmed = []
+    for paths in groups:
+        by_hash = {}
+        for path in paths:
+            try:
+                by_hash.setdefault(utils.hash_file(path), []).append(path)
+            except IOError:
+                continue
+        confirmed += [p for p in by_hash.values() if len(p) > 1]
+    return confirmed
+
+class SimilarCommand(Command):
+    """Find photos that look like a given photo.
+
+    Photos are compared by a perceptual hash of their embedded thumbnail, so
+    this finds resized, re-encoded or otherwise touched-up copies as well as
+    burst shots.  The photo doesn't have to be in iris already.
+        iris similar photos/italy/IMG_0042.JPG --within 8
+    """
+    def __init__(self):
+        Command.__init__(self, 'similar', summary='find photos similar to a photo')
+        self.add_option('-w', '--within', type='int', default=6, help='maximum number of differing bits (default 6)')
+
+    def run(self, options, args):
+        from iris import backend
+        from iris.loaders import phash
+        from iris.loaders.file import UnknownImageTypeException
+        for path in args:
+            path = os.path.realpath(path)
+            stored = backend.Photo.objects.find_one({'path': path}, ['phash'])
+            if stored and stored.get('phash') is not None:
+                value = stored['phash']
+            else:
+                photo = backend.Photo()
+                try:
+                    photo.load_file(path)
+                except (UnknownImageTypeException, OSError):
+                    utils.error('could not read `%s`' % path)
+                    continue
+                value = photo.phash
+            if value is None:
+                utils.error('`%s` has no thumbnail to compare' % path)
+                continue
+            try:
+                matches = backend.Photo.objects.similar(value, options.within)
+            except ValueError, e:
+                utils.error(str(e))
+                return 1
+            print utils.bold(path)
+            for distance, photo in matches:
+                if photo.path != path:
+                    print '  %2d %s' % (distance, photo.path)
+
+class WatchCommand(Command):
+    """Watch directories and keep iris up to date as photos change.
+
+    Watches the directories given, or the 'roots' in the [iris] section of
+    the iris config file (separated by ':').  New and changed photos are
+    read once they have been quiet for --delay seconds, moves within the
+    watched directories update paths in place, and deleted photos are
+    flagged as moved.  This uses inotify, so it only works on Linux."""
+    def __init__(self):
+        Command.__init__(self, 'watch', summary='watch directories for new and changed photos')
+        self.add_option('-d', '--delay', type='float', default=2.0, help='seconds a file must be quiet before it is read (default 2)')
+        self.add_option('', '--hash', type='choice', choices=['full', 'quick', 'none'], default='quick',
+            help='content hash files by their first 64KB and size (default), fully, or not at all')
+        self.add_option('-v', '--verbose', action='count', help='increase verbosity')
+
+    def run(self, options, args):
+        from iris import backend, config, watch
+        roots = args or config.IrisConfig().roots
+        if not roots:
+            utils.error('no directories to watch;  give some or set `roots` in the config file.')
+            return 1
+        def log(string):
+            if options.verbose:
+                print string
+        hashing = options.hash if options.hash != 'none' else None
+        backend.ensure_schema()
+        try:
+            watcher = watch.Watcher(roots, delay=options.delay, hashing=hashing, log=log)
+        except OSError, e:
+            utils.error(e.strerror)
+            return 1
+        watcher.run()
+
 class FlushCommand(Command):
     def __init__(self):
         Command.__init__(self, 'flush', summary='flush iris\' database;  this cannot be reversed!')
         self.add_option('-y', '--yes', action='store_true', help='do not prompt')
 
     def run(self, options, args):
-        from iris import utils
+        from iris import backend, utils
         if options.yes:
             backend.flush()
             return
@@ -161,8 +332,7 @@ def run_with_timer(command, options, args):
     return ret
 
 def main():
-    import utils
-    import pymongo
+    import sys
     parser = CommandParser()
     parser.add_option('', '--profile', action='store_true', help='profile the running command')
     parser.add_option('', '--timer', action='store_true', help='record the time it takes to run the command')
@@ -171,6 +341,9 @@ def main():
     parser.add_command(TagCommand())
     parser.add_command(ListCommand())
     parser.add_command(SyncCommand())
+    parser.add_command(DupesCommand())
+    parser.add_command(SimilarCommand())
+    parser.add_command(WatchCommand())
     parser.add_command(FlushCommand())
     command, options, args = parser.parse_args()
     if command is None:
@@ -184,7 +357,11 @@ def main():
         return command.run(options, args)
     except KeyboardInterrupt:
         return -1
-    except pymongo.errors.AutoReconnect:
+    except Exception, e:
+        # pymongo is only imported by the commands that need the database
+        pymongo = sys.modules.get('pymongo')
+        if pymongo is None or not isinstance(e, pymongo.errors.ConnectionFailure):
+            raise
         from iris import config
         cfg = config.IrisConfig()
         host, port = cfg.host, cfg.port
@@ -14,10 +14,6 @@ from iris import backend
 from iris.utils import color, bold, white, green, red
 from iris.query import parser, completion
 
-import logging
-logger = logging.getLogger("lepl")
-logger.setLevel(logging.CRITICAL)
-
 
 def dbg(func):
     def wrapped(*args):
@@ -34,16 +30,42 @@ def print_exceptions(func):
             traceback.print_exc()
     return wrapped
 
+def print_query_errors(func):
+    def wrapped(*args):
+        try: return func(*args)
+        except parser.QueryError, e:
+            print bold("Error", red) + ': %s' % e
+    return wrapped
+
 # --- perform queries based on various parsed statements
 
 def find(query):
-    """Perform a 'find' based on a shell query."""
+    """Perform a 'find' based on a shell query.  Only the fields the query
+    asks for (and the path) are fetched, or just the path if it asks for
+    none."""
     if isinstance(query, basestring):
         query = parser.FindStatement(query)
     spec = query.spec
-    photos = backend.Photo.objects.find(spec, limit=query.count)
+    fields = list(backend.Photo.path_fields)
+    fields += [f for f in query.fields if f not in fields]
+    photos = backend.Photo.objects.find(spec, fields, limit=query.count)
+    if query.hint:
+        photos = photos.hint(query.hint)
     return photos
 
+def count(query):
+    """Count the photos matching a 'count' query."""
+    if isinstance(query, basestring):
+        query = parser.CountStatement(query)
+    return backend.Photo.objects.count(query.spec, query.hint)
+
+def group(query):
+    """Run a 'group by' or 'histogram' query.  Returns an iterator of rows,
+    the values of the query's keys followed by a count."""
+    if isinstance(query, basestring):
+        query = parser.GroupStatement(query)
+    return backend.Photo.objects.group(query.keys, query.spec, query.width, query.order)
+
 class CommandParser(cmd.Cmd):
     def __init__(self, *args, **kwargs):
         # stupid non-newstyle classes in stdlib
@@ -94,6 +116,7 @@ class CommandParser(cmd.Cmd):
         except Exception, e:
             self._handle_stream_exception(e)
 
+    @print_query_errors
     def do_find(self, params):
         tokens = self._do_statement(params, parser.find_stmt, 'find')
         if not tokens:
@@ -101,6 +124,8 @@ class CommandParser(cmd.Cmd):
         query = parser.FindStatement(tokens)
         for photo in find(query):
             print photo
+            for field in query.fields:
+                print '  %s: %r' % (field, photo[field])
 
     @print_exceptions
     def complete_find(self, text, line, *args):
@@ -110,22 +135,49 @@ class CommandParser(cmd.Cmd):
     def complete_count(self, text, line, *args):
         return completion.CountStatement(text, line).complete()
 
+    @print_query_errors
     def do_count(self, params):
         tokens = self._do_statement(params, parser.count_stmt, 'count')
         if not tokens:
             return
         query = parser.CountStatement(tokens)
-        print query.spec
+        print '%d photos' % count(query)
+
+    @print_query_errors
+    def do_group(self, params):
+        tokens = self._do_statement(params, parser.group_stmt, 'group')
+        if not tokens:
+            return
+        query = parser.GroupStatement(tokens)
+        print '  '.join([bold(key, white) for key in query.keys] + [bold('count', white)])
+        for row in group(query):
+            print '  '.join(['%s' % (value,) for value in row])
+
+    @print_query_errors
+    def do_histogram(self, params):
+        tokens = self._do_statement(params, parser.histogram_stmt, 'histogram')
+        if not tokens:
+            return
+        rows = list(group(parser.HistogramStatement(tokens)))
+        if not rows:
+            return
+        width = max([len('%s' % (value,)) for value, count in rows])
+        most = max([count for value, count in rows])
+        for value, count in rows:
+            bar = '#' * max(1, count * 50 / most)
+            print '%s  %s %d' % (('%s' % (value,)).rjust(width), bar, count)
 
     def do_tag(self, params):
-        self._do_statement(params, tag_stmt, 'tag')
+        self._do_statement(params, parser.tag_stmt, 'tag')
 
 def prompt():
+    backend.ensure_schema()
     parser = CommandParser()
     intro = "iris shell version: %s\n%s" % (bold(version, white), parser._general_help(True))
     parser.cmdloop(intro)
 
 def query(q):
+    backend.ensure_schema()
     return CommandParser().onecmd(q)
 
 if __name__ == '__main__':
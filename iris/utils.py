@@ -6,7 +6,6 @@
 import os
 from functools import wraps
 import math
-import multiprocessing
 
 # terminal color rubbish
 white,black,red,green,yellow,blue,purple = range(89,96)
@@ -32,48 +31,63 @@ def split(iterable, n):
         pivot += size
     return groups
 
-def parallelize(n, function, args):
-    """Parallelizes a function n ways.  Returns a list of results.  The
-    function must be one that takes a list of arguments and operates over
-    them all, with each item dealt with in isolation from the others."""
-    pool = multiprocessing.Pool(n)
-    arg_groups = split(args, n)
-    waiters = []
-    for i in range(n):
-        waiters.append(
-            pool.apply_async(function, (arg_groups[i],))
-        )
-    results = [r.get() for r in waiters]
-    return results
+def chunked(iterable, size):
+    """Yields lists of at most size items from iterable.  Unlike split, this
+    does not need to know the length of iterable ahead of time."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-def auto_parallelize(function, args):
-    """Auto-parallelizes a function depending on the number of cpu cores."""
-    n = multiprocessing.cpu_count()
-    return parallelize(n, function, args)
-
-# returns all paths to filenames under a list of paths
-def recursive_walk(*paths):
+def walk(*paths):
+    """Yields paths to all filenames under a list of paths as they are found.
+    Directories given in paths are never walked twice, even if one is nested
+    in another.  Unlike recursive_walk, this does not hold the full listing
+    in memory."""
     ignore = set(['.git', '.svn', '.hg'])
-    visited_files = set()
-    visited_dirs = set()
+    roots = set([p for p in paths if os.path.isdir(p)])
+    walked = set()
     for path in paths:
-        if os.path.isdir(path):
-            visited_dirs.add(path)
+        if path in roots:
+            if path in walked:
+                continue
+            walked.add(path)
             for root, dirs, files in os.walk(path):
-                pruned = []
-                for directory in dirs:
-                    d = os.path.join(root, directory)
-                    if d in visited_dirs:
-                        pruned.append(directory)
-                    if d in ignore:
-                        pruned.append(directory)
-                for d in pruned:
-                    dirs.remove(d)
+                dirs[:] = [d for d in dirs if d not in ignore
+                    and os.path.join(root, d) not in roots]
                 for f in files:
-                    visited_files.add(os.path.join(root, f))
+                    yield os.path.join(root, f)
         elif os.path.isfile(path):
-            visited_files.add(path)
-    return sorted(list(visited_files))
+            yield path
+
+# returns all paths to filenames under a list of paths
+def recursive_walk(*paths):
+    return sorted(set(walk(*paths)))
+
+def hash_file(path, prefix=None, chunk_size=4*1024*1024):
+    """Return the sha1 hex digest of the file at path, read chunk_size bytes
+    at a time.  If prefix is given, only the first prefix bytes are hashed,
+    along with the size of the file;  this is a cheap first pass that finds
+    every duplicate but can also match files that merely start the same."""
+    import hashlib
+    digest = hashlib.sha1()
+    remaining = prefix
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    if prefix is not None:
+        digest.update(str(os.path.getsize(path)))
+    return digest.hexdigest()
 
 def exclude_self(d):
     copy = dict(d)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Watch directories with Linux inotify and keep iris up to date as photos
+are added, changed, moved and removed.
+
+Events are debounced:  a file is only read once no event has arrived for it
+for `delay` seconds, so a burst of writes (or a create followed by a couple
+of modifications) turns into one refresh.  Renames within the watched trees
+update the stored 'path' of the existing documents instead of re-reading the
+files, and files that go away are flagged 'moved', as `iris sync` does."""
+
+import os
+import re
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from iris import backend, ingest
+
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+IN_NONBLOCK     = 0x00000800
+IN_CLOEXEC      = 0x00080000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+_event = struct.Struct('iIII')
+
+class Inotify(object):
+    """A minimal ctypes wrapper around the inotify system calls."""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available on this system')
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        if self._libc.inotify_rm_watch(self.fd, wd) < 0:
+            self._raise()
+
+    def read(self, timeout=None):
+        """Return a list of (wd, mask, cookie, name) events, waiting up to
+        timeout seconds (forever if None) for some to arrive."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events, pos = [], 0
+        while pos + _event.size <= len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, pos)
+            pos += _event.size
+            name = data[pos:pos+length].rstrip('\x00')
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher(object):
+    """Watches roots (and every directory under them) and feeds changed files
+    through `Photo.load_file` into a `BulkInserter`.  Files already under the
+    roots when watching starts are left alone;  use `iris add -r` for those.
+    Directories that are created or moved in later are read in full."""
+    def __init__(self, roots, delay=2.0, hashing='quick', threshold=50, log=None):
+        self.roots = [os.path.realpath(r) for r in roots]
+        self.delay = delay
+        self.hashing = hashing
+        self.log = log or (lambda string: None)
+        self.inotify = Inotify()
+        backend.Photo.objects._init()
+        self.collection = backend.Photo.objects.collection
+        self.inserter = backend.BulkInserter(self.collection, threshold=threshold, unique_attr='path')
+        # wd -> directory path
+        self.directories = {}
+        # path -> (action, time of last event);  action is 'update' or 'delete'
+        self.pending = {}
+        # cookie -> (path, isdir, time) for moves we've only seen half of
+        self.moves = {}
+
+    def watch_tree(self, top, queue=False):
+        """Watch top and all directories under it.  If queue is True, files
+        found along the way are queued to be read."""
+        now = time.time()
+        for root, dirs, files in os.walk(top):
+            try:
+                self.directories[self.inotify.add_watch(root)] = root
+            except OSError, e:
+                self.log('cannot watch %s: %s' % (root, e.strerror))
+                dirs[:] = []
+                continue
+            if queue:
+                for name in files:
+                    self.queue(os.path.join(root, name), 'update', now)
+
+    def queue(self, path, action, now):
+        self.pending[path] = (action, now)
+
+    def unwatch_tree(self, top):
+        """Stop watching top and the directories under it, eg. once they've
+        been moved out of the roots."""
+        prefix = top + os.sep
+        for wd, path in self.directories.items():
+            if path == top or path.startswith(prefix):
+                del self.directories[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    # the kernel drops watches on directories that are gone
+                    pass
+
+    def run(self):
+        """Watch the roots until interrupted."""
+        for root in self.roots:
+            self.watch_tree(root)
+            self.log('watching %s' % root)
+        try:
+            while True:
+                self.poll()
+        finally:
+            self.inotify.close()
+
+    def poll(self, timeout=None):
+        """Wait for and handle one batch of events, then process whatever
+        has been quiet for long enough.  Waits at most timeout seconds for
+        events, or forever if it's None and nothing is pending."""
+        if self.pending or self.moves:
+            timeout = self.delay / 2.0
+        for event in self.inotify.read(timeout):
+            self.handle(event, time.time())
+        self.process(time.time())
+
+    def handle(self, event, now):
+        wd, mask, cookie, name = event
+        if mask & IN_Q_OVERFLOW:
+            self.log('inotify queue overflowed;  run `iris add -r` to catch up')
+            return
+        directory = self.directories.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.directories[wd]
+            return
+        path = os.path.join(directory, name) if name else directory
+        isdir = bool(mask & IN_ISDIR)
+        if mask & IN_MOVED_FROM:
+            self.moves[cookie] = (path, isdir, now)
+        elif mask & IN_MOVED_TO:
+            if cookie in self.moves:
+                self.rename(self.moves.pop(cookie)[0], path, isdir, now)
+            elif isdir:
+                self.watch_tree(path, queue=True)
+            else:
+                self.queue(path, 'update', now)
+        elif isdir:
+            if mask & IN_CREATE:
+                self.watch_tree(path, queue=True)
+        elif mask & IN_CLOSE_WRITE:
+            self.queue(path, 'update', now)
+        elif mask & IN_DELETE:
+            self.queue(path, 'delete', now)
+
+    def rename(self, old, new, isdir, now):
+        """Something moved from old to new within the watched trees;  update
+        the stored paths rather than reading anything again."""
+        self.log('%s -> %s' % (old, new))
+        if not isdir:
+            if old in self.pending:
+                self.pending[new] = self.pending.pop(old)
+            self.collection.remove({'path': new})
+            result = self.collection.update({'path': old}, {'$set': {'path': new}})
+            backend.bump_generation(self.collection)
+            if not result or not result.get('updatedExisting'):
+                self.queue(new, 'update', now)
+            return
+        prefix = old + os.sep
+        for wd, path in self.directories.items():
+            if path == old or path.startswith(prefix):
+                self.directories[wd] = new + path[len(old):]
+        for path in [p for p in self.pending if p.startswith(prefix)]:
+            self.pending[new + path[len(old):]] = self.pending.pop(path)
+        spec = {'path': {'$regex': '^' + re.escape(prefix)}}
+        for document in self.collection.find(spec, ['path']):
+            path = new + document['path'][len(old):]
+            self.collection.update({'_id': document['_id']}, {'$set': {'path': path}})
+        backend.bump_generation(self.collection)
+
+    def process(self, now):
+        """Read files and flag deletions that have been quiet for `delay`
+        seconds, and treat moves that never got their other half as files
+        leaving the watched trees.  Counts cached by `Manager.count` (in a
+        shell, say) are invalidated by anything that's written."""
+        wrote = False
+        for cookie, (path, isdir, when) in self.moves.items():
+            if now - when >= self.delay:
+                del self.moves[cookie]
+                if isdir:
+                    self.unwatch_tree(path)
+                    spec = {'path': {'$regex': '^' + re.escape(path + os.sep)}}
+                    self.collection.update(spec, {'$set': {'moved': True}}, multi=True)
+                    wrote = True
+                else:
+                    self.queue(path, 'delete', when)
+        ready = [p for p, (action, when) in self.pending.items() if now - when >= self.delay]
+        if not ready:
+            if wrote:
+                backend.bump_generation(self.collection)
+            return
+        for path in sorted(ready):
+            action, when = self.pending.pop(path)
+            if action == 'delete':
+                self.log('%s [gone]' % path)
+                self.collection.update({'path': path}, {'$set': {'moved': True}})
+                wrote = True
+                continue
+            try:
+                stat = os.stat(path)
+                document = ingest.extract(path, stat, self.hashing)
+            except Exception, e:
+                # gone again, or still being written;  the next event for
+                # it will queue it again
+                self.log('%s [failed: %s]' % (path, e))
+                continue
+            if document is not None:
+                self.log(path)
+                self.inserter.insert(document)
+        # the inserter notes its own writes
+        self.inserter.flush()
+        if wrote:
+            backend.bump_generation(self.collection)
@@ -31,12 +31,12 @@ setup(
     author_email='jmoiron@jmoiron.net',
     url='http://github.com/jmoiron/iris',
     license='MIT',
-    packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+    packages=find_packages(exclude=['ez_setup', 'examples', 'tests', 'benchmarks']),
     include_package_data=True,
     zip_safe=False,
     test_suite="tests",
     # -*- Extra requirements: -*-
-    install_requires=['lepl', 'pymongo',],
+    install_requires=['pymongo',],
     entry_points="""
     # -*- Entry points: -*-
     """,
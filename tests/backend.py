@@ -58,6 +58,152 @@ class BulkInserterTest(TestCase):
         self.assertEquals(inserter._inserts, 100)
         self.assertEquals(collection.find({'foo':'bar'}).count(), 200)
 
+    def test_duplicate_insertion(self):
+        collection = self.db[self.collection]
+        inserter = backend.BulkInserter(collection, threshold=50, unique_attr='value')
+        inserter.insert({'value': '1', 'foo': 'bar'}, {'value': '2'}, {'value': '1', 'foo': 'baz'})
+        inserter.flush()
+        # only the last document with a given unique value is written
+        self.assertEquals(collection.find().count(), 2)
+        self.assertEquals(collection.find_one({'value': '1'})['foo'], 'baz')
+        self.assertEquals(inserter._inserts, 2)
+        self.assertEquals(inserter._updates, 0)
+
+    def test_model_insertion(self):
+        """Models use the inserter's unique_attr, or their own."""
+        collection = self.db[self.collection]
+        collection.insert([{'value': '1'}, {'other': 'a'}])
+        inserter = backend.BulkInserter(collection, threshold=50, unique_attr='value')
+        inserter.insert(backend.Model(value='1', foo='bar'))
+        inserter.insert(backend.Model(value='2', other='a', _unique_attr='other'))
+        inserter.flush()
+        self.assertEquals(collection.find().count(), 2)
+        self.assertEquals(collection.find_one({'value': '1'})['foo'], 'bar')
+        self.assertEquals(collection.find_one({'other': 'a'})['value'], '2')
+        self.assertFalse('_unique_attr' in collection.find_one({'other': 'a'}))
+
+    def test_background_insertion(self):
+        collection = self.db[self.collection]
+        self._collision_setup()
+        flushed = []
+        inserter = backend.BulkInserter(collection, threshold=30, unique_attr='value',
+            background=True, max_pending=1, on_flush=lambda d: flushed.append(len(d)))
+        inserter.insert(*[{'value': str(i), 'foo': 'bar'} for i in xrange(1, 200+1)])
+        # flush waits for the writer to finish with everything
+        inserter.flush()
+        self.assertEquals(sum(flushed), 200)
+        self.assertEquals(inserter._updates, 100)
+        self.assertEquals(inserter._inserts, 100)
+        self.assertEquals(collection.find({'foo':'bar'}).count(), 200)
+        inserter.close()
+
+    def test_lingering_flush(self):
+        import time
+        collection = self.db[self.collection]
+        inserter = backend.BulkInserter(collection, threshold=100, background=True,
+            max_linger=0.05)
+        write_batch = inserter._write_batch
+        def slow_write(batch):
+            time.sleep(0.3)
+            write_batch(batch)
+        inserter._write_batch = slow_write
+        inserter.insert(*[{'value': str(i)} for i in xrange(10)])
+        # let the writer pick the lingering documents up and start on them
+        time.sleep(0.15)
+        inserter.flush()
+        self.assertEquals(collection.find().count(), 10)
+        inserter.close()
+
+    def test_byte_budget(self):
+        collection = self.db[self.collection]
+        inserter = backend.BulkInserter(collection, threshold=1000, max_bytes=10000)
+        for i in xrange(25):
+            inserter.insert({'value': str(i), 'padding': 'x' * 1000})
+        # roughly every ten documents fill the budget
+        self.assertEquals(collection.find().count(), 20)
+        self.assertEquals(inserter.total, 5)
+        inserter.flush()
+        self.assertEquals(inserter.bytes, 0)
+
+    def test_sampled_sizes(self):
+        """Only a sample of documents is encoded to measure them."""
+        BSON = backend.bson.BSON
+        original, encode, encoded = BSON.__dict__['encode'], BSON.encode, []
+        def counting(document, *args, **kwargs):
+            encoded.append(document)
+            return encode(document, *args, **kwargs)
+        inserter = backend.BulkInserter(self.db[self.collection], threshold=1000, max_bytes=10 ** 6)
+        BSON.encode = staticmethod(counting)
+        try:
+            for i in xrange(backend.SIZE_SAMPLE * 2):
+                inserter.insert({'value': str(i), 'padding': 'x' * 1000})
+        finally:
+            BSON.encode = original
+        self.assertEquals(len(encoded), 2)
+        self.assertEquals(inserter.bytes, len(encode(encoded[0])) * backend.SIZE_SAMPLE * 2)
+        inserter.flush()
+
+    def test_diff_updates(self):
+        collection = self.db[self.collection]
+        self._collision_setup()
+        inserter = backend.BulkInserter(collection, threshold=50, unique_attr='value', diff_updates=True,
+            diff_keys=['foo'])
+        inserter.insert(*[{'value': str(i), 'foo': 'bar'} for i in xrange(1, 200+1)])
+        inserter.flush()
+        self.assertEquals(inserter._inserts, 100)
+        self.assertEquals(inserter._updates, 100)
+        self.assertEquals(collection.find({'foo':'bar'}).count(), 200)
+        # writing the same documents again changes nothing, so writes nothing
+        inserter.insert(*[{'value': str(i), 'foo': 'bar'} for i in xrange(1, 200+1)])
+        inserter.flush()
+        self.assertEquals(inserter._unchanged, 200)
+        self.assertEquals(inserter._updates, 100)
+        # diff_keys missing from the new document are removed, and fields
+        # that aren't compared are left alone
+        collection.update({'value': '1'}, {'$set': {'other': 1}})
+        inserter.insert({'value': '1'})
+        inserter.flush()
+        self.assertEquals(sorted(collection.find_one({'value': '1'}).keys()), ['_id', 'other', 'value'])
+
+class DiffTest(TestCase):
+    def test_diff(self):
+        old = {'_id': 1, 'path': 'a', 'size': 10, 'hash': 'x'}
+        self.assertEquals(backend.diff(old, dict(old)), {})
+        self.assertEquals(backend.diff(old, {'path': 'a', 'size': 11}),
+            {'$set': {'size': 11}, '$unset': {'hash': 1}})
+        # only the given keys are looked at
+        self.assertEquals(backend.diff(old, {'path': 'b'}, ['path']), {'$set': {'path': 'b'}})
+
+    def test_model_changes(self):
+        photo = backend.Photo({'path': 'a'})
+        self.assertEquals(photo.changes(), None)
+        photo = backend.Photo({'_id': 1, 'path': 'a', 'moved': True})
+        self.assertEquals(photo.changes(), {})
+        photo.moved = True
+        self.assertEquals(photo.changes(), {})
+        photo.moved = None
+        photo.size = 10
+        del photo['path']
+        self.assertEquals(photo.changes(), {'$set': {'moved': None, 'size': 10}, '$unset': {'path': 1}})
+        photo.mark_clean()
+        self.assertEquals(photo.changes(), {})
+
+class BatchControllerTest(TestCase):
+    def test_sizing(self):
+        controller = backend.BatchController(initial=10, target=1.0, maximum=1000)
+        # quick flushes grow the batches, but never more than double them
+        controller.observe(0.01, 10)
+        self.assertEquals(controller.size, 20)
+        for i in range(10):
+            controller.observe(0.01, controller.size)
+        self.assertEquals(controller.size, 1000)
+        # slow ones shrink them
+        for i in range(10):
+            controller.observe(5.0, controller.size)
+        self.assertTrue(controller.size < 1000)
+        controller.observe(0, 0)
+        self.assertTrue(controller.size >= controller.minimum)
+
 class PagerTest(TestCase):
     def __init__(self, *args):
         super(PagerTest, self).__init__(*args)
@@ -127,3 +273,236 @@ class PagerTest(TestCase):
         self.assertEquals(item_list[0]['value'], 1000)
         self.assertEquals(item_list[-1]['value'], 501)
 
+    def test_paging_cursor_ties(self):
+        """Test that paging by range on a key with lots of ties, which has to
+        fall back to _id to keep its place, sees every document exactly once
+        and in the same order as a plain find."""
+        import pymongo
+        collection = self.db[self.collection]
+        cursor = backend.Pager(collection, threshold=100, range_keys=('_id', 'group'))
+        collection.update({}, {'$set': {'group': 1}}, multi=True)
+        collection.update({'value': {'$gt': 1000}}, {'$set': {'group': 0}}, multi=True)
+        sort = [('group', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+        items = cursor.find({'value': {'$lte': 1500}}, ['value'], sort=[('group', pymongo.ASCENDING)])
+        item_list = list(items)
+        expected = list(collection.find({'value': {'$lte': 1500}}, ['value'], sort=sort))
+        self.assertEquals(item_list, expected)
+        self.assertEquals(len(set([i['_id'] for i in item_list])), 1500)
+        # 'group' was only fetched to page on
+        self.assertEquals(sorted(item_list[0].keys()), ['_id', 'value'])
+
+    def test_paging_cursor_sparse(self):
+        """Test that paging on a key some documents don't have, or have as
+        null or another type, still sees all of them in order."""
+        import pymongo
+        collection = self.db[self.collection]
+        cursor = backend.Pager(collection, threshold=100)
+        collection.update({'value': {'$lte': 1000}}, {'$set': {'tag': 'a'}}, multi=True)
+        collection.update({'value': {'$gt': 1200, '$lte': 1300}}, {'$set': {'tag': None}}, multi=True)
+        collection.update({'value': {'$gt': 1300, '$lte': 1400}}, {'$set': {'tag': 5}}, multi=True)
+        for direction in (pymongo.ASCENDING, pymongo.DESCENDING):
+            sort = [('tag', direction), ('_id', direction)]
+            items = list(cursor.find({'value': {'$lte': 1500}}, ['value'], sort=[('tag', direction)]))
+            expected = list(collection.find({'value': {'$lte': 1500}}, ['value'], sort=sort))
+            self.assertEquals(len(items), 1500)
+            self.assertEquals(items, expected)
+
+    def test_paging_cursor_prefetch(self):
+        """Test that prefetching pages gives the same results, and that
+        stopping early stops the prefetching thread."""
+        import threading
+        collection = self.db[self.collection]
+        cursor = backend.Pager(collection, threshold=100, prefetch=2)
+        items = cursor.find({'value': {'$lte': 1500}})
+        self.assertEquals(list(items), list(backend.Pager(collection, threshold=100).find({'value': {'$lte': 1500}})))
+        self.assertEquals(items._num_pages, 15)
+        threads = threading.active_count()
+        items = cursor.find()
+        for i, item in enumerate(items):
+            if i == 150:
+                break
+        del item, items
+        self.assertEquals(threading.active_count(), threads)
+
+class Counted(backend.Model):
+    _collection = 'CountTest'
+
+class CountTest(TestCase):
+    def __init__(self, *args):
+        super(CountTest, self).__init__(*args)
+        self.db = backend.get_database()
+        self.collection = Counted._collection
+
+    def setUp(self):
+        self.db[self.collection].insert([{'value': i} for i in xrange(100)])
+
+    def tearDown(self):
+        self.db.drop_collection(self.collection)
+
+    def test_cached_counts(self):
+        manager = backend.Manager(Counted)
+        spec = {'value': {'$gte': 50, '$lt': 80}}
+        self.assertEquals(manager.count(), 100)
+        self.assertEquals(manager.count(spec), 30)
+        # without a write this process knows of, the cached count stands
+        self.db[self.collection].insert({'value': 60})
+        self.assertEquals(manager.count({'value': {'$lt': 80, '$gte': 50}}), 30)
+        Counted(value=61).save()
+        self.assertEquals(manager.count(spec), 32)
+        inserter = backend.BulkInserter(self.db[self.collection], threshold=10)
+        inserter.insert({'value': 62})
+        inserter.flush()
+        self.assertEquals(manager.count(spec), 33)
+        self.assertEquals(manager.count(), 103)
+        self.assertEquals(manager.count(spec, [('_id', 1)]), 33)
+
+class SchemaTest(TestCase):
+    def test_migrate(self):
+        db = backend.get_database()
+        db.drop_collection('meta')
+        self.assertTrue(backend.migrate(db))
+        self.assertTrue('keywords_1' in db.photos.index_information())
+        self.assertEquals(db.meta.find_one({'_id': 'schema'})['version'], backend.SCHEMA_VERSION)
+        # nothing to do until the schema version changes
+        self.assertFalse(backend.migrate(db))
+
+    def test_backfill(self):
+        import datetime
+        collection = backend.get_database()['BackfillTest']
+        try:
+            collection.insert([
+                {'path': '/a', 'tags': ['Paris'], 'exif': {'Photo': {'ISOSpeedRatings': 400,
+                    'DateTimeOriginal': datetime.datetime(2011, 5, 1)}}},
+                {'path': '/b', 'caption': 'Rome', 'fingerprint': [1, 2, 3, 1300000000 * 10**9]},
+                {'path': '/c', 'date': datetime.datetime(2012, 1, 1), 'keywords': []},
+            ])
+            self.assertEquals(backend.backfill(collection), 2)
+            a = collection.find_one({'path': '/a'})
+            self.assertEquals((a['iso'], a['date']), (400, datetime.datetime(2011, 5, 1)))
+            self.assertEquals(a['keywords'], ['pa', 'par', 'pari', 'paris'])
+            b = collection.find_one({'path': '/b'})
+            self.assertEquals(b['date'], datetime.datetime.fromtimestamp(1300000000))
+            self.assertEquals(b['keywords'], ['ro', 'rom', 'rome'])
+            self.assertEquals(backend.backfill(collection), 0)
+        finally:
+            backend.get_database().drop_collection('BackfillTest')
+
+class GroupTest(TestCase):
+    def __init__(self, *args):
+        super(GroupTest, self).__init__(*args)
+        self.db = backend.get_database()
+        self.collection = 'GroupTest'
+
+    def setUp(self):
+        import datetime
+        documents = []
+        for i in xrange(120):
+            document = {'iso': [100, 200, 400, 800, 1600][i % 5], 'lens': ['EF50mm', 'EF85mm', None][i % 3]}
+            if i % 4:
+                document['date'] = datetime.datetime(2011, 1 + i % 3, 1 + i % 28)
+            documents.append(document)
+        self.db[self.collection].insert(documents)
+
+    def tearDown(self):
+        self.db.drop_collection(self.collection)
+
+    def test_group(self):
+        manager = backend.Manager(Grouped)
+        rows = list(manager.group(['lens']))
+        self.assertEquals(sorted(rows), [(None, 40), ('EF50mm', 40), ('EF85mm', 40)])
+        rows = list(manager.group(['iso'], {'lens': 'EF50mm'}, width=500, order='value'))
+        self.assertEquals(rows, [(0, 24), (500, 8), (1500, 8)])
+        rows = list(manager.group(['month', 'lens'], {'iso': {'$gte': 400}}))
+        self.assertEquals(sum([row[-1] for row in rows]), 54)
+        self.assertEquals(rows[0][0], '2011-01')
+        self.assertEquals(rows, sorted(rows, key=lambda row: -row[-1]))
+
+    def test_group_here(self):
+        """Grouping without the server gets the same rows as with it."""
+        manager = backend.Manager(Grouped)
+        for args in ((['lens', 'year'],), (['iso'], {'lens': 'EF50mm'}, 300, 'value'), (['day'],)):
+            self.assertEquals(list(manager.group(*args)), list(manager.group(*args, **{'server': False})))
+
+class Grouped(backend.Model):
+    _collection = 'GroupTest'
+
+class Stored(backend.Model):
+    _collection = 'ManagerTest'
+
+class ManagerTest(TestCase):
+    def __init__(self, *args):
+        super(ManagerTest, self).__init__(*args)
+        self.db = backend.get_database()
+        self.collection = Stored._collection
+
+    def tearDown(self):
+        self.db.drop_collection(self.collection)
+
+    def test_duplicates(self):
+        self.db[self.collection].insert([
+            {'path': 'a', 'hash': 'x', 'quickhash': 'q'},
+            {'path': 'b', 'hash': 'x', 'quickhash': 'q'},
+            {'path': 'c', 'hash': 'x', 'quickhash': 'r'},
+            {'path': 'd', 'hash': 'y', 'quickhash': 'r'},
+            {'path': 'e', 'hash': 'z'},
+            {'path': 'f'},
+        ])
+        manager = backend.Manager(Stored)
+        groups = manager.duplicates('hash')
+        self.assertEquals([(g['_id'], g['count'], sorted(g['paths'])) for g in groups],
+            [('x', 3, ['a', 'b', 'c'])])
+        groups = manager.duplicates('quickhash')
+        self.assertEquals(sorted([sorted(g['paths']) for g in groups]), [['a', 'b'], ['c', 'd']])
+
+    def test_similar(self):
+        from iris.loaders import phash
+        value = 0x0123456789abcdef
+        hashes = {
+            'same': value,
+            'near': value ^ 0x8000000100000011,
+            'spread': value ^ 0x0007000700070007,
+            'far': value ^ 0xffffffff00000000,
+        }
+        self.db[self.collection].insert([{'path': path, 'phash': phash.to_signed(h),
+            'phash_bands': phash.bands(h)} for path, h in hashes.items()])
+        manager = backend.Manager(Stored)
+        matches = manager.similar(value, distance=6)
+        self.assertEquals([(d, p.path) for d, p in matches], [(0, 'same'), (4, 'near')])
+        self.assertTrue(isinstance(matches[0][1], Stored))
+        matches = manager.similar(phash.to_signed(value), distance=15)
+        self.assertEquals([(d, p.path) for d, p in matches], [(0, 'same'), (4, 'near'), (12, 'spread')])
+
+    def test_confirm_duplicates(self):
+        """Groups sharing a quick hash are split by their full hashes."""
+        import os, shutil, tempfile
+        from iris.script import confirm_duplicates
+        directory = tempfile.mkdtemp()
+        try:
+            paths = {}
+            for name, contents in [('a', 'one'), ('b', 'one'), ('c', 'two'), ('d', 'three'), ('e', 'three')]:
+                paths[name] = os.path.join(directory, name)
+                with open(paths[name], 'w') as f:
+                    f.write(contents)
+            groups = [[paths[n] for n in 'abc'], [paths[n] for n in 'de'] + [os.path.join(directory, 'gone')]]
+            confirmed = confirm_duplicates(groups)
+            self.assertEquals(sorted([sorted(g) for g in confirmed]),
+                [[paths['a'], paths['b']], [paths['d'], paths['e']]])
+        finally:
+            shutil.rmtree(directory)
+
+
+class FingerprintTest(TestCase):
+    def test_fingerprint_changes(self):
+        """Test that a file's fingerprint only changes when the file does."""
+        import os, tempfile
+        handle, path = tempfile.mkstemp()
+        os.write(handle, 'iris')
+        os.close(handle)
+        try:
+            first = backend.fingerprint(os.stat(path))
+            self.assertEquals(first, backend.fingerprint(os.stat(path)))
+            self.assertEquals(first[2], 4)
+            os.utime(path, (0, 0))
+            self.assertNotEquals(first, backend.fingerprint(os.stat(path)))
+        finally:
+            os.unlink(path)
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""iris benchmark tests;  a tiny run of every benchmark, in memory."""
+
+import os
+import json
+import tempfile
+from unittest import TestCase
+from benchmarks import run
+
+class RunTest(TestCase):
+    def test_run(self):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        try:
+            self.assertEquals(run.main(['--count', '20', '--size', '4096', '--repeat', '1',
+                '--out', path]), 0)
+            with open(path) as f:
+                report = json.load(f)
+        finally:
+            os.unlink(path)
+        self.assertEquals(sorted(report['results']), sorted(run.BENCHMARKS))
+        self.assertEquals(report['results']['add']['items'], 20)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""iris typed field tests."""
+
+import datetime
+from unittest import TestCase
+from iris import fields
+
+class Meta(object):
+    def __init__(self, tags):
+        self.tags = tags
+    def raw(self, key):
+        return self.tags.get(key)
+
+class FieldsTest(TestCase):
+    def test_conversions(self):
+        self.assertEquals(fields.to_float('1/250'), 0.004)
+        self.assertEquals(fields.to_float('1/0'), None)
+        self.assertEquals(fields.to_float(['2.8']), 2.8)
+        self.assertEquals(fields.to_int('399.6'), 400)
+        self.assertEquals(fields.to_string(' Canon\x00 '), 'Canon')
+        self.assertEquals(fields.to_datetime('2011:05:01 12:30:00'),
+            datetime.datetime(2011, 5, 1, 12, 30))
+
+    def test_extract(self):
+        meta = Meta({
+            'Exif.Image.Make': 'Canon',
+            'Exif.Image.Model': 'Canon EOS 5D',
+            'Exif.Photo.ISOSpeedRatings': '400',
+            'Exif.Photo.ShutterSpeedValue': '8',
+            'Exif.Photo.FNumber': '28/10',
+        })
+        self.assertEquals(fields.extract(meta), {'camera': 'Canon EOS 5D',
+            'iso': 400, 'shutter': 2 ** -8, 'fstop': 2.8})
+        meta = Meta({'Exif.Image.Make': 'NIKON CORPORATION', 'Exif.Image.Model': 'D700'})
+        self.assertEquals(fields.extract(meta), {'camera': 'NIKON CORPORATION D700'})
+
+    def test_stored_meta(self):
+        document = {'exif': {'Image': {'Model': 'D700'},
+            'Photo': {'ExposureTime': '1/250', 'FNumber': '5.6',
+                'DateTimeOriginal': datetime.datetime(2011, 5, 1)}}}
+        self.assertEquals(fields.extract(fields.StoredMeta(document)), {'camera': 'D700',
+            'shutter': 0.004, 'fstop': 5.6, 'taken_at': datetime.datetime(2011, 5, 1)})
+        self.assertEquals(fields.StoredMeta({'exif': {'Photo': '(bin)'}}).raw('Exif.Photo.FNumber'), None)
+
+    def test_resolve(self):
+        self.assertEquals(fields.resolve('Aperture'), 'fstop')
+        self.assertEquals(fields.resolve('ISO'), 'iso')
+        self.assertEquals(fields.resolve('caption'), 'caption')
+        self.assertEquals(fields.query_value('taken_at', '2011-05-01'), datetime.datetime(2011, 5, 1))
+        self.assertEquals(fields.query_value('caption', '10'), '10')
+
+    def test_keywords(self):
+        document = {'tags': ['Italy', 'beach'], 'caption': u'Café at the beach', 'lens': 'EF50mm f/1.4'}
+        keywords = fields.keywords(document)
+        for keyword in ('it', 'ita', 'italy', 'be', 'beach', u'caf', u'café', 'ef', 'ef50mm'):
+            self.assertTrue(keyword in keywords, keyword)
+        self.assertFalse('a' in keywords)
+        self.assertEquals(keywords, sorted(set(keywords)))
+        self.assertEquals(fields.keywords({'caption': 'a' * 20}), ['a' * n for n in range(2, 13)])
+        self.assertEquals(fields.keyword_query('At the Beach, a beach'), ['at', 'the', 'beach'])
+        self.assertEquals(fields.keyword_query('photographically'), ['photographic'])
+
+    def test_periods(self):
+        date = datetime.datetime(2011, 5, 6, 10, 30)
+        self.assertEquals([fields.period(p, date) for p in fields.PERIODS], [2011, 201105, 20110506])
+        self.assertEquals([fields.period_label(p, fields.period(p, date)) for p in fields.PERIODS],
+            ['2011', '2011-05', '2011-05-06'])
+        self.assertEquals(fields.period('month', None), None)
+
+    def test_date_range(self):
+        d = datetime.datetime
+        self.assertEquals(fields.date_range('2011'), (d(2011, 1, 1), d(2012, 1, 1)))
+        self.assertEquals(fields.date_range('2011-12'), (d(2011, 12, 1), d(2012, 1, 1)))
+        self.assertEquals(fields.date_range('2011-05-06'), (d(2011, 5, 6), d(2011, 5, 7)))
+        self.assertEquals(fields.date_range('2011:05:06 10:00:00'),
+            (d(2011, 5, 6, 10), d(2011, 5, 6, 10, 0, 1)))
+        start, end = fields.date_range('yesterday')
+        self.assertEquals(end - start, datetime.timedelta(days=1))
+        self.assertEquals(end.date(), datetime.date.today())
+        self.assertEquals(fields.date_range('last tuesday'), None)
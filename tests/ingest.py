@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""iris ingest pipeline tests."""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from iris import backend, ingest
+
+def load_file(photo, path, stat=None, keys=None, stats=None):
+    """Stands in for reading a photo;  files named 'bad*' can't be read, and
+    'junk*' files aren't images."""
+    from iris.loaders.file import UnknownImageTypeException
+    if os.path.basename(path).startswith('bad'):
+        raise IOError('%s vanished' % path)
+    if os.path.basename(path).startswith('junk'):
+        raise UnknownImageTypeException(path)
+    photo.path = os.path.realpath(path)
+    photo.size = stat.st_size
+    photo.fingerprint = backend.fingerprint(stat)
+
+class PipelineTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for name in ['good%d' % i for i in range(6)] + ['bad%d' % i for i in range(3)] + \
+                ['junk%d' % i for i in range(2)]:
+            self.paths.append(os.path.join(self.directory, name))
+            with open(self.paths[-1], 'w') as f:
+                f.write(name)
+        self.objects, self.load_file = backend.Photo.objects, backend.Photo.load_file
+        backend.Photo.objects = backend.Manager(Photo)
+        backend.Photo.load_file = load_file
+
+    def tearDown(self):
+        backend.get_database().drop_collection(Photo._collection)
+        backend.Photo.objects, backend.Photo.load_file = self.objects, self.load_file
+        shutil.rmtree(self.directory)
+
+    def check_run(self, workers):
+        counts = ingest.Pipeline(workers=workers, linger=0.1).run(self.paths)
+        self.assertEquals(counts, dict(added=6, refreshed=0, skipped=0, failed=5))
+        self.assertEquals(backend.Photo.objects.collection.count(), 6)
+
+    def test_failures(self):
+        """Files that raise while they're read fail on their own."""
+        self.check_run(0)
+
+    def test_known_failures(self):
+        """Files the journal says weren't images are skipped until they
+        change, unless the run is forced;  ones that couldn't be read are
+        tried again."""
+        from iris.journal import Journal
+        journal = Journal(os.path.join(self.directory, 'journal'))
+        journal.open()
+        ingest.Pipeline(journal=journal).run(self.paths)
+        counts = ingest.Pipeline(journal=journal).run(self.paths)
+        self.assertEquals(counts, dict(added=0, refreshed=0, skipped=8, failed=3))
+        counts = ingest.Pipeline(journal=journal, force=True).run(self.paths)
+        self.assertEquals(counts, dict(added=0, refreshed=6, skipped=0, failed=5))
+        journal.close()
+
+    def test_failures_in_workers(self):
+        """...and don't stop an extractor process, which would leave the
+        writer waiting on it forever."""
+        self.check_run(2)
+
+class Photo(backend.Photo):
+    _collection = 'PipelineTest'
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""iris ingest journal tests."""
+
+import os
+import tempfile
+from unittest import TestCase
+from iris.journal import Journal
+
+class JournalTest(TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_resume(self):
+        journal = Journal(self.path)
+        journal.open()
+        journal.record(completed=[('/a.jpg', [1, 2, 3, 4])], failed=[('/b.txt', [1, 5, 9, 4])])
+        journal.close()
+        # an interrupted run left its progress behind
+        journal = Journal(self.path)
+        journal.open(resume=True)
+        self.assertTrue(journal.done('/a.jpg'))
+        self.assertFalse(journal.done('/b.txt'))
+        self.assertTrue(journal.known_failure('/b.txt', [1, 5, 9, 4]))
+        self.assertFalse(journal.known_failure('/b.txt', [1, 5, 10, 4]))
+        journal.record(failed=[('/c.txt', [1, 6, 9, 4])])
+        journal.close(finished=True)
+        # finished paths are forgotten, failures are kept
+        journal = Journal(self.path)
+        journal.open(resume=True)
+        self.assertFalse(journal.done('/a.jpg'))
+        self.assertTrue(journal.known_failure('/b.txt', [1, 5, 9, 4]))
+        self.assertTrue(journal.known_failure('/c.txt', [1, 6, 9, 4]))
+        # and forgotten once they succeed
+        journal.record(completed=[('/b.txt', [1, 5, 10, 4])])
+        journal.close(finished=True)
+        journal.open()
+        self.assertFalse(journal.known_failure('/b.txt', [1, 5, 9, 4]))
+        journal.close()
+
+    def test_fresh(self):
+        journal = Journal(self.path)
+        journal.open()
+        journal.record(completed=[('/a.jpg', [1, 2, 3, 4])])
+        journal.close()
+        journal = Journal(self.path)
+        journal.open()
+        self.assertFalse(journal.done('/a.jpg'))
+        journal.close()
+        # a truncated last line is ignored
+        with open(self.path, 'a') as f:
+            f.write('ok\t1:2')
+        journal.open(resume=True)
+        journal.close()
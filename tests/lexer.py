@@ -38,4 +38,16 @@ class LexerTokenTest(TestCase):
         self.assertToken(parse('<'), 'operator', '<')
         self.assertToken(parse('>'), 'operator', '>')
         self.assertToken(parse('in'), 'operator', 'in')
+        self.assertToken(parse('between'), 'operator', 'between')
+        self.assertToken(parse('BEFORE'), 'operator', 'before')
+        self.assertRaises(ME, parse, ('and'))
+
+    def test_field_list(self):
+        parse = l.field_list.parse
+        tokens = parse('(path, is')
+        self.assertEquals([t.type for t in tokens], ['sep', 'field', 'sep', 'field'])
+        # whitespace is only kept at the end
+        tokens = parse('( path, ')
+        self.assertEquals([t.type for t in tokens], ['sep', 'field', 'sep', 'whitespace'])
+        self.assertEquals(parse('path'), None)
 
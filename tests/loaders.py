@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""iris metadata loader tests."""
+
+import os
+import struct
+import datetime
+import tempfile
+from fractions import Fraction
+from unittest import TestCase
+from iris.loaders import header, phash
+
+def ifd(entries, offset, endian='<'):
+    """Pack a list of (tag, type, count, data) entries into an IFD that will
+    live at offset;  returns the ifd bytes followed by its out of line data."""
+    size = 2 + len(entries) * 12 + 4
+    body, extra = struct.pack(endian + 'H', len(entries)), ''
+    for tag, type, count, data in entries:
+        if len(data) <= 4:
+            body += struct.pack(endian + 'HHL', tag, type, count) + data.ljust(4, '\x00')
+        else:
+            body += struct.pack(endian + 'HHLL', tag, type, count, offset + size + len(extra))
+            extra += data
+    return body + struct.pack(endian + 'L', 0) + extra
+
+def exif_segment(endian='<'):
+    """A tiff structure with an IFD0 and an Exif sub-IFD."""
+    ascii = lambda s: (2, len(s) + 1, s + '\x00')
+    photo_offset = 8 + 2 + 3 * 12 + 4 + len('Canon\x00') + len('Canon EOS 5D\x00')
+    ifd0 = ifd([
+        (0x010f,) + ascii('Canon'),
+        (0x0110,) + ascii('Canon EOS 5D'),
+        (0x8769, 4, 1, struct.pack(endian + 'L', photo_offset)),
+    ], 8, endian)
+    photo = ifd([
+        (0x829a, 5, 1, struct.pack(endian + 'LL', 10, 2500)),
+        (0x8827, 3, 1, struct.pack(endian + 'H', 400)),
+        (0x9003,) + ascii('2010:06:01 12:30:45'),
+        (0x920a, 5, 1, struct.pack(endian + 'LL', 50, 1)),
+    ], photo_offset, endian)
+    magic = 'II*\x00' if endian == '<' else 'MM\x00*'
+    return magic + struct.pack(endian + 'L', 8) + ifd0 + photo
+
+def iptc_segment():
+    datasets = [(2, 25, 'italy'), (2, 25, 'rome'), (2, 120, 'hello world'),
+        (2, 55, '20100601')]
+    iim = ''.join(['\x1c' + chr(r) + chr(d) + struct.pack('>H', len(v)) + v
+        for r, d, v in datasets])
+    resource = '8BIM' + struct.pack('>H', 0x0404) + '\x00\x00' + struct.pack('>L', len(iim)) + iim
+    return 'Photoshop 3.0\x00' + resource
+
+def segment(marker, data):
+    return '\xff' + chr(marker) + struct.pack('>H', len(data) + 2) + data
+
+def jpeg(width=640, height=480, endian='<'):
+    frame = struct.pack('>BHHB', 8, height, width, 1) + '\x01\x11\x00'
+    return ('\xff\xd8' + segment(0xe1, 'Exif\x00\x00' + exif_segment(endian)) +
+        segment(0xed, iptc_segment()) + segment(0xc0, frame) +
+        segment(0xda, '\x01\x01\x00\x00\x3f\x00') + '\x00' * 16 + '\xff\xd9')
+
+def dc_jpeg(blocks):
+    """A grayscale baseline jpeg made of flat 8x8 blocks with the given
+    brightnesses (rows of ints), using tiny made-up huffman tables."""
+    height, width = len(blocks) * 8, len(blocks[0]) * 8
+    # dc categories 0-11 get 4 bit codes;  the only ac symbol is end of block
+    dht = '\x00' + '\x00' * 3 + chr(12) + '\x00' * 12 + ''.join(map(chr, range(12)))
+    dht += '\x10' + '\x01' + '\x00' * 15 + '\x00'
+    bits, previous = '', 0
+    for row in blocks:
+        for value in row:
+            diff, previous = value - previous, value
+            size = len(bin(abs(diff))) - 2 if diff else 0
+            bits += bin(size)[2:].zfill(4)
+            if size:
+                bits += bin(diff if diff > 0 else diff + (1 << size) - 1)[2:].zfill(size)
+            bits += '0'
+    bits += '1' * (-len(bits) % 8)
+    scan = ''.join([chr(int(bits[i:i+8], 2)) for i in range(0, len(bits), 8)])
+    frame = struct.pack('>BHHB', 8, height, width, 1) + '\x01\x11\x00'
+    return ('\xff\xd8' + segment(0xc4, dht) + segment(0xc0, frame) +
+        segment(0xda, '\x01\x01\x00\x00\x3f\x00') +
+        scan.replace('\xff', '\xff\x00') + '\xff\xd9')
+
+class PHashTest(TestCase):
+    def test_dc_image(self):
+        blocks = [[(x * 37 + y * 11) % 200 - 100 for x in range(20)] for y in range(15)]
+        self.assertEquals(phash.dc_image(dc_jpeg(blocks)), blocks)
+
+    def test_dhash(self):
+        falling = [[200 - x * 10 for x in range(18)] for y in range(16)]
+        self.assertEquals(phash.dhash(dc_jpeg(falling)), (1 << 64) - 1)
+        rising = [[x * 10 for x in range(18)] for y in range(16)]
+        self.assertEquals(phash.dhash(dc_jpeg(rising)), 0)
+        self.assertEquals(phash.dhash('not a jpeg'), None)
+
+    def test_bad_sampling(self):
+        """A corrupt frame with a sampling factor of 0 isn't decoded."""
+        data = dc_jpeg([[x * 10 for x in range(18)] for y in range(16)])
+        data = data.replace('\x01\x11\x00', '\x01\x01\x00', 1)
+        self.assertRaises(phash.UnsupportedJPEG, phash.dc_image, data)
+        self.assertEquals(phash.dhash(data), None)
+
+    def test_bands(self):
+        value = 0x0123456789abcdef
+        self.assertEquals(len(phash.bands(value)), phash.BANDS)
+        near = value ^ 0b1011 ^ (1 << 40)
+        self.assertEquals(phash.hamming(value, near), 4)
+        self.assertEquals(phash.hamming(phash.to_signed((1 << 64) - 1), 0), 64)
+        # everything within the distance shares a band with the neighbours
+        keys = set(phash.neighbour_bands(value, 7))
+        self.assertTrue(keys & set(phash.bands(near)))
+        self.assertRaises(ValueError, phash.neighbour_bands, value, 64)
+
+class HeaderMetadataTest(TestCase):
+    def setUp(self):
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            os.unlink(path)
+
+    def write(self, data, suffix='.jpg'):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        os.write(handle, data)
+        os.close(handle)
+        self.paths.append(path)
+        return path
+
+    def test_jpeg(self):
+        for endian in '<>':
+            meta = header.HeaderMetadata(self.write(jpeg(endian=endian)))
+            meta.read()
+            self.assertEquals(meta.dimensions, (640, 480))
+            self.assertEquals(meta['Exif.Image.Make'].value, 'Canon')
+            self.assertEquals(meta['Exif.Image.Model'].value, 'Canon EOS 5D')
+            self.assertEquals(meta['Exif.Photo.ExposureTime'].value, Fraction(1, 250))
+            self.assertEquals(meta['Exif.Photo.ISOSpeedRatings'].value, 400)
+            self.assertEquals(meta['Exif.Photo.FocalLength'].value, Fraction(50))
+            self.assertEquals(meta['Exif.Photo.DateTimeOriginal'].value,
+                datetime.datetime(2010, 6, 1, 12, 30, 45))
+            self.assertTrue('Exif.Photo.ExposureTime' in meta.exif_keys)
+            self.assertEquals(meta.iptc_keys, ['Iptc.Application2.Keywords',
+                'Iptc.Application2.Caption', 'Iptc.Application2.DateCreated'])
+            self.assertEquals(meta['Iptc.Application2.Keywords'].values, ['italy', 'rome'])
+            self.assertEquals(meta['Iptc.Application2.DateCreated'].values,
+                [datetime.date(2010, 6, 1)])
+
+    def test_tiff(self):
+        data = 'II*\x00' + struct.pack('<L', 8) + ifd([
+            (0x0100, 3, 1, struct.pack('<H', 300)),
+            (0x0101, 4, 1, struct.pack('<L', 200)),
+        ], 8)
+        meta = header.HeaderMetadata(self.write(data, '.tif'))
+        meta.read()
+        self.assertEquals(meta.dimensions, (300, 200))
+
+    def test_tiff_iptc(self):
+        iim = iptc_segment()[len('Photoshop 3.0\x00'):]
+        for tag, data in ((0x83bb, iim[12:]), (0x8649, iim)):
+            data = 'II*\x00' + struct.pack('<L', 8) + ifd([
+                (0x0100, 3, 1, struct.pack('<H', 300)),
+                (0x0101, 4, 1, struct.pack('<L', 200)),
+                (tag, 7, len(data), data),
+            ], 8)
+            meta = header.HeaderMetadata(self.write(data, '.tif'))
+            meta.read()
+            self.assertEquals(meta['Iptc.Application2.Keywords'].values, ['italy', 'rome'])
+            self.assertEquals(meta['Iptc.Application2.Caption'].values, ['hello world'])
+            self.assertEquals(meta.exif_keys, ['Exif.Image.ImageWidth', 'Exif.Image.ImageLength'])
+
+    def test_unsupported(self):
+        for data, suffix in (('', '.jpg'), ('not an image', '.jpg'),
+                ('\xff\xd8\xff\xe1\x00', '.jpg'), (exif_segment(), '.cr2')):
+            meta = header.HeaderMetadata(self.write(data, suffix))
+            self.assertRaises(header.UnsupportedFormat, meta.read)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""iris ingest metrics tests."""
+
+import pickle
+from unittest import TestCase
+from iris import metrics
+
+class StatsTest(TestCase):
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        for seconds in (0.000001, 0.0001, 0.0001, 0.01):
+            histogram.add(seconds)
+        self.assertEquals(histogram.count, 4)
+        self.assertEquals(histogram.max, 0.01)
+        self.assertTrue(0.0001 <= histogram.percentile(50) < 0.0002)
+        self.assertEquals(histogram.percentile(100), 0.01)
+        other = metrics.Histogram()
+        other.add(1.0)
+        histogram.merge(other)
+        self.assertEquals(histogram.count, 5)
+        self.assertEquals(histogram.max, 1.0)
+        self.assertEquals(histogram.min, 0.000001)
+
+    def test_merge(self):
+        worker = metrics.Stats()
+        with worker.timer('read'):
+            pass
+        worker.count(files=2, bytes=100)
+        # stats travel between processes pickled
+        drained = pickle.loads(pickle.dumps(worker.drain()))
+        self.assertEquals(worker.stages, {})
+        parent = metrics.Stats()
+        parent.count(files=1)
+        parent.merge(drained)
+        report = parent.as_dict()
+        self.assertEquals(report['counters'], {'files': 3, 'bytes': 100})
+        self.assertEquals(report['stages']['read']['count'], 1)
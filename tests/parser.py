@@ -167,6 +167,32 @@ class QueryParserTest(TokenTestCase):
                 tokens = parse(stmt)
             test_tokens(i, tokens)
 
+    def test_errors(self):
+        """Test that parse errors say where the statement went wrong."""
+        errors = (
+            ('find 10 where iso <', 19), # missing value, so at the end
+            ('find 10 (a,) where', 11), # missing field
+            ('find where iso < "x"', 17), # '<' needs a number
+            ('find 1 2', 7),
+        )
+        for string, offset in errors:
+            try:
+                q.find_stmt.parse(string)
+            except ME, e:
+                self.assertEquals(e.stream.character_offset, offset)
+                self.assertEquals(e.stream.location[3], string)
+            else:
+                self.fail('%r parsed' % string)
+
+    def test_partial_match(self):
+        """Test that matching takes as much of a statement as it can, which
+        is how the completers see what's left to complete."""
+        tokens, stream = q.statement.match('find 10 (pa').next()
+        self.assertEquals(len(tokens), 2)
+        self.assertEquals(stream.text, '(pa')
+        tokens, stream = q.statement.match('find where iso > 3 an').next()
+        self.assertEquals(len(tokens), 5)
+        self.assertEquals(stream.text, 'an')
 
 class FindStatementTest(TokenTestCase):
     def assertStatement(self, statement, count, field_len, spec):
@@ -210,5 +236,61 @@ class FindStatementTest(TokenTestCase):
         self.assertStatement(find, 10, 1, {'$or' : [{'iso':{'$gt':200}}, {'tags': {'$in':['italy']}}]})
         find = q.FindStatement('find 10 (iso) where iso > 200 OR tags in ("italy")')
         self.assertStatement(find, 10, 1, {'$or' : [{'iso':{'$gt':200}}, {'tags': {'$in':['italy']}}]})
+        find = q.FindStatement('FIND 10 (iso) WHERE iso > 200 | tags in ("italy")')
+        self.assertStatement(find, 10, 1, {'$or' : [{'iso':{'$gt':200}}, {'tags': {'$in':['italy']}}]})
+
+    def test_typed_fields(self):
+        find = q.FindStatement('find (aperture, Camera) where aperture in ("2.8", 4)')
+        self.assertStatement(find, 0, 2, {'fstop': {'$in': [2.8, 4.0]}})
+        self.assertEquals(find.fields, ['fstop', 'camera'])
+        find = q.FindStatement('find where shutter <= 1/250 and iso = "400"')
+        self.assertStatement(find, 0, 0, {'shutter': {'$lte': 0.004}, 'iso': 400})
+        find = q.FindStatement('find where iso == 400')
+        self.assertStatement(find, 0, 0, {'iso': 400})
+
+    def test_date_queries(self):
+        from datetime import datetime
+        find = q.FindStatement('find where date between "2011-05-06" and "2011-05-08" and iso > 100')
+        self.assertStatement(find, 0, 0, {'date': {'$gte': datetime(2011, 5, 6), '$lt': datetime(2011, 5, 9)},
+            'iso': {'$gt': 100}})
+        self.assertEquals(find.hint, [('date', -1)])
+        find = q.FindStatement('find where date after "2011-05" or taken before "2011"')
+        self.assertStatement(find, 0, 0, {'$or': [{'date': {'$gte': datetime(2011, 6, 1)}},
+            {'taken_at': {'$lt': datetime(2011, 1, 1)}}]})
+        self.assertEquals(find.hint, None)
+        find = q.FindStatement('find where date = "2011-05-06"')
+        self.assertStatement(find, 0, 0, {'date': {'$gte': datetime(2011, 5, 6), '$lt': datetime(2011, 5, 7)}})
+        for query in ('find where date after "junk"', 'find where taken = "soon"',
+                'find where date < 5', 'find where taken in ("2011", 5)',
+                'find where date between "2011-05-08" and "2011-05-06"'):
+            self.assertRaises(q.QueryError, lambda: q.FindStatement(query).spec)
+        find = q.FindStatement('find where iso between 100 and "400"')
+        self.assertStatement(find, 0, 0, {'iso': {'$gte': 100, '$lte': 400}})
+        self.assertEquals(find.hint, None)
+
+    def test_keyword_queries(self):
+        find = q.FindStatement('find where caption == "Paris 2011" and tags == "x"')
+        self.assertStatement(find, 0, 0, {'caption': {'$regex': '.*Paris 2011.*'},
+            'tags': {'$regex': '.*x.*'}, 'keywords': {'$all': ['paris', '2011']}})
+        self.assertEquals(find.hint, [('keywords', 1)])
+        find = q.FindStatement('find where path == "paris"')
+        self.assertStatement(find, 0, 0, {'path': {'$regex': '.*paris.*'}})
+        self.assertEquals(find.hint, None)
 
+class GroupStatementTest(TokenTestCase):
+    def test_group_statements(self):
+        group = q.GroupStatement('group by Camera, month where iso >= 400')
+        self.assertEquals(group.keys, ['camera', 'month'])
+        self.assertEquals(group.spec, {'iso': {'$gte': 400}})
+        self.assertEquals((group.width, group.order), (None, 'count'))
+        self.assertEquals(q.GroupStatement('group by lens').spec, {})
+        self.assertRaises(ME, q.GroupStatement, 'group camera')
+        self.assertRaises(ME, q.GroupStatement, 'group by camera,')
 
+    def test_histogram_statements(self):
+        histogram = q.HistogramStatement('histogram aperture')
+        self.assertEquals((histogram.keys, histogram.width, histogram.order), (['fstop'], None, 'value'))
+        histogram = q.HistogramStatement('histogram iso by 100 where lens == "50mm"')
+        self.assertEquals((histogram.keys, histogram.width), (['iso'], 100))
+        self.assertEquals(histogram.spec['lens'], {'$regex': '.*50mm.*'})
+        self.assertRaises(ME, q.HistogramStatement, 'histogram iso, fstop')
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""iris utils tests."""
+
+from unittest import TestCase
+from iris import utils
+
+class ChunkedTest(TestCase):
+    def test_chunked(self):
+        chunks = list(utils.chunked(iter(range(7)), 3))
+        self.assertEquals(chunks, [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEquals(list(utils.chunked([], 3)), [])
+
+class HashFileTest(TestCase):
+    def test_hash_file(self):
+        import os, hashlib, tempfile
+        handle, path = tempfile.mkstemp()
+        os.write(handle, 'a' * 1000 + 'b' * 1000)
+        os.close(handle)
+        try:
+            expected = hashlib.sha1('a' * 1000 + 'b' * 1000).hexdigest()
+            self.assertEquals(utils.hash_file(path), expected)
+            self.assertEquals(utils.hash_file(path, chunk_size=7), expected)
+            quick = hashlib.sha1('a' * 1000 + '2000').hexdigest()
+            self.assertEquals(utils.hash_file(path, prefix=1000, chunk_size=300), quick)
+        finally:
+            os.unlink(path)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""iris watch tests.  These drive the Watcher with made up inotify events,
+so nothing waits on the kernel."""
+
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+from iris import backend, watch
+
+def load_file(photo, path, stat=None, keys=None, stats=None):
+    """Stands in for reading a photo;  files named 'bad*' are half written."""
+    if os.path.basename(path).startswith('bad'):
+        raise ValueError('truncated jpeg')
+    photo.path = os.path.realpath(path)
+    photo.size = stat.st_size
+    photo.fingerprint = backend.fingerprint(stat)
+
+class Photo(backend.Photo):
+    _collection = 'WatchTest'
+
+class WatcherTest(TestCase):
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        os.mkdir(os.path.join(self.root, 'album'))
+        self.objects, self.load_file = backend.Photo.objects, backend.Photo.load_file
+        backend.Photo.objects = backend.Manager(Photo)
+        backend.Photo.load_file = load_file
+        self.watcher = watch.Watcher([self.root], delay=1.0, hashing=None, threshold=1)
+        self.watcher.watch_tree(self.root)
+        self.collection = self.watcher.collection
+        self.cookie = 0
+
+    def tearDown(self):
+        self.watcher.inotify.close()
+        backend.get_database().drop_collection(Photo._collection)
+        backend.Photo.objects, backend.Photo.load_file = self.objects, self.load_file
+        shutil.rmtree(self.root)
+
+    def wd(self, directory):
+        for wd, path in self.watcher.directories.items():
+            if path == os.path.join(self.root, directory).rstrip(os.sep):
+                return wd
+
+    def write(self, path, contents='jpeg'):
+        with open(os.path.join(self.root, path), 'w') as f:
+            f.write(contents)
+
+    def event(self, mask, path, now, cookie=0):
+        directory, name = os.path.split(path)
+        self.watcher.handle((self.wd(directory), mask, cookie, name), now)
+
+    def move(self, mask, old, new, now):
+        self.cookie += 1
+        if old:
+            self.event(watch.IN_MOVED_FROM | mask, old, now, self.cookie)
+        if new:
+            self.event(watch.IN_MOVED_TO | mask, new, now, self.cookie)
+
+    def paths(self, **spec):
+        return sorted([d['path'][len(self.root) + 1:] for d in self.collection.find(spec)])
+
+    def test_debounced_reads(self):
+        self.write('album/a.jpg')
+        self.event(watch.IN_CLOSE_WRITE, 'album/a.jpg', 100)
+        self.watcher.process(100.5)
+        self.assertEquals(self.paths(), [])
+        self.event(watch.IN_CLOSE_WRITE, 'album/a.jpg', 100.5)
+        self.watcher.process(101.6)
+        self.assertEquals(self.paths(), ['album/a.jpg'])
+        self.assertEquals(self.watcher.pending, {})
+
+    def test_failed_reads(self):
+        """Files that vanish or can't be parsed yet are skipped, not fatal,
+        and read again on their next event."""
+        self.write('album/bad.jpg')
+        self.write('album/b.jpg')
+        for name in ('bad.jpg', 'b.jpg', 'gone.jpg'):
+            self.event(watch.IN_CLOSE_WRITE, 'album/' + name, 100)
+        self.watcher.process(102)
+        self.assertEquals(self.paths(), ['album/b.jpg'])
+        self.assertEquals(self.watcher.pending, {})
+        os.rename(os.path.join(self.root, 'album/bad.jpg'), os.path.join(self.root, 'album/good.jpg'))
+        self.move(0, 'album/bad.jpg', 'album/good.jpg', 103)
+        self.watcher.process(105)
+        self.assertEquals(self.paths(), ['album/b.jpg', 'album/good.jpg'])
+
+    def test_renames(self):
+        self.write('album/a.jpg')
+        self.event(watch.IN_CLOSE_WRITE, 'album/a.jpg', 100)
+        self.watcher.process(102)
+        self.move(0, 'album/a.jpg', 'album/c.jpg', 103)
+        self.assertEquals(self.paths(), ['album/c.jpg'])
+        os.rename(os.path.join(self.root, 'album'), os.path.join(self.root, 'trip'))
+        self.move(watch.IN_ISDIR, 'album', 'trip', 104)
+        self.assertEquals(self.paths(), ['trip/c.jpg'])
+        self.assertEquals(self.watcher.directories[self.wd('trip')], os.path.join(self.root, 'trip'))
+        self.watcher.process(110)
+        self.assertEquals(self.paths(moved=True), [])
+
+    def test_moved_out(self):
+        """Directories moved out of the roots are flagged and unwatched."""
+        self.write('album/a.jpg')
+        self.event(watch.IN_CLOSE_WRITE, 'album/a.jpg', 100)
+        self.watcher.process(102)
+        outside = tempfile.mkdtemp()
+        try:
+            shutil.move(os.path.join(self.root, 'album'), outside)
+            self.move(watch.IN_ISDIR, 'album', None, 103)
+            self.watcher.process(103.5)
+            self.assertTrue(self.wd('album'))
+            self.watcher.process(104)
+            self.assertEquals(self.paths(moved=True), ['album/a.jpg'])
+            self.assertEquals(self.wd('album'), None)
+            self.assertEquals(self.watcher.moves, {})
+        finally:
+            shutil.rmtree(outside)
+
+    def test_moved_in(self):
+        """Directories moved in are watched and read in full."""
+        outside = tempfile.mkdtemp()
+        os.mkdir(os.path.join(outside, 'new'))
+        with open(os.path.join(outside, 'new', 'd.jpg'), 'w') as f:
+            f.write('jpeg')
+        shutil.move(os.path.join(outside, 'new'), os.path.join(self.root, 'album'))
+        shutil.rmtree(outside)
+        self.move(watch.IN_ISDIR, None, 'album/new', 100)
+        self.assertTrue(self.wd('album/new'))
+        self.watcher.process(time.time() + 2)
+        self.assertEquals(self.paths(), ['album/new/d.jpg'])
+
+    def test_counts(self):
+        """Counts cached by another process, like a shell, see what the
+        watcher writes."""
+        manager = backend.Manager(Photo)
+        def elsewhere(function, *args):
+            # without this process noticing any writes
+            generations = dict(backend._generations)
+            function(*args)
+            backend._generations.clear()
+            backend._generations.update(generations)
+        self.assertEquals(manager.count({'moved': True}), 0)
+        self.assertEquals(manager.count(), 0)
+        self.write('album/a.jpg')
+        self.event(watch.IN_CLOSE_WRITE, 'album/a.jpg', 100)
+        elsewhere(self.watcher.process, 102)
+        self.assertEquals(manager.count(), 1)
+        self.event(watch.IN_DELETE, 'album/a.jpg', 103)
+        elsewhere(self.watcher.process, 105)
+        self.assertEquals(manager.count({'moved': True}), 1)